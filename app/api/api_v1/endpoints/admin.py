@@ -8,11 +8,13 @@ from app.schemas.common import ResponseBase
 from app.services.user import UserService
 from app.utils.security import get_current_admin_user
 from app.services.subscription import SubscriptionService
+from app.services.device_counters import refresh_device_counters
 from app.services.order import OrderService
 from app.services.settings import SettingsService
 from app.services.payment_config import PaymentConfigService
 from app.services.email_template import EmailTemplateService
 from app.services.node_service import NodeService
+from app.services.subscription_cache import subscription_config_cache, subscription_key_cache, bump_config_version
 # from app.services.node_speed_monitor import get_node_speed_monitor  # 已删除
 # from app.models.user import User  # 暂时注释掉，避免循环导入
 
@@ -51,37 +53,25 @@ def get_users(
         )
         
         
-        # 获取每个用户的订阅信息和设备信息
+        # 批量获取本页用户的订阅信息和设备信息
+        subscriptions = subscription_service.get_by_user_ids([user.id for user in users])
+        try:
+            device_counts = subscription_service.get_device_counts([sub.id for sub in subscriptions.values()])
+        except Exception as e:
+            # 统计失败时回滚失败的事务（否则PostgreSQL等后续查询都会报错），使用订阅记录中的设备数
+            print(f"批量统计设备数失败: {e}")
+            db.rollback()
+            device_counts = {sub.id: (sub.current_devices or 0, 0) for sub in subscriptions.values()}
+        
         user_list = []
         for user in users:
-            subscription = subscription_service.get_by_user_id(user.id)
+            subscription = subscriptions.get(user.id)
             
             # 获取用户设备信息
             device_count = 0
             online_devices = 0
             if subscription:
-                try:
-                    from sqlalchemy import text
-                    # 直接从devices表获取设备信息
-                    device_query = text("""
-                        SELECT COUNT(*) as total_count,
-                               COUNT(CASE WHEN last_access > datetime('now', '-5 minutes') THEN 1 END) as online_count
-                        FROM devices 
-                        WHERE subscription_id = :subscription_id
-                    """)
-                    result = db.execute(device_query, {
-                        'subscription_id': subscription.id
-                    }).fetchone()
-                    
-                    if result:
-                        device_count = result.total_count or 0
-                        online_devices = result.online_count or 0
-                    else:
-                        device_count = subscription.current_devices if subscription else 0
-                        online_devices = 0
-                except Exception as e:
-                    device_count = subscription.current_devices if subscription else 0
-                    online_devices = 0
+                device_count, online_devices = device_counts.get(subscription.id, (0, 0))
             
             # 计算订阅状态和到期信息
             subscription_status = "inactive"
@@ -477,6 +467,7 @@ def update_user(
                 if "is_active" in user_data["subscription"]:
                     subscription.is_active = user_data["subscription"]["is_active"]
                 subscription_service.db.commit()
+                subscription_key_cache.invalidate(subscription.id)
         
         # 记录管理员操作日志
         try:
@@ -637,12 +628,7 @@ def delete_device_admin(
         
         if result.rowcount > 0:
             # 更新订阅的设备计数
-            subscription_query = text("""
-                UPDATE subscriptions 
-                SET current_devices = current_devices - 1 
-                WHERE id = :subscription_id AND current_devices > 0
-            """)
-            db.execute(subscription_query, {'subscription_id': device.subscription_id})
+            refresh_device_counters(db, device.subscription_id)
             db.commit()
             return ResponseBase(message="设备删除成功")
         else:
@@ -700,11 +686,7 @@ def delete_user_device_admin(
         
         if result.rowcount > 0:
             # 更新订阅的设备计数
-            db.execute(text("""
-                UPDATE subscriptions 
-                SET current_devices = current_devices - 1 
-                WHERE id = :subscription_id AND current_devices > 0
-            """), {'subscription_id': device.subscription_id})
+            refresh_device_counters(db, device.subscription_id)
             db.commit()
             return ResponseBase(message="设备删除成功")
         else:
@@ -742,7 +724,7 @@ def clear_user_devices_admin(
         """), {'subscription_id': subscription.id})
         
         # 重置设备计数
-        subscription.current_devices = 0
+        refresh_device_counters(db, subscription.id)
         db.commit()
         
         return ResponseBase(message=f"已清理 {result.rowcount} 个设备")
@@ -778,9 +760,10 @@ def reset_user_subscription(
         devices = subscription_service.get_devices_by_subscription_id(subscription.id)
         for device in devices:
             subscription_service.db.delete(device)
+        refresh_device_counters(db, subscription.id)
         
-        subscription.current_devices = 0
         subscription_service.db.commit()
+        subscription_key_cache.invalidate(subscription.id)
         
         # 发送重置通知邮件
         try:
@@ -1788,7 +1771,9 @@ def save_clash_config(
                 "updated_at": current_time
             })
         
+        bump_config_version(db, current_time)
         db.commit()
+        subscription_config_cache.invalidate()
         return ResponseBase(message="Clash配置保存成功")
     except Exception as e:
         db.rollback()
@@ -1839,7 +1824,9 @@ def save_clash_config_invalid(
                 "updated_at": current_time
             })
         
+        bump_config_version(db, current_time)
         db.commit()
+        subscription_config_cache.invalidate()
         return ResponseBase(message="Clash失效配置保存成功")
     except Exception as e:
         db.rollback()
@@ -1934,7 +1921,9 @@ def save_v2ray_config(
                 "updated_at": current_time
             })
         
+        bump_config_version(db, current_time)
         db.commit()
+        subscription_config_cache.invalidate()
         return ResponseBase(message="V2Ray配置保存成功")
     except Exception as e:
         db.rollback()
@@ -1985,7 +1974,9 @@ def save_v2ray_config_invalid(
                 "updated_at": current_time
             })
         
+        bump_config_version(db, current_time)
         db.commit()
+        subscription_config_cache.invalidate()
         return ResponseBase(message="V2Ray失效配置保存成功")
     except Exception as e:
         db.rollback()
@@ -2573,51 +2564,42 @@ def get_subscriptions(
         if status:
             query_params['status'] = status
             
-        # 获取订阅数据
-        subscriptions, total = subscription_service.get_subscriptions_with_pagination(
-            skip=skip, 
-            limit=size,
-            **query_params
-        )
+        # 获取订阅数据（设备统计与排序在数据库中完成）
+        try:
+            subscriptions, device_stats, total = subscription_service.get_subscriptions_with_device_stats(
+                skip=skip,
+                limit=size,
+                sort=sort,
+                **query_params
+            )
+        except Exception as e:
+            print(f"获取订阅设备信息失败: {e}")
+            db.rollback()
+            subscriptions, total = subscription_service.get_subscriptions_with_pagination(
+                skip=skip,
+                limit=size,
+                **query_params
+            )
+            device_stats = {
+                subscription.id: {"device_count": subscription.current_devices or 0}
+                for subscription in subscriptions
+            }
+        
+        # 生成订阅地址
+        # 使用动态域名配置
+        from app.core.domain_config import get_domain_config
+        domain_config = get_domain_config()
+        base_url = domain_config.get_base_url(request, db)
         
         subscription_list = []
         for subscription in subscriptions:
             # 获取用户设备信息
-            device_count = 0
-            online_devices = 0
-            apple_count = 0
-            clash_count = 0
-            v2ray_count = 0
-            
-            try:
-                from sqlalchemy import text
-                # 直接从devices表获取设备信息
-                device_query = text("""
-                    SELECT COUNT(*) as total_count,
-                           COUNT(CASE WHEN last_access > datetime('now', '-5 minutes') THEN 1 END) as online_count,
-                           COUNT(CASE WHEN device_type = 'mobile' AND (user_agent LIKE '%iOS%' OR user_agent LIKE '%macOS%' OR user_agent LIKE '%Apple%') THEN 1 END) as apple_count,
-                           COUNT(CASE WHEN user_agent LIKE '%Clash%' THEN 1 END) as clash_count,
-                           COUNT(CASE WHEN user_agent LIKE '%V2Ray%' OR user_agent LIKE '%Shadowrocket%' THEN 1 END) as v2ray_count
-                    FROM devices 
-                    WHERE subscription_id = :subscription_id
-                """)
-                result = db.execute(device_query, {
-                    'subscription_id': subscription.id
-                }).fetchone()
-                
-                if result:
-                    device_count = result.total_count or 0
-                    online_devices = result.online_count or 0
-                    apple_count = result.apple_count or 0
-                    clash_count = result.clash_count or 0
-                    v2ray_count = result.v2ray_count or 0
-                else:
-                    device_count = subscription.current_devices if subscription else 0
-                    online_devices = 0
-            except Exception as e:
-                print(f"获取订阅设备信息失败: {e}")
-                device_count = subscription.current_devices if subscription else 0
-                online_devices = 0
+            stats = device_stats.get(subscription.id, {})
+            device_count = stats.get("device_count", 0)
+            online_devices = stats.get("online_devices", 0)
+            apple_count = stats.get("apple_count", 0)
+            clash_count = stats.get("clash_count", 0)
+            v2ray_count = stats.get("v2ray_count", 0)
             
             # 计算订阅状态和到期信息
             subscription_status = "inactive"
@@ -2641,11 +2623,6 @@ def get_subscriptions(
                     is_expired = True
                     days_until_expire = 0
             
-            # 生成订阅地址
-            # 使用动态域名配置
-            from app.core.domain_config import get_domain_config
-            domain_config = get_domain_config()
-            base_url = domain_config.get_base_url(request, db)
             v2ray_url = f"{base_url}/api/v1/subscriptions/ssr/{subscription.subscription_url}" if subscription.subscription_url else None
             clash_url = f"{base_url}/api/v1/subscriptions/clash/{subscription.subscription_url}" if subscription.subscription_url else None
             
@@ -2680,33 +2657,6 @@ def get_subscriptions(
             }
             subscription_list.append(subscription_data)
         
-        # 应用排序
-        if sort:
-            if sort == "add_time_desc":
-                subscription_list.sort(key=lambda x: x["created_at"] or "", reverse=True)
-            elif sort == "add_time_asc":
-                subscription_list.sort(key=lambda x: x["created_at"] or "")
-            elif sort == "expire_time_desc":
-                subscription_list.sort(key=lambda x: x["expire_time"] or "", reverse=True)
-            elif sort == "expire_time_asc":
-                subscription_list.sort(key=lambda x: x["expire_time"] or "")
-            elif sort == "device_count_desc":
-                subscription_list.sort(key=lambda x: x["current_devices"], reverse=True)
-            elif sort == "device_count_asc":
-                subscription_list.sort(key=lambda x: x["current_devices"])
-            elif sort == "apple_count_desc":
-                subscription_list.sort(key=lambda x: x["apple_count"], reverse=True)
-            elif sort == "apple_count_asc":
-                subscription_list.sort(key=lambda x: x["apple_count"])
-            elif sort == "online_devices_desc":
-                subscription_list.sort(key=lambda x: x["online_devices"], reverse=True)
-            elif sort == "online_devices_asc":
-                subscription_list.sort(key=lambda x: x["online_devices"])
-            elif sort == "device_limit_desc":
-                subscription_list.sort(key=lambda x: x["device_limit"], reverse=True)
-            elif sort == "device_limit_asc":
-                subscription_list.sort(key=lambda x: x["device_limit"])
-        
         response_data = {
             "subscriptions": subscription_list,
             "total": total,
@@ -2880,6 +2830,7 @@ def update_subscription(
             
             db.execute(update_query, update_values)
             db.commit()
+            subscription_key_cache.invalidate(subscription_id)
             
             return ResponseBase(message="订阅更新成功")
         else:
@@ -4474,12 +4425,12 @@ def get_apple_stats(
     try:
         subscription_service = SubscriptionService(db)
         
-        # 统计苹果设备
+        # 统计苹果设备（汇总各订阅的设备计数）
         from sqlalchemy import text
         apple_query = text("""
-            SELECT COUNT(*) as total_count,
-                   COUNT(CASE WHEN device_type = 'mobile' AND (user_agent LIKE '%iOS%' OR user_agent LIKE '%macOS%' OR user_agent LIKE '%Apple%') THEN 1 END) as apple_count
-            FROM devices
+            SELECT SUM(total_devices) as total_count,
+                   SUM(apple_devices) as apple_count
+            FROM subscription_device_counters
         """)
         result = db.execute(apple_query).fetchone()
         
@@ -4506,14 +4457,12 @@ def get_online_stats(
         # 统计在线设备
         from sqlalchemy import text
         online_query = text("""
-            SELECT COUNT(*) as total_count,
-                   COUNT(CASE WHEN last_access > datetime('now', '-5 minutes') THEN 1 END) as online_count
-            FROM devices
+            SELECT SUM(total_devices) as total_count FROM subscription_device_counters
         """)
         result = db.execute(online_query).fetchone()
         
         total_devices = result.total_count or 0
-        online_count = result.online_count or 0
+        online_count = subscription_service.count_online_devices()
         
         return ResponseBase(data={
             "online_devices": online_count,
@@ -77,13 +77,14 @@ def stop_config_update(
 @router.get("/logs", response_model=ResponseBase)
 def get_update_logs(
     limit: int = Query(100, ge=1, le=1000),
+    since_id: Optional[int] = Query(None, ge=0, description="只返回id大于该值的日志，用于增量轮询"),
     db: Session = Depends(get_db),
     current_admin = Depends(get_current_admin_user)
 ) -> Any:
     """获取更新日志"""
     try:
         service = get_config_update_service(db)
-        logs = service.get_logs(limit=limit)
+        logs = service.get_logs(limit=limit, since_id=since_id)
         return ResponseBase(data=logs)
     except Exception as e:
         return ResponseBase(success=False, message=f"获取日志失败: {str(e)}")
@@ -248,12 +249,8 @@ def clear_logs(
         service.logs.clear()
         
         # 清空数据库中的日志
-        from app.models.config import SystemConfig
-        import json
-        logs_record = db.query(SystemConfig).filter(SystemConfig.key == "config_update_logs").first()
-        if logs_record:
-            logs_record.value = json.dumps([])
-            db.commit()
+        from app.services.config_update_logs import config_update_log_buffer
+        config_update_log_buffer.clear()
         
         # 不记录任何日志，直接返回成功消息
         return ResponseBase(message="日志已清理")
@@ -39,17 +39,8 @@ def get_user_statistics(
     verified_users = user_service.count_verified_users()
     today_users = user_service.count_users_since(now.replace(hour=0, minute=0, second=0, microsecond=0))
     
-    # 注册趋势
-    registration_trend = []
-    current_date = start_date
-    while current_date <= now:
-        next_date = current_date + timedelta(days=1)
-        count = user_service.count_users_since(current_date, next_date)
-        registration_trend.append({
-            "date": current_date.strftime("%Y-%m-%d"),
-            "count": count
-        })
-        current_date = next_date
+    # 注册趋势（按天分组统计）
+    registration_trend = user_service.get_registration_trend(start_date, now)
     
     # 用户地域分布（示例数据）
     region_distribution = [
@@ -89,14 +80,12 @@ def get_subscription_statistics(
     # 设备统计
     from sqlalchemy import text
     device_stats_query = text("""
-        SELECT COUNT(*) as total_count,
-               COUNT(CASE WHEN last_access > datetime('now', '-5 minutes') THEN 1 END) as online_count
-        FROM devices
+        SELECT SUM(total_devices) as total_count FROM subscription_device_counters
     """)
     device_stats = db.execute(device_stats_query).fetchone()
     
     total_devices = device_stats.total_count or 0
-    online_devices = device_stats.online_count or 0
+    online_devices = subscription_service.count_online_devices()
     
     # 订阅时长分布
     duration_distribution = [
@@ -162,17 +151,8 @@ def get_order_statistics(
         {"status": "已过期", "count": order_service.count_by_status("expired")}
     ]
     
-    # 收入趋势
-    revenue_trend = []
-    current_date = start_date
-    while current_date <= now:
-        next_date = current_date + timedelta(days=1)
-        revenue = order_service.get_revenue_since(current_date, next_date)
-        revenue_trend.append({
-            "date": current_date.strftime("%Y-%m-%d"),
-            "revenue": float(revenue)
-        })
-        current_date = next_date
+    # 收入趋势（按天分组统计）
+    revenue_trend = order_service.get_revenue_trend(start_date, now)
     
     # 支付方式统计
     payment_methods = [
@@ -1,6 +1,8 @@
-from datetime import datetime, timedelta
-from typing import Any, List
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Any, List, Optional, Tuple
 from fastapi import APIRouter, Depends, HTTPException, status, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 import secrets
 import string
@@ -8,11 +10,18 @@ import base64
 from urllib.parse import quote
 
 from app.core.config import settings
-from app.core.database import get_db
+from app.core.database import AsyncSession, SessionLocal, get_async_db, get_db
 from app.schemas.subscription import SubscriptionInDB, DeviceInDB
 from app.schemas.common import ResponseBase
-from app.services.subscription import SubscriptionService
+from app.services.device_counters import get_device_counters, refresh_device_counters
+from app.services.device_presence import device_presence
+from app.services.device_manager import AsyncDeviceManager
+from app.services.subscription import AsyncSubscriptionService, SubscriptionService
+from app.services.subscription_cache import (
+    get_encoded_content, get_encoded_content_async, supported_encodings, subscription_key_cache
+)
 from app.services.user import UserService
+from app.utils.cache import SingleFlight
 from app.utils.security import get_current_user, generate_subscription_url
 from app.services.email import EmailService
 from app.utils.device import generate_device_fingerprint, detect_device_type, extract_device_name
@@ -77,9 +86,9 @@ def get_user_subscription(
             is_expiring = False
             expiry_date = "未设置"
         
-        # 获取设备数量
-        devices = subscription_service.get_devices_by_subscription_id(subscription.id)
-        current_devices = len(devices)
+        # 获取设备数量（设备计数表）和在线设备数（内存中的在线状态）
+        current_devices = get_device_counters(db, [subscription.id]).get(subscription.id, {}).get('total_devices', 0)
+        online_devices = device_presence.online_count_for(subscription.id)
         max_devices = subscription.device_limit
         
         # 生成订阅URL
@@ -104,7 +113,7 @@ def get_user_subscription(
                 "is_expiring": is_expiring,
                 "currentDevices": current_devices,
                 "current_devices": current_devices,
-                "online_devices": current_devices,
+                "online_devices": online_devices,
                 "maxDevices": max_devices,
                 "is_device_limit_reached": current_devices >= max_devices,
                 "mobileUrl": ssr_url,
@@ -300,7 +309,7 @@ def remove_device(
         
         if result.rowcount > 0:
             # 更新订阅的设备计数
-            subscription.current_devices = max(0, subscription.current_devices - 1)
+            refresh_device_counters(db, subscription.id)
             db.commit()
             return ResponseBase(message="设备移除成功")
         else:
@@ -442,6 +451,114 @@ def urlencode(text: str) -> str:
     """URL编码"""
     return quote(text)
 
+def _format_etag(entry: dict, encoding: str = None) -> str:
+    """生成强ETag，不同压缩编码使用不同的ETag"""
+    if encoding:
+        return f'"{entry["etag"]}-{encoding}"'
+    return f'"{entry["etag"]}"'
+
+def _etag_matches(client_tag: str, entry: dict) -> bool:
+    """比较客户端ETag与内容哈希（忽略压缩编码后缀）"""
+    tag = client_tag.strip()
+    if tag.startswith("W/"):
+        tag = tag[2:]
+    tag = tag.strip('"')
+    for encoding in supported_encodings():
+        if tag.endswith(f"-{encoding}"):
+            tag = tag[:-len(encoding) - 1]
+            break
+    return tag == entry["etag"]
+
+def _is_not_modified(request: Request, entry: dict) -> bool:
+    """检查条件请求头，判断客户端缓存是否仍然有效"""
+    if entry["etag"] is None:
+        return False
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        if if_none_match.strip() == "*":
+            return True
+        return any(_etag_matches(tag, entry) for tag in if_none_match.split(","))
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and entry.get("last_modified"):
+        try:
+            client_time = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if client_time.tzinfo is None:
+            client_time = client_time.replace(tzinfo=timezone.utc)
+        return entry["last_modified"].replace(microsecond=0) <= client_time
+    
+    return False
+
+def _has_conditional_headers(request: Request) -> bool:
+    """是否为条件请求"""
+    return bool(request.headers.get("if-none-match") or request.headers.get("if-modified-since"))
+
+def _negotiate_encoding(request: Request) -> str:
+    """根据Accept-Encoding选择压缩编码，返回None表示不压缩"""
+    accept_encoding = request.headers.get("accept-encoding", "")
+    if not accept_encoding:
+        return None
+    
+    accepted = {}
+    for item in accept_encoding.split(","):
+        parts = item.strip().split(";")
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+    
+    for encoding in supported_encodings():
+        quality = accepted.get(encoding, accepted.get("*", 0.0))
+        if quality > 0:
+            return encoding
+    return None
+
+def _cache_headers(entry: dict, encoding: str = None) -> dict:
+    """订阅内容的缓存校验响应头（占位内容不带校验信息，且禁止缓存）"""
+    if entry["etag"] is None:
+        return {"Cache-Control": "no-store", "Vary": "Accept-Encoding"}
+    headers = {
+        "ETag": _format_etag(entry, encoding),
+        "Cache-Control": "no-cache",
+        "Vary": "Accept-Encoding"
+    }
+    if entry.get("last_modified"):
+        headers["Last-Modified"] = format_datetime(entry["last_modified"], usegmt=True)
+    return headers
+
+def build_config_response(request: Request, entry: dict) -> Response:
+    """返回订阅配置内容，按Accept-Encoding返回预压缩版本，客户端缓存有效时返回304"""
+    encoding = _negotiate_encoding(request)
+    body = get_encoded_content(entry, encoding) if encoding else None
+    if body is None:
+        encoding = None
+    
+    headers = _cache_headers(entry, encoding)
+    if _is_not_modified(request, entry):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    
+    if encoding:
+        headers["Content-Encoding"] = encoding
+        return Response(content=body, media_type="text/plain", headers=headers)
+    return Response(content=entry["content"], media_type="text/plain", headers=headers)
+
+async def build_config_response_async(request: Request, entry: dict) -> Response:
+    """异步端点使用的build_config_response：首次压缩在线程池中执行"""
+    encoding = _negotiate_encoding(request)
+    if encoding and not _is_not_modified(request, entry):
+        await get_encoded_content_async(entry, encoding)
+    return build_config_response(request, entry)
+
 def record_device_access(subscription, request: Request, db: Session):
     """记录设备访问"""
     from app.services.device_manager import DeviceManager
@@ -492,6 +609,7 @@ def update_user_subscription(
                 raise HTTPException(status_code=400, detail="日期格式错误")
         
         subscription_service.db.commit()
+        subscription_key_cache.invalidate(subscription.id)
         
         return ResponseBase(message="订阅设置更新成功")
     except HTTPException:
@@ -521,9 +639,10 @@ def reset_user_subscription_url(
         devices = subscription_service.get_devices_by_subscription_id(subscription.id)
         for device in devices:
             subscription_service.db.delete(device)
+        refresh_device_counters(db, subscription.id)
         
-        subscription.current_devices = 0
         subscription_service.db.commit()
+        subscription_key_cache.invalidate(subscription.id)
         
         # 发送重置通知邮件
         try:
@@ -569,21 +688,117 @@ def clear_user_devices(
         devices = subscription_service.get_devices_by_subscription_id(subscription.id)
         for device in devices:
             subscription_service.db.delete(device)
+        refresh_device_counters(db, subscription.id)
         
-        subscription.current_devices = 0
         subscription_service.db.commit()
         
         return ResponseBase(message="所有设备清理成功")
     except Exception as e:
         return ResponseBase(success=False, message=f"清理设备失败: {str(e)}") 
 
+# 并发的相同订阅请求（同一地址、UA、IP）只执行一次设备检查和内容读取
+subscription_single_flight = SingleFlight()
+
+async def _resolve_subscription_async(kind: str, subscription_key: str, user_agent: str,
+                                      client_ip: str, db: AsyncSession) -> Tuple[bool, Any]:
+    """检查订阅访问权限并读取配置，返回 (是否允许, 配置缓存条目或失效配置内容)"""
+    subscription_service = AsyncSubscriptionService(db)
+    device_manager = AsyncDeviceManager(db)
+    
+    # 检查订阅访问权限（包含设备限制检查）
+    access_result = await device_manager.check_subscription_access(
+        subscription_key, user_agent, client_ip
+    )
+    
+    if not access_result['allowed']:
+        print(f"订阅访问被拒绝: {access_result['message']}")
+        # 所有失效情况都返回失效配置文件，软件订阅应该返回配置文件而不是HTML页面
+        if kind == "clash":
+            return False, await subscription_service.get_invalid_clash_config()
+        return False, await subscription_service.get_invalid_v2ray_config()
+    
+    print(f"订阅访问允许: {subscription_key}")
+    if kind == "clash":
+        return True, await subscription_service.get_clash_config_entry()
+    return True, await subscription_service.get_v2ray_config_entry()
+
+async def _serve_async(kind: str, subscription_key: str, request: Request, db: AsyncSession) -> Response:
+    """使用异步会话处理订阅请求"""
+    subscription_service = AsyncSubscriptionService(db)
+    
+    user_agent = request.headers.get("user-agent", "")
+    client_ip = request.client.host if request.client else "unknown"
+    
+    print(f"{'Clash' if kind == 'clash' else ''}订阅访问请求: {subscription_key}, UA: {user_agent}, IP: {client_ip}")
+    
+    # 条件请求：只校验订阅本身，内容未变化时直接返回304，不读写设备表
+    if _has_conditional_headers(request):
+        if (await AsyncDeviceManager(db).check_subscription_status(subscription_key))['allowed']:
+            if kind == "clash":
+                entry = await subscription_service.get_clash_config_entry()
+            else:
+                entry = await subscription_service.get_v2ray_config_entry()
+            if _is_not_modified(request, entry):
+                return build_config_response(request, entry)
+    
+    allowed, result = await subscription_single_flight.do(
+        (kind, subscription_key, user_agent, client_ip),
+        lambda: _resolve_subscription_async(kind, subscription_key, user_agent, client_ip, db)
+    )
+    
+    if not allowed:
+        return Response(content=result, media_type="text/plain", status_code=403)
+    # 压缩编码和304按各自请求头处理
+    return await build_config_response_async(request, result)
+
 @router.get("/ssr/{subscription_key}")
-def get_ssr_subscription(
+async def get_ssr_subscription(
     subscription_key: str,
     request: Request,
-    db: Session = Depends(get_db)
+    db: Optional[AsyncSession] = Depends(get_async_db)
 ) -> Any:
     """获取SSR/V2Ray订阅内容 - 集成设备限制检查"""
+    if db is None:
+        # 异步数据库驱动不可用，在线程池中使用同步会话处理
+        return await run_in_threadpool(_serve_sync, _serve_ssr_subscription, subscription_key, request)
+    
+    try:
+        return await _serve_async("v2ray", subscription_key, request, db)
+    except Exception as e:
+        print(f"获取SSR订阅失败: {e}")
+        import traceback
+        traceback.print_exc()
+        invalid_config = await AsyncSubscriptionService(db).get_invalid_v2ray_config()
+        return Response(content=invalid_config, media_type="text/plain")
+
+@router.get("/clash/{subscription_key}")
+async def get_clash_subscription(
+    subscription_key: str,
+    request: Request,
+    db: Optional[AsyncSession] = Depends(get_async_db)
+) -> Any:
+    """获取Clash订阅内容 - 集成设备限制检查"""
+    if db is None:
+        # 异步数据库驱动不可用，在线程池中使用同步会话处理
+        return await run_in_threadpool(_serve_sync, _serve_clash_subscription, subscription_key, request)
+    
+    try:
+        return await _serve_async("clash", subscription_key, request, db)
+    except Exception as e:
+        print(f"获取Clash订阅失败: {e}")
+        invalid_config = await AsyncSubscriptionService(db).get_invalid_clash_config()
+        return Response(content=invalid_config, media_type="text/plain")
+
+def _serve_sync(handler, subscription_key: str, request: Request) -> Response:
+    """使用同步会话处理订阅请求"""
+    db = SessionLocal()
+    try:
+        return handler(subscription_key, request, db)
+    finally:
+        db.close()
+
+def _serve_ssr_subscription(subscription_key: str, request: Request, db: Session) -> Response:
+    """获取SSR/V2Ray订阅内容（同步会话版本）"""
     try:
         from app.services.device_manager import DeviceManager
         
@@ -596,6 +811,13 @@ def get_ssr_subscription(
         
         print(f"订阅访问请求: {subscription_key}, UA: {user_agent}, IP: {client_ip}")
         
+        # 条件请求：只校验订阅本身，内容未变化时直接返回304，不读写设备表
+        if _has_conditional_headers(request):
+            if device_manager.check_subscription_status(subscription_key)['allowed']:
+                entry = subscription_service.get_v2ray_config_entry()
+                if _is_not_modified(request, entry):
+                    return build_config_response(request, entry)
+        
         # 检查订阅访问权限（包含设备限制检查）
         access_result = device_manager.check_subscription_access(
             subscription_key, user_agent, client_ip
@@ -612,9 +834,9 @@ def get_ssr_subscription(
         print(f"订阅访问允许: {subscription_key}")
         
         # 返回有效的V2Ray配置
-        v2ray_config = subscription_service.get_v2ray_config()
+        v2ray_entry = subscription_service.get_v2ray_config_entry()
         print("返回V2Ray配置")
-        return Response(content=v2ray_config, media_type="text/plain")
+        return build_config_response(request, v2ray_entry)
         
     except Exception as e:
         print(f"获取SSR订阅失败: {e}")
@@ -624,13 +846,8 @@ def get_ssr_subscription(
         invalid_config = subscription_service.get_invalid_v2ray_config()
         return Response(content=invalid_config, media_type="text/plain")
 
-@router.get("/clash/{subscription_key}")
-def get_clash_subscription(
-    subscription_key: str,
-    request: Request,
-    db: Session = Depends(get_db)
-) -> Any:
-    """获取Clash订阅内容 - 集成设备限制检查"""
+def _serve_clash_subscription(subscription_key: str, request: Request, db: Session) -> Response:
+    """获取Clash订阅内容（同步会话版本）"""
     try:
         from app.services.device_manager import DeviceManager
         
@@ -643,6 +860,13 @@ def get_clash_subscription(
         
         print(f"Clash订阅访问请求: {subscription_key}, UA: {user_agent}, IP: {client_ip}")
         
+        # 条件请求：只校验订阅本身，内容未变化时直接返回304，不读写设备表
+        if _has_conditional_headers(request):
+            if device_manager.check_subscription_status(subscription_key)['allowed']:
+                entry = subscription_service.get_clash_config_entry()
+                if _is_not_modified(request, entry):
+                    return build_config_response(request, entry)
+        
         # 检查订阅访问权限（包含设备限制检查）
         access_result = device_manager.check_subscription_access(
             subscription_key, user_agent, client_ip
@@ -659,9 +883,9 @@ def get_clash_subscription(
         print(f"订阅访问允许: {subscription_key}")
         
         # 返回有效的Clash配置
-        clash_config = subscription_service.get_clash_config()
+        clash_entry = subscription_service.get_clash_config_entry()
         print("返回Clash配置")
-        return Response(content=clash_config, media_type="text/plain")
+        return build_config_response(request, clash_entry)
         
     except Exception as e:
         print(f"获取Clash订阅失败: {e}")
@@ -78,6 +78,9 @@ class Settings(BaseSettings):
     # 订阅配置
     SUBSCRIPTION_URL_PREFIX: str = os.getenv("SUBSCRIPTION_URL_PREFIX", "http://localhost:8000/sub")
     DEVICE_LIMIT_DEFAULT: int = int(os.getenv("DEVICE_LIMIT_DEFAULT", "3"))
+    # 单个订阅地址的刷新频率限制（令牌桶）
+    SUBSCRIPTION_RATE_LIMIT_BURST: int = int(os.getenv("SUBSCRIPTION_RATE_LIMIT_BURST", "10"))
+    SUBSCRIPTION_RATE_LIMIT_PER_MINUTE: int = int(os.getenv("SUBSCRIPTION_RATE_LIMIT_PER_MINUTE", "6"))
     
     # 应用配置
     DEBUG: bool = os.getenv("DEBUG", "True").lower() == "true"
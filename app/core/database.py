@@ -6,6 +6,13 @@ from app.core.config import settings
 import logging
 import os
 
+try:
+    from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+except ImportError:  # 异步扩展不可用时只提供同步会话
+    AsyncSession = None
+    async_sessionmaker = None
+    create_async_engine = None
+
 logger = logging.getLogger(__name__)
 
 def get_database_url():
@@ -24,6 +31,27 @@ def get_database_url():
         # 默认SQLite
         return "sqlite:///./xboard.db"
 
+# 同步驱动 -> 异步驱动
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "mysql": "aiomysql",
+    "postgresql": "asyncpg"
+}
+
+def get_async_database_url(url: str):
+    """将同步数据库URL转换为异步驱动URL，不支持的数据库返回None"""
+    scheme, separator, rest = url.partition("://")
+    if not separator:
+        return None
+    
+    dialect = scheme.split("+")[0]
+    if dialect == "postgres":
+        dialect = "postgresql"
+    driver = ASYNC_DRIVERS.get(dialect)
+    if not driver:
+        return None
+    return f"{dialect}+{driver}://{rest}"
+
 # 创建数据库引擎
 database_url = get_database_url()
 logger.info(f"使用数据库: {database_url}")
@@ -70,6 +98,30 @@ else:
 # 创建会话工厂
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# 创建异步数据库引擎（供高并发的订阅下载端点使用）
+async_engine = None
+AsyncSessionLocal = None
+async_database_url = get_async_database_url(database_url)
+if create_async_engine is not None and async_database_url:
+    try:
+        if "sqlite" in async_database_url:
+            async_engine = create_async_engine(async_database_url, pool_pre_ping=True)
+        else:
+            async_engine = create_async_engine(
+                async_database_url,
+                pool_size=20,
+                max_overflow=30,
+                pool_pre_ping=True,
+                pool_recycle=3600,
+                echo=settings.DEBUG
+            )
+        AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+    except Exception as e:
+        # 异步驱动未安装时回退到同步会话
+        logger.warning(f"异步数据库引擎不可用，订阅端点将使用同步会话: {e}")
+        async_engine = None
+        AsyncSessionLocal = None
+
 # 创建基础模型类
 Base = declarative_base()
 
@@ -81,6 +133,15 @@ def get_db():
     finally:
         db.close()
 
+# 依赖注入：获取异步数据库会话（异步引擎不可用时返回None）
+async def get_async_db():
+    if AsyncSessionLocal is None:
+        yield None
+        return
+    
+    async with AsyncSessionLocal() as db:
+        yield db
+
 # 测试数据库连接
 def test_database_connection():
     """测试数据库连接"""
@@ -96,6 +157,16 @@ def test_database_connection():
         logger.error(f"数据库连接测试失败: {e}")
         return False
 
+# 补建索引
+def ensure_indexes():
+    """为已存在的表创建模型中新增的索引"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except Exception as e:
+                logger.warning(f"创建索引 {index.name} 失败: {e}")
+
 # 初始化数据库
 def init_database():
     """初始化数据库表"""
@@ -112,6 +183,9 @@ def init_database():
         Base.metadata.create_all(bind=engine)
         logger.info("数据库表初始化成功")
         
+        # create_all不会为已存在的表补建索引
+        ensure_indexes()
+        
         # 验证关键表是否创建成功
         with engine.connect() as connection:
             if "sqlite" in database_url:
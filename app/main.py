@@ -6,15 +6,18 @@ from datetime import datetime
 
 from .core.config import settings
 from .api.api_v1.api import api_router
-from .core.database import init_database
+from .core.database import init_database, SessionLocal
 from .middleware.rate_limit import rate_limit_middleware
 from .models import (
-    User, Subscription, Device, Order, Package, EmailQueue, 
+    User, Subscription, Device, SubscriptionDeviceCounter, Order, Package, EmailQueue, 
     EmailTemplate, Notification, Node, PaymentTransaction, 
     PaymentConfig, PaymentCallback, SystemConfig, Announcement, 
-    ThemeConfig, UserActivity, SubscriptionReset, LoginHistory
+    ThemeConfig, ConfigUpdateLog, UserActivity, SubscriptionReset, LoginHistory
 )
 from .services.email_queue_processor import get_email_queue_processor
+from .services.device_access_buffer import get_device_access_buffer
+from .services.device_presence import get_device_presence
+from .services.config_update_logs import get_config_update_log_buffer
 from .tasks.notification_tasks import start_notification_scheduler, stop_notification_scheduler
 # from .services.node_speed_monitor import get_node_speed_monitor  # 已删除
 
@@ -57,6 +60,19 @@ async def startup_event():
         # 启动通知调度器
         start_notification_scheduler()
         
+        # 启动设备访问写缓冲
+        get_device_access_buffer().start()
+        
+        # 加载最近访问过的设备，重启后在线设备数不从零开始
+        db = SessionLocal()
+        try:
+            loaded = get_device_presence().load_recent(db)
+            print(f"已加载 {loaded} 个在线设备")
+        except Exception as e:
+            print(f"加载在线设备失败: {e}")
+        finally:
+            db.close()
+        
         # 启动节点测速监控 - 已删除
         # node_monitor = get_node_speed_monitor()
         # node_monitor.start()
@@ -78,6 +94,13 @@ async def shutdown_event():
         stop_notification_scheduler()
         print("通知调度器已停止")
         
+        # 停止设备访问写缓冲并写入剩余记录
+        get_device_access_buffer().stop()
+        print("设备访问写缓冲已停止")
+        
+        # 写入剩余的配置更新日志
+        get_config_update_log_buffer().flush()
+        
         # 停止节点测速监控 - 已删除
         # node_monitor = get_node_speed_monitor()
         # node_monitor.stop()
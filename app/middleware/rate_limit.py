@@ -1,10 +1,11 @@
 """
 请求频率限制中间件
 """
+import re
 import time
-from typing import Dict, Optional
+from typing import Dict, Optional, Tuple
 from fastapi import Request, HTTPException, status
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from collections import defaultdict, deque
 import asyncio
 from app.core.config import settings
@@ -66,9 +67,59 @@ class RateLimiter:
                 del self.requests[ip]
 
 
+class TokenBucketLimiter:
+    """令牌桶限流器，按任意key（如订阅地址）独立计数"""
+    
+    def __init__(self, capacity: int, refill_per_second: float, max_keys: int = 100000):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.max_keys = max_keys
+        # key -> (剩余令牌, 上次更新时间)
+        self.buckets: Dict[str, Tuple[float, float]] = {}
+    
+    def acquire(self, key: str) -> float:
+        """
+        尝试获取一个令牌
+        
+        Returns:
+            float: 0表示允许请求，否则为需要等待的秒数
+        """
+        now = time.monotonic()
+        tokens, updated = self.buckets.get(key, (self.capacity, now))
+        tokens = min(self.capacity, tokens + (now - updated) * self.refill_per_second)
+        
+        if tokens >= 1:
+            self.buckets[key] = (tokens - 1, now)
+            return 0
+        
+        self.buckets[key] = (tokens, now)
+        if self.refill_per_second <= 0:
+            return 60.0
+        return (1 - tokens) / self.refill_per_second
+    
+    def cleanup(self):
+        """清理已回满的桶，回满后与新建的桶等价"""
+        now = time.monotonic()
+        full_keys = [
+            key for key, (tokens, updated) in self.buckets.items()
+            if tokens + (now - updated) * self.refill_per_second >= self.capacity
+        ]
+        for key in full_keys:
+            del self.buckets[key]
+
+
 # 全局速率限制器实例
 rate_limiter = RateLimiter()
 
+# 订阅地址限流器实例（防止客户端配置错误导致的高频刷新）
+subscription_rate_limiter = TokenBucketLimiter(
+    capacity=settings.SUBSCRIPTION_RATE_LIMIT_BURST,
+    refill_per_second=settings.SUBSCRIPTION_RATE_LIMIT_PER_MINUTE / 60
+)
+
+# 客户端订阅下载路径
+SUBSCRIPTION_PATH_PATTERN = re.compile(r"^/api/v1/subscriptions/(?:clash|ssr)/([^/]+)$")
+
 
 async def rate_limit_middleware(request: Request, call_next):
     """
@@ -90,6 +141,19 @@ async def rate_limit_middleware(request: Request, call_next):
     # 根据路径设置不同的限制
     path = request.url.path
     
+    # 订阅下载按订阅地址限流，单个地址的高频刷新不影响其他用户
+    subscription_match = SUBSCRIPTION_PATH_PATTERN.match(path)
+    if subscription_match:
+        retry_after = subscription_rate_limiter.acquire(subscription_match.group(1))
+        if retry_after > 0:
+            return PlainTextResponse(
+                "# 订阅刷新过于频繁，请稍后再试",
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers={"Retry-After": str(max(1, int(retry_after + 0.999)))}
+            )
+        if len(subscription_rate_limiter.buckets) > subscription_rate_limiter.max_keys:
+            subscription_rate_limiter.cleanup()
+    
     # 登录接口更严格的限制
     if path in ["/api/v1/auth/login", "/api/v1/auth/register"]:
         limit = 100  # 每分钟100次
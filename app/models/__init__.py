@@ -1,5 +1,5 @@
 from .user import User
-from .subscription import Subscription, Device
+from .subscription import Subscription, Device, SubscriptionDeviceCounter
 from .order import Order
 from .package import Package
 from .email import EmailQueue
@@ -7,7 +7,7 @@ from .notification import EmailTemplate, Notification
 from .node import Node
 from .payment import PaymentTransaction, PaymentCallback
 from .payment_config import PaymentConfig
-from .config import SystemConfig, Announcement, ThemeConfig
+from .config import SystemConfig, Announcement, ThemeConfig, ConfigUpdateLog
 from .user_activity import UserActivity, SubscriptionReset, LoginHistory
 
 # 设置关系
@@ -49,6 +49,7 @@ __all__ = [
     "User",
     "Subscription", 
     "Device",
+    "SubscriptionDeviceCounter",
     "Order",
     "Package", 
     "EmailQueue",
@@ -61,6 +62,7 @@ __all__ = [
     "SystemConfig",
     "Announcement",
     "ThemeConfig",
+    "ConfigUpdateLog",
     "UserActivity",
     "SubscriptionReset",
     "LoginHistory"
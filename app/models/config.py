@@ -53,4 +53,16 @@ class ThemeConfig(Base):
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
     
     def __repr__(self):
-        return f"<ThemeConfig(id={self.id}, name='{self.name}', display_name='{self.display_name}')>" 
\ No newline at end of file
+        return f"<ThemeConfig(id={self.id}, name='{self.name}', display_name='{self.display_name}')>" 
+
+class ConfigUpdateLog(Base):
+    """配置更新任务日志（只追加，按id游标读取）"""
+    __tablename__ = "config_update_logs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    level = Column(String(20), nullable=False, default='info')
+    message = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    
+    def __repr__(self):
+        return f"<ConfigUpdateLog(id={self.id}, level='{self.level}')>"
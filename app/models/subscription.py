@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from app.core.database import Base
@@ -28,6 +28,11 @@ class Subscription(Base):
         return f"<Subscription(id={self.id}, user_id={self.user_id}, url='{self.subscription_url}')>"
 class Device(Base):
     __tablename__ = "devices"
+    __table_args__ = (
+        # 订阅访问检查：按订阅查找设备哈希、统计已允许设备数
+        Index("ix_devices_subscription_hash", "subscription_id", "device_hash"),
+        Index("ix_devices_subscription_allowed", "subscription_id", "is_allowed"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=True)  # 直接关联用户
@@ -60,3 +65,20 @@ class Device(Base):
     
     def __repr__(self):
         return f"<Device(id={self.id}, subscription_id={self.subscription_id}, fingerprint='{self.device_fingerprint}')>" 
+
+
+class SubscriptionDeviceCounter(Base):
+    """订阅设备计数（由设备写入路径增量维护，定时任务对账修正）"""
+    __tablename__ = "subscription_device_counters"
+
+    subscription_id = Column(Integer, ForeignKey("subscriptions.id", ondelete="CASCADE"), primary_key=True)
+    total_devices = Column(Integer, nullable=False, default=0)
+    allowed_devices = Column(Integer, nullable=False, default=0)
+    blocked_devices = Column(Integer, nullable=False, default=0)
+    apple_devices = Column(Integer, nullable=False, default=0)  # 苹果移动设备
+    clash_devices = Column(Integer, nullable=False, default=0)  # Clash客户端
+    v2ray_devices = Column(Integer, nullable=False, default=0)  # V2Ray/Shadowrocket客户端
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<SubscriptionDeviceCounter(subscription_id={self.subscription_id}, total={self.total_devices})>"
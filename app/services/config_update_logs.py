@@ -0,0 +1,127 @@
+"""
+配置更新日志存储
+日志先写入内存缓冲，按条数或时间间隔批量插入config_update_logs表（只追加），
+避免每条日志都读取并重写整个JSON数组；管理后台按id游标增量读取
+"""
+
+import threading
+import time
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from sqlalchemy import text
+from app.core.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class ConfigUpdateLogBuffer:
+    """配置更新日志写缓冲"""
+
+    def __init__(self, flush_size: int = 50, flush_interval: float = 1.0, max_rows: int = 1000):
+        self.flush_size = flush_size  # 缓冲条数达到该值时写入
+        self.flush_interval = flush_interval  # 距上次写入超过该时间（秒）时写入
+        self.max_rows = max_rows  # 表中保留的最大日志条数
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: List[Dict[str, Any]] = []
+        self._last_flush = time.monotonic()
+
+    def append(self, level: str, message: str, created_at: Optional[datetime] = None):
+        """追加一条日志，达到条数或时间阈值时批量写入数据库"""
+        with self._lock:
+            self._pending.append({
+                'level': level,
+                'message': message,
+                'created_at': created_at or datetime.now()
+            })
+            due = (len(self._pending) >= self.flush_size
+                   or time.monotonic() - self._last_flush >= self.flush_interval)
+        if due:
+            self.flush()
+
+    def flush(self) -> int:
+        """将缓冲的日志写入数据库，返回写入的条数"""
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = []
+                self._last_flush = time.monotonic()
+
+            if not pending:
+                return 0
+
+            db = SessionLocal()
+            try:
+                db.execute(text("""
+                    INSERT INTO config_update_logs (level, message, created_at)
+                    VALUES (:level, :message, :created_at)
+                """), pending)
+                # 只保留最近的max_rows条
+                db.execute(text("""
+                    DELETE FROM config_update_logs
+                    WHERE id <= (SELECT max_id FROM (SELECT MAX(id) - :max_rows AS max_id FROM config_update_logs) t)
+                """), {'max_rows': self.max_rows})
+                db.commit()
+                return len(pending)
+            except Exception as e:
+                db.rollback()
+                logger.error(f"写入配置更新日志失败，丢弃 {len(pending)} 条: {e}")
+                return 0
+            finally:
+                db.close()
+
+    def get_logs(self, limit: int = 100, since_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """读取日志（按id升序）：指定since_id时返回其后的日志，否则返回最近limit条"""
+        self.flush()
+
+        db = SessionLocal()
+        try:
+            if since_id is not None:
+                rows = db.execute(text("""
+                    SELECT id, level, message, created_at FROM config_update_logs
+                    WHERE id > :since_id ORDER BY id LIMIT :limit
+                """), {'since_id': since_id, 'limit': limit}).fetchall()
+            else:
+                rows = db.execute(text("""
+                    SELECT id, level, message, created_at FROM config_update_logs
+                    ORDER BY id DESC LIMIT :limit
+                """), {'limit': limit}).fetchall()
+                rows = list(reversed(rows))
+        finally:
+            db.close()
+
+        return [
+            {
+                'id': row.id,
+                'timestamp': row.created_at.isoformat() if hasattr(row.created_at, 'isoformat') else row.created_at,
+                'level': row.level,
+                'message': row.message
+            }
+            for row in rows
+        ]
+
+    def clear(self):
+        """清空缓冲和数据库中的日志"""
+        with self._flush_lock:
+            with self._lock:
+                self._pending = []
+
+            db = SessionLocal()
+            try:
+                db.execute(text("DELETE FROM config_update_logs"))
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+
+
+# 全局配置更新日志缓冲实例
+config_update_log_buffer = ConfigUpdateLogBuffer()
+
+
+def get_config_update_log_buffer() -> ConfigUpdateLogBuffer:
+    """获取配置更新日志缓冲实例"""
+    return config_update_log_buffer
@@ -0,0 +1,122 @@
+"""
+配置更新运行指标
+记录每次配置更新各阶段的耗时、字节数、节点数和失败数，以及当前阶段的进度，
+供/config-update/status展示（服务实例按请求创建，指标保存在模块级实例中）
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+
+class ConfigUpdateMetrics:
+    """配置更新运行指标（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._current: Optional[Dict[str, Any]] = None
+        self._last: Optional[Dict[str, Any]] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._current is not None
+
+    def start_run(self, kind: str = "update"):
+        """开始记录一次运行"""
+        with self._lock:
+            self._current = {
+                'kind': kind,
+                'started_at': datetime.now().isoformat(),
+                'finished_at': None,
+                'duration': None,
+                'success': None,
+                'error': None,
+                'stages': {},
+                'sources': [],
+                'progress': None,
+                '_started': time.monotonic()
+            }
+
+    def finish_run(self, success: bool, error: Optional[str] = None):
+        """结束当前运行，保存为最近一次运行记录"""
+        with self._lock:
+            run = self._current
+            if run is None:
+                return
+            run['finished_at'] = datetime.now().isoformat()
+            run['duration'] = round(time.monotonic() - run.pop('_started'), 3)
+            run['success'] = success
+            run['error'] = error
+            run['progress'] = None
+            self._last = run
+            self._current = None
+
+    def _stage(self, run: Dict[str, Any], name: str) -> Dict[str, Any]:
+        return run['stages'].setdefault(name, {'seconds': 0.0, 'calls': 0})
+
+    @contextmanager
+    def stage(self, name: str):
+        """记录阶段耗时（同名阶段累加）"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.monotonic() - started)
+
+    def add_time(self, name: str, seconds: float):
+        """累加阶段耗时"""
+        with self._lock:
+            if self._current is None:
+                return
+            stage = self._stage(self._current, name)
+            stage['seconds'] = round(stage['seconds'] + seconds, 3)
+            stage['calls'] += 1
+
+    def add(self, name: str, **counters: int):
+        """累加阶段计数（字节数、节点数、失败数等）"""
+        with self._lock:
+            if self._current is None:
+                return
+            stage = self._stage(self._current, name)
+            for key, value in counters.items():
+                stage[key] = stage.get(key, 0) + value
+
+    def add_source(self, **source: Any):
+        """记录单个节点源的下载结果"""
+        with self._lock:
+            if self._current is not None:
+                self._current['sources'].append(source)
+
+    def set_progress(self, stage: str, done: int, total: int):
+        """更新当前阶段进度"""
+        with self._lock:
+            if self._current is None:
+                return
+            self._current['progress'] = {
+                'stage': stage,
+                'done': done,
+                'total': total,
+                'percent': round(done / total * 100, 1) if total else 100.0
+            }
+
+    def snapshot(self) -> Dict[str, Any]:
+        """返回当前运行（含已运行时间）和最近一次运行的指标"""
+        with self._lock:
+            current = None
+            if self._current is not None:
+                current = {k: v for k, v in self._current.items() if not k.startswith('_')}
+                current['stages'] = {k: dict(v) for k, v in self._current['stages'].items()}
+                current['sources'] = list(self._current['sources'])
+                current['elapsed'] = round(time.monotonic() - self._current['_started'], 3)
+            return {'current': current, 'last': self._last}
+
+
+# 全局配置更新运行指标实例
+config_update_metrics = ConfigUpdateMetrics()
+
+
+def get_config_update_metrics() -> ConfigUpdateMetrics:
+    """获取配置更新运行指标实例"""
+    return config_update_metrics
@@ -3,24 +3,225 @@
 """
 
 import os
+import copy
 import json
 import base64
+import binascii
+import codecs
+import hashlib
 import subprocess
 import threading
 import time
 import yaml
 import requests
+from requests.adapters import HTTPAdapter
 import urllib.parse
 import re
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Dict, List, Any, Optional
+from itertools import repeat
+from typing import Dict, List, Any, Optional, Tuple
 from sqlalchemy.orm import Session
 from app.core.database import get_db, SessionLocal
 from app.models.config import SystemConfig
+from app.services.config_update_logs import config_update_log_buffer
+from app.services.config_update_metrics import config_update_metrics
+from app.services.node_parse_cache import NodeParseCache
+from app.services.subscription_cache import subscription_config_cache, precompress_entry, bump_config_version
 import logging
 
 logger = logging.getLogger(__name__)
 
+# 节点源并发下载线程数
+MAX_DOWNLOAD_WORKERS = 8
+# 节点源下载超时（连接超时, 读取超时），单位秒
+DOWNLOAD_TIMEOUT = (10, 30)
+# 节点源校验信息（ETag/Last-Modified/内容哈希）及缓存节点的保存文件，位于target_dir下
+SOURCE_STATE_FILE = ".source_state.json"
+# 配置生成逻辑版本，修改生成逻辑后递增，使已有的输入摘要失效
+GENERATOR_VERSION = 1
+# 节点数量达到该值时使用多进程解析
+PARALLEL_PARSE_MIN_NODES = 2000
+# 每个解析任务包含的节点数
+PARSE_CHUNK_SIZE = 500
+# 解析进程数上限
+MAX_PARSE_WORKERS = 8
+# 节点解析结果缓存文件（位于配置目标目录下）
+NODE_PARSE_CACHE_FILE = ".node_parse_cache.sqlite"
+# 节点解析结果缓存的最大条目数
+NODE_PARSE_CACHE_MAX_ENTRIES = 50000
+
+# 各协议节点链接的匹配规则，使用更精确的正则表达式，避免误匹配
+NODE_LINK_PATTERNS = [
+    ('vmess', r'vmess://[A-Za-z0-9+/=]+'),
+    ('vless', r'vless://[A-Za-z0-9+/=@:?#.-]+'),  # 添加点号支持域名
+    ('ss', r'ss://[A-Za-z0-9+/=@:?#.-]+'),  # 添加点号支持域名
+    ('ssr', r'ssr://[A-Za-z0-9+/=]+'),
+    ('trojan', r'trojan://[A-Za-z0-9-]+@[^:\s]+:\d+(?:[?&][^#\s]*)?(?:#[^\s]*)?'),  # 精确匹配Trojan格式
+    ('hysteria2', r'hysteria2://[A-Za-z0-9+/=@:?#.-]+'),  # 添加点号支持域名
+    ('hy2', r'hy2://[A-Za-z0-9+/=@:?#.-]+'),  # 添加点号支持域名
+    ('tuic', r'tuic://[A-Za-z0-9+/=@:?#.-]+'),  # 添加点号支持域名
+]
+# 合并后的节点链接正则，单次扫描按文档顺序提取所有协议的链接
+NODE_LINK_REGEX = re.compile('|'.join(f'(?P<{name}>{pattern})' for name, pattern in NODE_LINK_PATTERNS))
+# 协议前缀 -> 节点类型（用于统计）
+NODE_TYPE_BY_SCHEME = {
+    'ss': 'SS',
+    'ssr': 'SSR',
+    'vmess': 'VMess',
+    'trojan': 'Trojan',
+    'vless': 'VLESS',
+    'hysteria2': 'Hysteria2',
+    'hy2': 'Hysteria2',
+    'tuic': 'TUIC',
+}
+
+
+def scan_node_links(content: str):
+    """单次扫描内容，按文档顺序依次返回 (节点类型, 节点链接)"""
+    for match in NODE_LINK_REGEX.finditer(content):
+        yield NODE_TYPE_BY_SCHEME[match.lastgroup], match.group()
+
+
+# 发布到数据库的配置行：key -> (type, display_name, description, sort_order)
+PUBLISHED_CONFIG_ROWS = {
+    'clash_config': ('clash', 'Clash有效配置', 'Clash代理有效配置文件', 1),
+    'v2ray_config': ('v2ray', 'V2Ray有效配置', 'V2Ray代理有效配置文件', 2),
+}
+
+# 生成Clash配置时每次序列化的节点数
+CLASH_PROXY_DUMP_BATCH = 200
+
+# 下载节点源时每次读取的字节数
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# 判断节点源是否为base64编码时检查的前缀长度
+BASE64_SNIFF_SIZE = 4096
+BASE64_CHARS = frozenset(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/=')
+# URL安全base64使用的字符
+BASE64_URLSAFE_CHARS = frozenset(b'-_')
+# 解码前删除的非base64字符（空白、混入的其他字符），与base64.b64decode默认丢弃非法字符的行为一致
+BASE64_DELETE_BYTES = bytes(c for c in range(256) if c not in BASE64_CHARS)
+# URL安全base64转换为标准base64
+BASE64_URLSAFE_TABLE = bytes.maketrans(b'-_', b'+/')
+
+
+class NodeLinkStream:
+    """流式解析节点源内容：根据开头内容判断是否为base64编码，边下载边解码，
+    按行提取节点链接，不在内存中保留完整的响应内容"""
+
+    def __init__(self):
+        self.links: List[str] = []
+        self.type_count: Dict[str, int] = {}
+        self.size = 0  # 原始内容字节数
+        self.decoded_size = 0  # 解码后的字符数
+        self.is_base64: Optional[bool] = None
+        self.is_urlsafe = False
+        self.decode_error: Optional[str] = None  # base64解码失败的原因，之后的内容按原始文本提取
+        self._sha256 = hashlib.sha256()
+        self._head = b''
+        self._b64_pending = b''
+        self._text_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._line_tail = ''
+
+    @property
+    def sha256(self) -> str:
+        return self._sha256.hexdigest()
+
+    def feed(self, chunk: bytes):
+        """写入一段原始响应内容"""
+        if not chunk:
+            return
+        self.size += len(chunk)
+        self._sha256.update(chunk)
+
+        if self.is_base64 is None:
+            # 积累足够的开头内容后再判断编码
+            self._head += chunk
+            if len(self._head) < BASE64_SNIFF_SIZE:
+                return
+            chunk, self._head = self._head, b''
+            self._sniff(chunk[:BASE64_SNIFF_SIZE])
+
+        self._feed_raw(chunk)
+
+    def close(self):
+        """内容结束，处理剩余数据"""
+        if self.is_base64 is None:
+            chunk, self._head = self._head, b''
+            self._sniff(chunk[:BASE64_SNIFF_SIZE])
+            self._feed_raw(chunk)
+
+        if self.is_base64 and self._b64_pending and self.decode_error is None:
+            # 补齐缺失的填充字符
+            pending = self._b64_pending + b'=' * (-len(self._b64_pending) % 4)
+            self._b64_pending = b''
+            self._feed_decoded(self._b64decode(pending))
+
+        self._feed_text(self._text_decoder.decode(b'', final=True))
+        if self._line_tail:
+            self._scan_line(self._line_tail)
+            self._line_tail = ''
+
+    def _sniff(self, head: bytes):
+        """开头内容去掉空白后只包含base64字符（标准或URL安全）时认为是base64编码"""
+        compact = set(b''.join(head.split()))
+        self.is_base64 = bool(compact) and compact <= BASE64_CHARS | BASE64_URLSAFE_CHARS
+        # 同时出现两种字母表的字符时按标准base64处理，-和_视为混入的非法字符
+        self.is_urlsafe = self.is_base64 and bool(compact & BASE64_URLSAFE_CHARS) and not compact & set(b'+/')
+
+    def _feed_raw(self, chunk: bytes):
+        if not self.is_base64 or self.decode_error is not None:
+            self._feed_decoded(chunk)
+            return
+
+        encoded = chunk.translate(BASE64_URLSAFE_TABLE) if self.is_urlsafe else chunk
+        # 先删除非base64字符再按4字节分组，混入的字符不会打乱后续分组
+        data = self._b64_pending + encoded.translate(None, BASE64_DELETE_BYTES)
+        usable = len(data) - len(data) % 4
+        self._b64_pending = data[usable:]
+        if not usable:
+            return
+
+        self._feed_decoded(self._b64decode(data[:usable]))
+        if self.decode_error is not None:
+            # 解码失败时不丢弃剩余内容：本段及之后的内容按原始文本提取节点链接
+            self._b64_pending = b''
+            self._feed_text('\n')
+            self._feed_decoded(chunk)
+
+    def _b64decode(self, data: bytes) -> bytes:
+        """解码base64数据，支持多段带填充的base64拼接在一起；失败时记录原因，返回已解码的部分"""
+        # 填充字符出现在中间时按段解码（b64decode遇到填充后会忽略剩余内容）
+        segments = [data] if b'=' not in data[:-4] else [segment for segment in re.findall(rb'[^=]*=*', data) if segment]
+        decoded = []
+        for segment in segments:
+            try:
+                decoded.append(base64.b64decode(segment))
+            except (binascii.Error, ValueError) as e:
+                self.decode_error = str(e)
+                break
+        return b''.join(decoded)
+
+    def _feed_decoded(self, data: bytes):
+        if data:
+            self._feed_text(self._text_decoder.decode(data))
+
+    def _feed_text(self, text: str):
+        if not text:
+            return
+        self.decoded_size += len(text)
+        lines = (self._line_tail + text).split('\n')
+        self._line_tail = lines.pop()
+        for line in lines:
+            self._scan_line(line)
+
+    def _scan_line(self, line: str):
+        for node_type, link in scan_node_links(line):
+            self.links.append(link)
+            self.type_count[node_type] = self.type_count.get(node_type, 0) + 1
+
+
 def unicode_decode(s):
     """Unicode解码函数"""
     try:
@@ -67,6 +268,10 @@ def clean_name(name, filter_keywords=None):
 
 def get_unique_name(name, name_count, node_type="节点", server=None, filter_keywords=None):
     """获取唯一名称 - 按照老代码逻辑，使用中文名称"""
+    return ensure_unique_name(normalize_node_name(name, node_type, server, filter_keywords), name_count)
+
+def normalize_node_name(name, node_type="节点", server=None, filter_keywords=None):
+    """清理节点名称，名称为空或为默认名称时按地区和协议重命名（不依赖其他节点）"""
     # 先清理名称
     name = clean_name(name, filter_keywords)
     name = name.strip()
@@ -81,6 +286,10 @@ def get_unique_name(name, name_count, node_type="节点", server=None, filter_ke
         # 生成新的名称格式：地区-协议-编号
         name = f"{region}-{node_type}-001"
     
+    return name
+
+def ensure_unique_name(name, name_count):
+    """名称已被使用时添加编号，并记录到name_count"""
     # 检查名称是否已存在，如果存在则添加编号
     original_name = name
     counter = 1
@@ -166,6 +375,8 @@ class ConfigUpdateService:
         self.scheduled_thread = None
         self.logs = []
         self.max_logs = 1000
+        # 已生成但尚未发布的配置：key -> {content, temp_file, output_file}
+        self._staged_outputs: Dict[str, Dict[str, str]] = {}
         
         # 默认配置（仅作为备用，实际使用后台配置）
         self.default_config = {
@@ -180,12 +391,17 @@ class ConfigUpdateService:
     
     def get_status(self) -> Dict[str, Any]:
         """获取服务状态"""
+        metrics = config_update_metrics.snapshot()
+        current_run = metrics['current']
         return {
-            "is_running": self.is_running_flag,
+            "is_running": self.is_running_flag or current_run is not None,
             "scheduled_enabled": self.scheduled_task is not None,
             "last_update": self._get_last_update_time(),
             "next_update": self._get_next_update_time(),
-            "config_exists": self._check_config_files_exist()
+            "config_exists": self._check_config_files_exist(),
+            "progress": current_run['progress'] if current_run else None,
+            "current_run": current_run,
+            "last_run": metrics['last']
         }
     
     def is_running(self) -> bool:
@@ -199,6 +415,8 @@ class ConfigUpdateService:
             return
         
         self.is_running_flag = True
+        config_update_metrics.start_run("update")
+        run_error = None
         self._add_log("开始执行配置更新任务", "info")
         
         # 在后台任务中创建新的数据库连接
@@ -214,11 +432,17 @@ class ConfigUpdateService:
             target_dir = config.get("target_dir", "./uploads/config")
             os.makedirs(target_dir, exist_ok=True)
             
-            # 下载和处理节点
-            nodes = self._download_and_process_nodes(config)
+            # 下载和处理节点（带上次的校验信息，未变化的节点源直接使用缓存节点）
+            source_state = self._load_source_state(target_dir)
+            nodes = self._download_and_process_nodes(config, source_state)
             
-            # 生成配置文件
-            if nodes:
+            # 所有输入均未变化时跳过配置生成，避免重写文件和使下游缓存失效
+            input_digest = self._compute_input_digest(config, source_state)
+            if nodes and self._is_output_current(source_state, input_digest, config):
+                self._add_log("⏭️ 节点源与配置均未变化，跳过配置文件生成", "info")
+                self._save_source_state(target_dir, source_state)
+                self._update_last_update_time()
+            elif nodes:
                 self._add_log(f"📝 开始生成配置文件，共 {len(nodes)} 个节点", "info")
                 
                 # 生成v2ray配置
@@ -232,6 +456,18 @@ class ConfigUpdateService:
                 filter_keywords = config.get("filter_keywords", [])
                 self._generate_clash_config(nodes, clash_file, filter_keywords)
                 
+                # 两份配置在同一事务中写入数据库，再替换配置文件
+                self._publish_staged_outputs()
+                
+                # 预热订阅内容缓存并生成压缩版本，避免每次下载时重复压缩
+                with config_update_metrics.stage("cache_warmup"):
+                    output_digests = self._warm_subscription_cache()
+                
+                # 记录本次输入摘要，下次输入不变时可跳过生成
+                source_state['input_digest'] = input_digest
+                source_state['output_digests'] = output_digests
+                self._save_source_state(target_dir, source_state)
+                
                 self._add_log(f"🎉 配置更新完成！成功处理了 {len(nodes)} 个节点", "success")
                 self._update_last_update_time()
             else:
@@ -240,9 +476,14 @@ class ConfigUpdateService:
             self._add_log("配置更新任务完成", "success")
                 
         except Exception as e:
+            run_error = str(e)
             self._add_log(f"配置更新失败: {str(e)}", "error")
             logger.error(f"配置更新失败: {str(e)}", exc_info=True)
         finally:
+            # 生成失败时清理未发布的临时文件
+            self._discard_staged_outputs()
+            config_update_metrics.finish_run(run_error is None, run_error)
+            self._flush_logs()
             # 添加短暂延迟，确保前端能获取到运行状态
             import time
             time.sleep(1)
@@ -258,6 +499,8 @@ class ConfigUpdateService:
             return
         
         self.is_running_flag = True
+        config_update_metrics.start_run("test")
+        run_error = None
         self._add_log("开始执行测试任务", "info")
         
         # 在后台任务中创建新的数据库连接
@@ -280,10 +523,13 @@ class ConfigUpdateService:
             self._add_log("测试任务完成", "success")
                 
         except Exception as e:
+            run_error = str(e)
             self._add_log(f"测试失败: {str(e)}", "error")
             logger.error(f"测试失败: {str(e)}", exc_info=True)
         finally:
             self.is_running_flag = False
+            config_update_metrics.finish_run(run_error is None, run_error)
+            self._flush_logs()
             # 关闭数据库连接
             if db:
                 db.close()
@@ -296,8 +542,12 @@ class ConfigUpdateService:
         else:
             self._add_log("任务未在运行", "warning")
     
-    def _download_and_process_nodes(self, config: Dict[str, Any]) -> List[Dict[str, Any]]:
-        """下载和处理节点，返回带来源信息的节点列表"""
+    def _download_and_process_nodes(self, config: Dict[str, Any], source_state: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """下载和处理节点，返回带来源信息的节点列表
+        
+        传入source_state时使用其中的ETag/Last-Modified发起条件请求，内容未变化的节点源
+        直接使用缓存的节点链接，并将本次的校验信息写回source_state
+        """
         urls = config.get("urls", [])
         filter_keywords = config.get("filter_keywords", [])
         nodes = []
@@ -315,73 +565,30 @@ class ConfigUpdateService:
         else:
             self._add_log(f"🔍 过滤关键词: {', '.join(filter_keywords)}", "info")
         
-        for i, url in enumerate(urls, 1):
-            try:
-                self._add_log(f"📥 [{i}/{len(urls)}] 正在下载节点源: {url}", "info")
-                response = requests.get(url, timeout=30)
-                response.raise_for_status()
-                
-                content = response.text
-                content_size = len(content)
-                self._add_log(f"📊 下载完成，内容大小: {content_size} 字符", "info")
-                
-                # 检查是否是base64编码
-                if self._is_base64(content):
-                    try:
-                        content = base64.b64decode(content).decode('utf-8')
-                        self._add_log(f"🔓 Base64解码成功，解码后大小: {len(content)} 字符", "info")
-                    except:
-                        self._add_log(f"⚠️ Base64解码失败，使用原始内容", "warning")
-                
-                # 提取节点链接
-                node_links = self._extract_node_links(content)
-                self._add_log(f"🔗 从 {url} 提取到 {len(node_links)} 个节点链接", "info")
-                
-                # 显示节点类型统计
-                if node_links:
-                    type_count = {}
-                    for link in node_links:
-                        if link.startswith('ss://'):
-                            type_count['SS'] = type_count.get('SS', 0) + 1
-                        elif link.startswith('ssr://'):
-                            type_count['SSR'] = type_count.get('SSR', 0) + 1
-                        elif link.startswith('vmess://'):
-                            type_count['VMess'] = type_count.get('VMess', 0) + 1
-                        elif link.startswith('trojan://'):
-                            type_count['Trojan'] = type_count.get('Trojan', 0) + 1
-                        elif link.startswith('vless://'):
-                            type_count['VLESS'] = type_count.get('VLESS', 0) + 1
-                        elif link.startswith('hysteria2://') or link.startswith('hy2://'):
-                            type_count['Hysteria2'] = type_count.get('Hysteria2', 0) + 1
-                        elif link.startswith('tuic://'):
-                            type_count['TUIC'] = type_count.get('TUIC', 0) + 1
-                    
-                    if type_count:
-                        type_info = ', '.join([f"{k}: {v}" for k, v in type_count.items()])
-                        self._add_log(f"📈 节点类型统计: {type_info}", "info")
-                
-                # 过滤节点
-                if filter_keywords:
-                    filtered_links = self._filter_nodes(node_links, filter_keywords)
-                    filtered_count = len(node_links) - len(filtered_links)
-                    self._add_log(f"🔍 过滤掉 {filtered_count} 个节点，保留 {len(filtered_links)} 个节点", "info")
-                else:
-                    filtered_links = node_links
-                    self._add_log(f"✅ 未设置过滤条件，保留所有 {len(filtered_links)} 个节点", "info")
-                
-                # 为每个节点添加来源信息
-                for link in filtered_links:
-                    nodes.append({
-                        'url': link,
-                        'source_index': i - 1,  # 0-based index
-                        'source_url': url,
-                        'is_first_source': i == 1  # 标记是否是第一个源
-                    })
-                
-                self._add_log(f"✅ [{i}/{len(urls)}] 从 {url} 成功获取 {len(filtered_links)} 个有效节点", "success")
-                
-            except Exception as e:
-                self._add_log(f"❌ [{i}/{len(urls)}] 下载 {url} 失败: {str(e)}", "error")
+        # 所有节点源并发下载，按源顺序依次处理，保证节点顺序与串行下载一致
+        workers = min(MAX_DOWNLOAD_WORKERS, len(urls))
+        self._add_log(f"📥 开始并发下载 {len(urls)} 个节点源（并发数 {workers}）", "info")
+        
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        
+        previous_sources = source_state.get('sources', {}) if source_state is not None else {}
+        current_sources = {}
+        
+        with config_update_metrics.stage("download"), session, \
+                ThreadPoolExecutor(max_workers=workers, thread_name_prefix="node-source") as executor:
+            futures = [executor.submit(self._fetch_source, session, url, previous_sources.get(url)) for url in urls]
+            
+            for i, (url, future) in enumerate(zip(urls, futures), 1):
+                source = self._process_source_result(i, len(urls), url, future.result(), filter_keywords, nodes)
+                if source:
+                    current_sources[url] = source
+                config_update_metrics.set_progress("download", i, len(urls))
+        
+        if source_state is not None:
+            source_state['sources'] = current_sources
         
         # 不在这里进行全局去重，保持所有节点，在生成配置时分别处理
         total_count = len(nodes)
@@ -389,6 +596,130 @@ class ConfigUpdateService:
         
         return nodes
     
+    def _fetch_source(self, session: requests.Session, url: str, previous: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """下载单个节点源（在线程池中执行，不写日志、不访问数据库）
+        
+        有上次的校验信息时发起条件请求；304或内容哈希不变时标记unchanged
+        """
+        started_at = time.time()
+        result = {'stream': None, 'error': None, 'unchanged': False, 'previous': previous,
+                  'etag': None, 'last_modified': None, 'sha256': None}
+        
+        headers = {}
+        if previous and previous.get('links') is not None:
+            if previous.get('etag'):
+                headers['If-None-Match'] = previous['etag']
+            if previous.get('last_modified'):
+                headers['If-Modified-Since'] = previous['last_modified']
+        
+        try:
+            with session.get(url, timeout=DOWNLOAD_TIMEOUT, headers=headers, stream=True) as response:
+                if response.status_code == 304 and headers:
+                    result.update(unchanged=True, etag=previous.get('etag'),
+                                  last_modified=previous.get('last_modified'), sha256=previous.get('sha256'))
+                else:
+                    response.raise_for_status()
+                    result['etag'] = response.headers.get('ETag')
+                    result['last_modified'] = response.headers.get('Last-Modified')
+                    
+                    # 边下载边解码和提取节点链接，不保留完整响应内容
+                    stream = NodeLinkStream()
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        stream.feed(chunk)
+                    stream.close()
+                    
+                    result['sha256'] = stream.sha256
+                    if (previous and previous.get('sha256') and previous.get('links') is not None
+                            and result['sha256'] == previous['sha256']):
+                        # 服务端未返回304（或不提供ETag/Last-Modified），但内容未变化
+                        result['unchanged'] = True
+                    else:
+                        result['stream'] = stream
+        except Exception as e:
+            result['error'] = e
+        
+        result['elapsed'] = time.time() - started_at
+        return result
+    
+    def _process_source_result(self, i: int, total: int, url: str, result: Dict[str, Any],
+                               filter_keywords: List[str], nodes: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """解析单个节点源的下载结果，节点追加到nodes，返回该节点源的校验信息（失败时返回None）"""
+        try:
+            if result['error'] is not None:
+                raise result['error']
+            
+            stream = result['stream']
+            if result['unchanged']:
+                # 内容未变化，跳过解码和提取，直接使用上次提取的节点链接
+                node_links = result['previous']['links']
+                self._add_log(f"♻️ [{i}/{total}] {url} 内容未变化，使用缓存的 {len(node_links)} 个节点链接", "info")
+                config_update_metrics.add("download", unchanged_sources=1, links=len(node_links))
+            else:
+                node_links = self._extract_source_links(url, stream, i, total, result['elapsed'])
+                # 解码和提取在下载时流式完成，计入download阶段
+                config_update_metrics.add("download", bytes=stream.size, decoded_chars=stream.decoded_size,
+                                          links=len(node_links), decode_failures=int(stream.decode_error is not None))
+            
+            # 过滤节点
+            if filter_keywords:
+                with config_update_metrics.stage("filter"):
+                    filtered_links = self._filter_nodes(node_links, filter_keywords)
+                filtered_count = len(node_links) - len(filtered_links)
+                config_update_metrics.add("filter", removed=filtered_count)
+                self._add_log(f"🔍 过滤掉 {filtered_count} 个节点，保留 {len(filtered_links)} 个节点", "info")
+            else:
+                filtered_links = node_links
+                self._add_log(f"✅ 未设置过滤条件，保留所有 {len(filtered_links)} 个节点", "info")
+            
+            # 为每个节点添加来源信息
+            for link in filtered_links:
+                nodes.append({
+                    'url': link,
+                    'protocol': self._get_node_type(link),
+                    'source_index': i - 1,  # 0-based index
+                    'source_url': url,
+                    'is_first_source': i == 1  # 标记是否是第一个源
+                })
+            
+            self._add_log(f"✅ [{i}/{total}] 从 {url} 成功获取 {len(filtered_links)} 个有效节点", "success")
+            config_update_metrics.add_source(url=url, status="unchanged" if result['unchanged'] else "downloaded",
+                                             seconds=round(result['elapsed'], 3), bytes=stream.size if stream else 0,
+                                             links=len(node_links), nodes=len(filtered_links))
+            
+            return {
+                'etag': result['etag'],
+                'last_modified': result['last_modified'],
+                'sha256': result['sha256'],
+                'links': node_links
+            }
+            
+        except Exception as e:
+            self._add_log(f"❌ [{i}/{total}] 下载 {url} 失败: {str(e)}", "error")
+            config_update_metrics.add("download", failures=1)
+            config_update_metrics.add_source(url=url, status="failed", seconds=round(result.get('elapsed') or 0, 3),
+                                             error=str(e))
+            return None
+    
+    def _extract_source_links(self, url: str, stream: NodeLinkStream, i: int, total: int, elapsed: float) -> List[str]:
+        """记录节点源的解码和提取结果，返回提取到的节点链接"""
+        self._add_log(f"📊 [{i}/{total}] {url} 下载完成，耗时 {elapsed:.2f} 秒，内容大小: {stream.size} 字节", "info")
+        
+        if stream.is_base64:
+            if stream.decode_error is None:
+                self._add_log(f"🔓 Base64解码成功，解码后大小: {stream.decoded_size} 字符", "info")
+            else:
+                self._add_log(f"⚠️ Base64解码失败: {stream.decode_error}，剩余内容按原始文本提取节点链接", "warning")
+        
+        node_links = stream.links
+        self._add_log(f"🔗 从 {url} 提取到 {len(node_links)} 个节点链接", "info")
+        
+        # 显示节点类型统计
+        if stream.type_count:
+            type_info = ', '.join([f"{k}: {v}" for k, v in stream.type_count.items()])
+            self._add_log(f"📈 节点类型统计: {type_info}", "info")
+        
+        return node_links
+    
     def _is_base64(self, text: str) -> bool:
         """检查文本是否是base64编码"""
         try:
@@ -409,26 +740,8 @@ class ConfigUpdateService:
                 return False
     
     def _extract_node_links(self, content: str) -> List[str]:
-        """提取节点链接"""
-        import re
-        # 使用更精确的正则表达式，避免误匹配
-        patterns = [
-            r'vmess://[A-Za-z0-9+/=]+',
-            r'vless://[A-Za-z0-9+/=@:?#.-]+',  # 添加点号支持域名
-            r'ss://[A-Za-z0-9+/=@:?#.-]+',  # 添加点号支持域名
-            r'ssr://[A-Za-z0-9+/=]+',
-            r'trojan://[A-Za-z0-9-]+@[^:\s]+:\d+(?:[?&][^#\s]*)?(?:#[^\s]*)?',  # 精确匹配Trojan格式
-            r'hysteria2://[A-Za-z0-9+/=@:?#.-]+',  # 添加点号支持域名
-            r'hy2://[A-Za-z0-9+/=@:?#.-]+',  # 添加点号支持域名
-            r'tuic://[A-Za-z0-9+/=@:?#.-]+'  # 添加点号支持域名
-        ]
-        
-        links = []
-        for pattern in patterns:
-            matches = re.findall(pattern, content)
-            links.extend(matches)
-        
-        return links
+        """提取节点链接（按文档顺序）"""
+        return [link for _, link in scan_node_links(content)]
     
     def _filter_nodes(self, nodes: List[str], keywords: List[str]) -> List[str]:
         """过滤节点"""
@@ -455,24 +768,24 @@ class ConfigUpdateService:
             ordered_nodes = first_source_nodes + other_source_nodes
             
             # 将节点链接合并并base64编码
-            node_urls = [node['url'] for node in ordered_nodes]
-            content = '\n'.join(node_urls)
-            content_size = len(content)
-            self._add_log(f"📊 节点内容大小: {content_size} 字符", "info")
-            
-            encoded_content = base64.b64encode(content.encode('utf-8')).decode('utf-8')
-            encoded_size = len(encoded_content)
-            self._add_log(f"🔐 Base64编码完成，编码后大小: {encoded_size} 字符", "info")
+            with config_update_metrics.stage("render_v2ray"):
+                node_urls = [node['url'] for node in ordered_nodes]
+                content = '\n'.join(node_urls)
+                content_size = len(content)
+                self._add_log(f"📊 节点内容大小: {content_size} 字符", "info")
+                
+                encoded_content = base64.b64encode(content.encode('utf-8')).decode('utf-8')
+                encoded_size = len(encoded_content)
+                self._add_log(f"🔐 Base64编码完成，编码后大小: {encoded_size} 字符", "info")
+            config_update_metrics.add("render_v2ray", nodes=len(node_urls), bytes=encoded_size)
             
-            # 保存到文件
-            with open(output_file, 'w', encoding='utf-8') as f:
+            # 先写入临时文件，发布时再替换正式文件
+            temp_file = f"{output_file}.tmp"
+            with config_update_metrics.stage("write_file"), open(temp_file, 'w', encoding='utf-8') as f:
                 f.write(encoded_content)
-            
-            file_size = os.path.getsize(output_file)
-            self._add_log(f"💾 V2Ray配置文件已保存: {output_file} (大小: {file_size} 字节)", "info")
-            
-            # 保存到数据库
-            self._save_v2ray_config_to_db(encoded_content)
+                f.flush()
+                os.fsync(f.fileno())
+            self._stage_output('v2ray_config', encoded_content, temp_file, output_file)
             
             self._add_log(f"✅ V2Ray配置生成完成！文件: {output_file}", "success")
         except Exception as e:
@@ -511,30 +824,17 @@ class ConfigUpdateService:
             first_source_proxy_names = []
             first_source_name_count = {}  # 用于跟踪第一个源的节点名称计数
             
-            for i, node_info in enumerate(first_source_nodes, 1):
+            # 第一个源的节点不进行重命名，但需要解析以生成正确的Clash配置
+            # 使用不重命名的解析方法，保持原始名称
+            cache_dir = os.path.dirname(output_file)
+            first_source_results = self._parse_nodes([node['url'] for node in first_source_nodes], rename=False, cache_dir=cache_dir)
+            
+            for i, (node_info, (proxy, error)) in enumerate(zip(first_source_nodes, first_source_results), 1):
                 try:
-                    node_url = node_info['url']
-                    # 记录节点类型
-                    if node_url.startswith('ss://'):
-                        node_type = 'SS'
-                    elif node_url.startswith('ssr://'):
-                        node_type = 'SSR'
-                    elif node_url.startswith('vmess://'):
-                        node_type = 'VMess'
-                    elif node_url.startswith('trojan://'):
-                        node_type = 'Trojan'
-                    elif node_url.startswith('vless://'):
-                        node_type = 'VLESS'
-                    elif node_url.startswith('hysteria2://') or node_url.startswith('hy2://'):
-                        node_type = 'Hysteria2'
-                    elif node_url.startswith('tuic://'):
-                        node_type = 'TUIC'
-                    else:
-                        node_type = 'Unknown'
+                    if error:
+                        raise Exception(error)
+                    node_type = node_info.get('protocol') or self._get_node_type(node_info['url'])
                     
-                    # 第一个源的节点不进行重命名，但需要解析以生成正确的Clash配置
-                    # 使用不重命名的解析方法，保持原始名称
-                    proxy = self._parse_node_without_rename(node_url)
                     if proxy:
                         # 确保第一个源的节点名称唯一
                         original_name = proxy['name']
@@ -561,6 +861,7 @@ class ConfigUpdateService:
                     # 每100个节点记录一次进度
                     if i % 100 == 0:
                         self._add_log(f"📊 已处理第一个源 {i}/{len(first_source_nodes)} 个节点", "info")
+                        config_update_metrics.set_progress("process_first_source", i, len(first_source_nodes))
                         
                 except Exception as e:
                     failed_count += 1
@@ -575,6 +876,7 @@ class ConfigUpdateService:
             # 再处理其他源的节点（只在这些源之间进行去重和重命名，不与第一个源对比）
             if other_source_nodes:
                 # 在其他源节点之间进行去重（根据节点类型使用不同的去重策略）
+                dedup_started = time.monotonic()
                 other_source_urls = set()
                 unique_other_nodes = []
                 for node_info in other_source_nodes:
@@ -595,35 +897,26 @@ class ConfigUpdateService:
                         other_source_urls.add(dedup_key)
                         unique_other_nodes.append(node_info)
                 
+                config_update_metrics.add_time("dedup", time.monotonic() - dedup_started)
+                config_update_metrics.add("dedup", nodes=len(other_source_nodes),
+                                          removed=len(other_source_nodes) - len(unique_other_nodes))
+                
                 if len(unique_other_nodes) != len(other_source_nodes):
                     duplicate_count = len(other_source_nodes) - len(unique_other_nodes)
                     self._add_log(f"🔄 其他源节点去重: 原始 {len(other_source_nodes)} 个，去重后 {len(unique_other_nodes)} 个，移除 {duplicate_count} 个重复节点", "info")
                 
-                # 解析其他源的节点
-                for i, node_info in enumerate(unique_other_nodes, 1):
+                # 解析其他源的节点（解析可并行，名称去重需按原顺序在此依次进行）
+                other_source_results = self._parse_nodes([node['url'] for node in unique_other_nodes], rename=True, filter_keywords=filter_keywords, cache_dir=cache_dir)
+                
+                for i, (node_info, (proxy, error)) in enumerate(zip(unique_other_nodes, other_source_results), 1):
                     try:
-                        node_url = node_info['url']
-                        # 记录节点类型
-                        if node_url.startswith('ss://'):
-                            node_type = 'SS'
-                        elif node_url.startswith('ssr://'):
-                            node_type = 'SSR'
-                        elif node_url.startswith('vmess://'):
-                            node_type = 'VMess'
-                        elif node_url.startswith('trojan://'):
-                            node_type = 'Trojan'
-                        elif node_url.startswith('vless://'):
-                            node_type = 'VLESS'
-                        elif node_url.startswith('hysteria2://') or node_url.startswith('hy2://'):
-                            node_type = 'Hysteria2'
-                        elif node_url.startswith('tuic://'):
-                            node_type = 'TUIC'
-                        else:
-                            node_type = 'Unknown'
+                        if error:
+                            raise Exception(error)
+                        node_type = node_info.get('protocol') or self._get_node_type(node_info['url'])
                         
                         # 其他源的节点进行重命名和去重
-                        proxy = self._parse_node_legacy(node_url, name_count, filter_keywords)
                         if proxy:
+                            proxy['name'] = ensure_unique_name(proxy['name'], name_count)
                             proxies.append(proxy)
                             proxy_names.append(proxy['name'])
                             node_type_count[node_type] = node_type_count.get(node_type, 0) + 1
@@ -631,6 +924,7 @@ class ConfigUpdateService:
                             # 每100个节点记录一次进度
                             if i % 100 == 0:
                                 self._add_log(f"📊 已解析其他源 {i}/{len(unique_other_nodes)} 个节点", "info")
+                                config_update_metrics.set_progress("process_other_sources", i, len(unique_other_nodes))
                         else:
                             failed_count += 1
                             if failed_count <= 5:  # 只记录前5个失败案例
@@ -648,6 +942,7 @@ class ConfigUpdateService:
                 self._add_log(f"📈 成功解析节点类型统计: {type_info}", "info")
             
             self._add_log(f"📊 解析完成: 成功 {len(proxies)} 个节点，失败 {failed_count} 个", "info")
+            config_update_metrics.add("parse", succeeded=len(proxies), failures=failed_count)
             
             if not proxies:
                 self._add_log("❌ 没有有效的节点可以生成Clash配置", "error")
@@ -655,31 +950,21 @@ class ConfigUpdateService:
             
             self._add_log(f"🔧 开始生成Clash配置文件，使用 {len(proxies)} 个有效节点", "info")
             
-            # 使用老代码的模板生成完整的Clash配置
-            clash_config_content = self._generate_clash_with_legacy_template(proxies, proxy_names)
+            # 使用老代码的模板生成完整的Clash配置，边生成边写入临时文件，同时保留一份用于保存到数据库
+            temp_file = f"{output_file}.tmp"
+            # 渲染与写入临时文件同时进行，统一计入render_clash阶段
+            with config_update_metrics.stage("render_clash"), open(temp_file, 'w', encoding='utf-8') as f:
+                writer = ClashConfigWriter(f)
+                self._write_clash_with_legacy_template(proxies, proxy_names, writer)
+                f.flush()
+                os.fsync(f.fileno())
+            clash_config_content = writer.getvalue()
             
             config_size = len(clash_config_content)
+            config_update_metrics.add("render_clash", nodes=len(proxies), bytes=config_size)
             self._add_log(f"📊 Clash配置内容大小: {config_size} 字符", "info")
             
-            # 保存到文件
-            with open(output_file, 'w', encoding='utf-8') as f:
-                f.write(clash_config_content)
-            
-            file_size = os.path.getsize(output_file)
-            self._add_log(f"💾 Clash配置文件已保存: {output_file} (大小: {file_size} 字节)", "info")
-            
-            # 保存到数据库
-            self._save_clash_config_to_db(clash_config_content)
-            
-            # 清除节点服务缓存，确保下次获取节点时使用最新配置
-            try:
-                from app.services.node_service import NodeService
-                node_service = NodeService(self.db)
-                node_service.clear_cache()
-                node_service.close()
-                self._add_log(f"🔄 节点服务缓存已清除", "info")
-            except Exception as e:
-                self._add_log(f"⚠️ 清除节点缓存失败: {str(e)}", "warning")
+            self._stage_output('clash_config', clash_config_content, temp_file, output_file)
             
             self._add_log(f"✅ Clash配置生成完成！文件: {output_file}，共 {len(proxies)} 个节点", "success")
         except Exception as e:
@@ -1412,21 +1697,13 @@ class ConfigUpdateService:
         return yaml.dump(config, allow_unicode=True, default_flow_style=False, sort_keys=False)
     
     
-    def get_logs(self, limit: int = 100) -> List[Dict[str, Any]]:
-        """获取日志"""
+    def get_logs(self, limit: int = 100, since_id: Optional[int] = None) -> List[Dict[str, Any]]:
+        """获取日志，指定since_id时只返回该id之后的日志（供管理后台增量轮询）"""
         try:
-            # 优先从内存中获取日志（实时性更好）
-            if self.logs:
-                return self.logs[-limit:] if len(self.logs) > limit else self.logs
-            
-            # 如果内存中没有日志，从数据库获取
             if self.db is not None:
-                logs_record = self.db.query(SystemConfig).filter(SystemConfig.key == "config_update_logs").first()
-                if logs_record:
-                    logs_data = json.loads(logs_record.value)
-                    return logs_data[-limit:] if logs_data else []
+                return config_update_log_buffer.get_logs(limit=limit, since_id=since_id)
             
-            return []
+            return self.logs[-limit:] if len(self.logs) > limit else self.logs
         except Exception as e:
             logger.error(f"获取日志失败: {str(e)}")
             # 如果出错，至少返回内存中的日志
@@ -1434,8 +1711,9 @@ class ConfigUpdateService:
     
     def _add_log(self, message: str, level: str = "info"):
         """添加日志"""
+        now = datetime.now()
         log_entry = {
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": now.isoformat(),
             "level": level,
             "message": message
         }
@@ -1445,47 +1723,24 @@ class ConfigUpdateService:
         if len(self.logs) > self.max_logs:
             self.logs = self.logs[-self.max_logs:]
         
+        # 检查数据库连接是否有效
+        if self.db is None:
+            return
+        
+        # 写入日志缓冲，批量插入数据库（使用独立的数据库会话，不影响当前事务）
         try:
-            # 检查数据库连接是否有效
-            if self.db is None:
-                logger.warning("数据库连接无效，仅保存到内存")
-                return
-                
-            # 从数据库获取现有日志
-            logs_record = self.db.query(SystemConfig).filter(SystemConfig.key == "config_update_logs").first()
-            if logs_record:
-                logs_data = json.loads(logs_record.value)
-            else:
-                logs_data = []
-            
-            # 添加新日志
-            logs_data.append(log_entry)
-            
-            # 限制日志数量
-            if len(logs_data) > self.max_logs:
-                logs_data = logs_data[-self.max_logs:]
-            
-            # 保存到数据库
-            if logs_record:
-                logs_record.value = json.dumps(logs_data)
-            else:
-                logs_record = SystemConfig(
-                    key="config_update_logs",
-                    value=json.dumps(logs_data),
-                    type="json",
-                    category="general",
-                    display_name="配置更新日志",
-                    description="配置更新操作日志"
-                )
-                self.db.add(logs_record)
-            
-            self.db.commit()
-            logger.info(f"日志已保存到数据库: {message}")
-                
+            config_update_log_buffer.append(level, message, now)
         except Exception as e:
             logger.error(f"保存日志到数据库失败: {str(e)}")
             # 如果数据库保存失败，至少已经保存到内存中了
     
+    def _flush_logs(self):
+        """将缓冲中的日志立即写入数据库"""
+        try:
+            config_update_log_buffer.flush()
+        except Exception as e:
+            logger.error(f"写入日志失败: {str(e)}")
+    
     def get_config(self) -> Dict[str, Any]:
         """获取配置"""
         try:
@@ -1769,91 +2024,310 @@ class ConfigUpdateService:
             self._add_log(f"定时更新失败: {str(e)}", "error")
             logger.error(f"定时更新失败: {str(e)}", exc_info=True)
     
-    def _save_clash_config_to_db(self, config_content: str):
-        """保存clash配置到数据库（只覆盖有效配置）"""
+    def _stage_output(self, key: str, content: str, temp_file: str, output_file: str):
+        """登记已生成的配置，等待统一发布"""
+        self._staged_outputs[key] = {
+            'content': content,
+            'temp_file': temp_file,
+            'output_file': output_file
+        }
+    
+    def _discard_staged_outputs(self):
+        """丢弃未发布的配置及其临时文件"""
+        staged, self._staged_outputs = self._staged_outputs, {}
+        for item in staged.values():
+            try:
+                os.remove(item['temp_file'])
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                self._add_log(f"⚠️ 删除临时文件失败: {item['temp_file']}: {str(e)}", "warning")
+    
+    def _publish_staged_outputs(self):
+        """发布已生成的配置
+        
+        所有配置行和配置版本号在同一事务中更新，读取方只会看到完整的旧版本或新版本；
+        数据库提交后再用os.replace原子替换配置文件
+        """
+        if not self._staged_outputs:
+            return
+        
         try:
-            from sqlalchemy import text
-            from datetime import datetime
-            
-            current_time = datetime.now()
-            
-            # 检查是否存在有效配置（不是失效配置）
-            check_query = text('SELECT id FROM system_configs WHERE key = \'clash_config\' AND type = \'clash\'')
-            existing = self.db.execute(check_query).first()
-            
-            if existing:
-                # 更新现有有效配置
-                update_query = text("""
-                    UPDATE system_configs 
-                    SET value = :value, updated_at = :updated_at
-                    WHERE key = 'clash_config' AND type = 'clash'
-                """)
-                self.db.execute(update_query, {
-                    "value": config_content,
-                    "updated_at": current_time
-                })
-                self._add_log("Clash有效配置已更新", "success")
-            else:
-                # 插入新的有效配置
-                insert_query = text("""
-                    INSERT INTO system_configs ("key", value, type, category, display_name, description, is_public, sort_order, created_at, updated_at)
-                    VALUES ('clash_config', :value, 'clash', 'proxy', 'Clash有效配置', 'Clash代理有效配置文件', 0, 1, :created_at, :updated_at)
-                """)
-                self.db.execute(insert_query, {
-                    "value": config_content,
-                    "created_at": current_time,
-                    "updated_at": current_time
-                })
-                self._add_log("Clash有效配置已创建", "success")
-            
-            self.db.commit()
+            with config_update_metrics.stage("write_db"):
+                current_time = datetime.now()
+                for key, item in self._staged_outputs.items():
+                    self._upsert_published_config(key, item['content'], current_time)
+                version = bump_config_version(self.db, current_time)
+                self.db.commit()
         except Exception as e:
             self.db.rollback()
-            self._add_log(f"保存Clash有效配置到数据库失败: {str(e)}", "error")
+            self._discard_staged_outputs()
+            self._add_log(f"保存配置到数据库失败: {str(e)}", "error")
             raise
+        
+        staged, self._staged_outputs = self._staged_outputs, {}
+        subscription_config_cache.invalidate()
+        self._add_log(f"📦 配置已发布，版本: {version}", "success")
+        
+        with config_update_metrics.stage("write_file"):
+            for item in staged.values():
+                os.replace(item['temp_file'], item['output_file'])
+                file_size = os.path.getsize(item['output_file'])
+                config_update_metrics.add("write_file", bytes=file_size)
+                self._add_log(f"💾 配置文件已保存: {item['output_file']} (大小: {file_size} 字节)", "info")
+        
+        # 清除节点服务缓存，确保下次获取节点时使用最新配置
+        with config_update_metrics.stage("cache_invalidation"):
+            try:
+                from app.services.node_service import NodeService
+                node_service = NodeService(self.db)
+                node_service.clear_cache()
+                node_service.close()
+                self._add_log(f"🔄 节点服务缓存已清除", "info")
+            except Exception as e:
+                config_update_metrics.add("cache_invalidation", failures=1)
+                self._add_log(f"⚠️ 清除节点缓存失败: {str(e)}", "warning")
+    
+    def _upsert_published_config(self, key: str, config_content: str, current_time: datetime):
+        """写入有效配置行（只覆盖有效配置，不提交）"""
+        from sqlalchemy import text
+        
+        config_type, display_name, description, sort_order = PUBLISHED_CONFIG_ROWS[key]
+        
+        # 更新现有有效配置（不是失效配置）
+        update_query = text("""
+            UPDATE system_configs 
+            SET value = :value, updated_at = :updated_at
+            WHERE key = :key AND type = :type
+        """)
+        result = self.db.execute(update_query, {
+            "key": key,
+            "type": config_type,
+            "value": config_content,
+            "updated_at": current_time
+        })
+        
+        if result.rowcount == 0:
+            # 插入新的有效配置
+            insert_query = text("""
+                INSERT INTO system_configs ("key", value, type, category, display_name, description, is_public, sort_order, created_at, updated_at)
+                VALUES (:key, :value, :type, 'proxy', :display_name, :description, 0, :sort_order, :created_at, :updated_at)
+            """)
+            self.db.execute(insert_query, {
+                "key": key,
+                "type": config_type,
+                "value": config_content,
+                "display_name": display_name,
+                "description": description,
+                "sort_order": sort_order,
+                "created_at": current_time,
+                "updated_at": current_time
+            })
+            self._add_log(f"{display_name}已创建", "success")
+        else:
+            self._add_log(f"{display_name}已更新", "success")
     
-    def _save_v2ray_config_to_db(self, config_content: str):
-        """保存v2ray配置到数据库（只覆盖有效配置）"""
+    def _warm_subscription_cache(self) -> Optional[Dict[str, str]]:
+        """重新加载订阅内容缓存并预先压缩，返回当前配置内容的哈希"""
         try:
-            from sqlalchemy import text
-            from datetime import datetime
-            
-            current_time = datetime.now()
-            
-            # 检查是否存在有效配置（不是失效配置）
-            check_query = text('SELECT id FROM system_configs WHERE key = \'v2ray_config\' AND type = \'v2ray\'')
-            existing = self.db.execute(check_query).first()
-            
-            if existing:
-                # 更新现有有效配置
-                update_query = text("""
-                    UPDATE system_configs 
-                    SET value = :value, updated_at = :updated_at
-                    WHERE key = 'v2ray_config' AND type = 'v2ray'
-                """)
-                self.db.execute(update_query, {
-                    "value": config_content,
-                    "updated_at": current_time
-                })
-                self._add_log("V2Ray有效配置已更新", "success")
-            else:
-                # 插入新的有效配置
-                insert_query = text("""
-                    INSERT INTO system_configs ("key", value, type, category, display_name, description, is_public, sort_order, created_at, updated_at)
-                    VALUES ('v2ray_config', :value, 'v2ray', 'proxy', 'V2Ray有效配置', 'V2Ray代理有效配置文件', 0, 2, :created_at, :updated_at)
-                """)
-                self.db.execute(insert_query, {
-                    "value": config_content,
-                    "created_at": current_time,
-                    "updated_at": current_time
-                })
-                self._add_log("V2Ray有效配置已创建", "success")
+            output_digests = self._get_output_digests()
+            self._add_log("🗜️ 订阅内容缓存已预热，压缩版本已生成", "info")
+            return output_digests
+        except Exception as e:
+            self._add_log(f"⚠️ 预热订阅内容缓存失败: {str(e)}", "warning")
+            return None
+    
+    def _get_output_digests(self) -> Dict[str, str]:
+        """读取数据库中当前的订阅配置（经缓存），返回内容哈希"""
+        from app.services.subscription import SubscriptionService
+        subscription_service = SubscriptionService(self.db)
+        clash_entry = subscription_service.get_clash_config_entry()
+        v2ray_entry = subscription_service.get_v2ray_config_entry()
+        precompress_entry(clash_entry)
+        precompress_entry(v2ray_entry)
+        return {'clash': clash_entry['etag'], 'v2ray': v2ray_entry['etag']}
+    
+    def _load_source_state(self, target_dir: str) -> Dict[str, Any]:
+        """读取上次更新保存的节点源校验信息"""
+        state_file = os.path.join(target_dir, SOURCE_STATE_FILE)
+        try:
+            with open(state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if isinstance(state, dict) and isinstance(state.get('sources'), dict):
+                return state
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self._add_log(f"⚠️ 读取节点源校验信息失败，将重新下载所有节点源: {str(e)}", "warning")
+        return {'sources': {}}
+    
+    def _save_source_state(self, target_dir: str, state: Dict[str, Any]):
+        """保存节点源校验信息（先写临时文件再替换）"""
+        state_file = os.path.join(target_dir, SOURCE_STATE_FILE)
+        temp_file = f"{state_file}.tmp"
+        try:
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+            os.replace(temp_file, state_file)
+        except Exception as e:
+            self._add_log(f"⚠️ 保存节点源校验信息失败: {str(e)}", "warning")
+    
+    def _compute_input_digest(self, config: Dict[str, Any], source_state: Dict[str, Any]) -> str:
+        """根据生成相关的配置和各节点源内容哈希计算输入摘要"""
+        digest = hashlib.sha256()
+        digest.update(json.dumps({
+            'generator_version': GENERATOR_VERSION,
+            'urls': config.get('urls', []),
+            'filter_keywords': config.get('filter_keywords', []),
+            'target_dir': config.get('target_dir', './uploads/config'),
+            'v2ray_file': config.get('v2ray_file', 'xr'),
+            'clash_file': config.get('clash_file', 'clash.yaml')
+        }, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+        
+        sources = source_state.get('sources', {})
+        for url in config.get('urls', []):
+            # 下载失败的节点源没有哈希，其节点不会进入本次配置
+            source = sources.get(url) or {}
+            digest.update(f"\n{url}\n{source.get('sha256') or 'failed'}".encode('utf-8'))
+        return digest.hexdigest()
+    
+    def _is_output_current(self, source_state: Dict[str, Any], input_digest: str, config: Dict[str, Any]) -> bool:
+        """检查上次生成的配置是否仍与当前输入一致"""
+        if source_state.get('input_digest') != input_digest or not source_state.get('output_digests'):
+            return False
+        
+        target_dir = config.get("target_dir", "./uploads/config")
+        v2ray_file = os.path.join(target_dir, config.get("v2ray_file", "xr"))
+        clash_file = os.path.join(target_dir, config.get("clash_file", "clash.yaml"))
+        if not (os.path.exists(v2ray_file) and os.path.exists(clash_file)):
+            return False
+        
+        # 数据库中的配置被手动修改过时仍需重新生成
+        try:
+            return self._get_output_digests() == source_state['output_digests']
+        except Exception:
+            return False
+    
+    def _get_node_type(self, node_url: str) -> str:
+        """根据节点URL前缀获取节点类型，用于统计"""
+        return NODE_TYPE_BY_SCHEME.get(node_url.split('://', 1)[0], 'Unknown')
+    
+    def _parse_nodes(self, node_urls: List[str], rename: bool, filter_keywords: List[str] = None, cache_dir: str = None) -> List[Tuple[Optional[Dict[str, Any]], Optional[str]]]:
+        """批量解析节点，返回与node_urls一一对应的(proxy, error)列表
+        
+        rename为True时按老代码逻辑清理并重命名，但不做跨节点的名称去重，由调用方按顺序处理；
+        指定cache_dir时优先使用磁盘上的解析结果缓存，只解析新出现的节点链接；
+        待解析节点数量较多时使用多进程并行解析
+        """
+        with config_update_metrics.stage("parse"):
+            return self._parse_nodes_cached(node_urls, rename, filter_keywords, cache_dir)
+    
+    def _parse_nodes_cached(self, node_urls: List[str], rename: bool, filter_keywords: List[str] = None, cache_dir: str = None) -> List[Tuple[Optional[Dict[str, Any]], Optional[str]]]:
+        """_parse_nodes的实现：先查解析缓存，再解析未命中的节点"""
+        parse_cache = self._open_parse_cache(cache_dir) if cache_dir is not None else None
+        try:
+            cached = {}
+            keys = []
+            if parse_cache is not None:
+                mode = "legacy" if rename else "raw"
+                fingerprint = json.dumps([GENERATOR_VERSION, filter_keywords or []] if rename else [GENERATOR_VERSION], ensure_ascii=False)
+                keys = [NodeParseCache.make_key(node_url, mode, fingerprint) for node_url in node_urls]
+                try:
+                    cached = parse_cache.get_many(keys)
+                except Exception as e:
+                    self._add_log(f"⚠️ 读取节点解析缓存失败: {str(e)}", "warning")
             
-            self.db.commit()
+            # 只解析缓存中没有的节点，相同链接只解析一次
+            pending_urls = []
+            pending_index = {}
+            for i, node_url in enumerate(node_urls):
+                if keys and keys[i] in cached:
+                    continue
+                if node_url not in pending_index:
+                    pending_index[node_url] = len(pending_urls)
+                    pending_urls.append(node_url)
+            
+            config_update_metrics.add("parse", cache_hits=len(node_urls) - len(pending_urls) if keys else 0,
+                                      parsed=len(pending_urls))
+            
+            parsed = None
+            if len(pending_urls) >= PARALLEL_PARSE_MIN_NODES:
+                parsed = self._parse_nodes_parallel(pending_urls, rename, filter_keywords)
+            if parsed is None:
+                parsed = [self._parse_node_isolated(node_url, rename, filter_keywords) for node_url in pending_urls]
+            
+            # 调用方会修改返回的节点（重命名），重复的链接需要各自独立的副本
+            results = []
+            used = set()
+            for i, node_url in enumerate(node_urls):
+                if keys and keys[i] in cached:
+                    proxy, error = cached[keys[i]], None
+                else:
+                    proxy, error = parsed[pending_index[node_url]]
+                if node_url in used and proxy is not None:
+                    proxy = copy.deepcopy(proxy)
+                used.add(node_url)
+                results.append((proxy, error))
+            
+            if parse_cache is not None:
+                # 解析出错的节点不缓存，下次重新解析
+                new_items = [(keys[i], proxy) for i, (proxy, error) in enumerate(results)
+                             if error is None and node_urls[i] in pending_index]
+                try:
+                    parse_cache.set_many(new_items)
+                    stats = parse_cache.stats()
+                    self._add_log(f"🗃️ 节点解析缓存命中 {stats['hits']} 个，新解析 {len(pending_urls)} 个", "info")
+                except Exception as e:
+                    self._add_log(f"⚠️ 写入节点解析缓存失败: {str(e)}", "warning")
+            
+            return results
+        finally:
+            if parse_cache is not None:
+                parse_cache.close()
+    
+    def _open_parse_cache(self, cache_dir: str) -> Optional[NodeParseCache]:
+        """打开节点解析结果缓存，失败时返回None（不使用缓存）"""
+        try:
+            os.makedirs(cache_dir or ".", exist_ok=True)
+            return NodeParseCache(os.path.join(cache_dir, NODE_PARSE_CACHE_FILE), NODE_PARSE_CACHE_MAX_ENTRIES)
         except Exception as e:
-            self.db.rollback()
-            self._add_log(f"保存V2Ray有效配置到数据库失败: {str(e)}", "error")
-            raise
+            self._add_log(f"⚠️ 打开节点解析缓存失败，本次不使用缓存: {str(e)}", "warning")
+            return None
+    
+    def _parse_node_isolated(self, node_url: str, rename: bool, filter_keywords: List[str] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+        """解析单个节点，使用独立的名称计数，返回(proxy, error)"""
+        try:
+            if rename:
+                return self._parse_node_legacy(node_url, {}, filter_keywords), None
+            return self._parse_node_without_rename(node_url), None
+        except Exception as e:
+            return None, str(e)
+    
+    def _parse_nodes_parallel(self, node_urls: List[str], rename: bool, filter_keywords: List[str] = None) -> Optional[List[Tuple[Optional[Dict[str, Any]], Optional[str]]]]:
+        """使用进程池并行解析节点，进程池不可用时返回None"""
+        workers = min(MAX_PARSE_WORKERS, os.cpu_count() or 1)
+        if workers < 2:
+            return None
+        
+        chunks = [node_urls[i:i + PARSE_CHUNK_SIZE] for i in range(0, len(node_urls), PARSE_CHUNK_SIZE)]
+        self._add_log(f"⚡ 使用 {workers} 个进程并行解析 {len(node_urls)} 个节点", "info")
+        
+        try:
+            # 更新任务运行在后台线程中，fork带线程的进程不安全，使用spawn启动子进程
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                chunk_results = list(executor.map(_parse_nodes_chunk, chunks, repeat(rename), repeat(filter_keywords)))
+        except Exception as e:
+            self._add_log(f"⚠️ 多进程解析失败，改为单进程解析: {str(e)}", "warning")
+            return None
+        
+        results = []
+        for chunk_result in chunk_results:
+            for proxy, error, logs in chunk_result:
+                # 子进程中的解析日志在主进程中按顺序补记
+                for log in logs:
+                    self._add_log(log['message'], log['level'])
+                results.append((proxy, error))
+        return results
     
     def _parse_node_legacy(self, node_url: str, name_count: dict, filter_keywords: List[str] = None) -> Optional[Dict[str, Any]]:
         """按照老代码逻辑解析节点"""
@@ -3089,8 +3563,8 @@ class ConfigUpdateService:
             self._add_log(f"解析TUIC节点失败: {str(e)}", "warning")
             return None
     
-    def _generate_clash_with_legacy_template(self, proxies: List[Dict[str, Any]], proxy_names: List[str]) -> str:
-        """使用老代码的模板生成Clash配置"""
+    def _write_clash_with_legacy_template(self, proxies: List[Dict[str, Any]], proxy_names: List[str], writer: "ClashConfigWriter"):
+        """使用老代码的模板生成Clash配置，按顺序写入writer"""
         try:
             # 读取模板文件
             script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -3100,67 +3574,117 @@ class ConfigUpdateService:
             # 检查模板文件是否存在
             if not os.path.exists(head_file):
                 self._add_log(f"⚠️ 模板文件不存在: {head_file}", "warning")
-                return self._create_basic_clash_config_fallback(proxies, proxy_names)
+                writer.write(self._create_basic_clash_config_fallback(proxies, proxy_names))
+                return
             if not os.path.exists(tail_file):
                 self._add_log(f"⚠️ 模板文件不存在: {tail_file}", "warning")
-                return self._create_basic_clash_config_fallback(proxies, proxy_names)
+                writer.write(self._create_basic_clash_config_fallback(proxies, proxy_names))
+                return
             
             with open(head_file, encoding='utf-8') as f:
                 head = f.read().rstrip() + '\n'
             with open(tail_file, encoding='utf-8') as f:
                 tail = f.read().lstrip()
             
-            # 生成proxies部分的YAML
-            proxies_yaml = yaml.dump({'proxies': proxies}, allow_unicode=True, sort_keys=False, indent=2)
+            writer.write(head)
+            writer.write('\nproxies:\n')
             
-            # 处理tail部分，替换代理名称列表
-            tail_lines = tail.split('\n')
-            formatted_tail_lines = []
-            i = 0
-            while i < len(tail_lines):
-                line = tail_lines[i]
-                if line.strip():
-                    if line.startswith('  - name:') or line.startswith('- name:'):
-                        # 处理代理组
-                        if line.startswith('- name:'):
-                            formatted_tail_lines.append('  ' + line)
-                        else:
-                            formatted_tail_lines.append(line)
-                        
-                        # 查找proxies字段并替换
-                        j = i + 1
-                        while j < len(tail_lines):
-                            next_line = tail_lines[j]
-                            if 'proxies:' in next_line:
-                                formatted_tail_lines.append(next_line)
-                                
-                                # 跳过原有的代理列表
-                                k = j + 1
-                                while k < len(tail_lines) and (tail_lines[k].startswith('      -') or not tail_lines[k].strip()):
-                                    k += 1
-                                
-                                # 添加新的代理名称列表
-                                for proxy_name in proxy_names:
-                                    formatted_tail_lines.append(f'      - {proxy_name}')
-                                
-                                i = k - 1
-                                break
-                            else:
-                                formatted_tail_lines.append(next_line)
-                                j += 1
-                        if j >= len(tail_lines):
-                            i = len(tail_lines)
-                    else:
-                        formatted_tail_lines.append(line)
-                else:
-                    formatted_tail_lines.append(line)
-                i += 1
+            # 分批序列化proxies部分，不生成完整的YAML字符串
+            # 使用纯Python的SafeDumper：libyaml的CSafeDumper会把emoji等BMP以外的字符转义为\U形式
+            for start in range(0, len(proxies), CLASH_PROXY_DUMP_BATCH):
+                writer.write(yaml.dump(proxies[start:start + CLASH_PROXY_DUMP_BATCH], Dumper=yaml.SafeDumper,
+                                       allow_unicode=True, sort_keys=False, indent=2))
             
-            formatted_tail = '\n'.join(formatted_tail_lines)
-            final_content = head + '\nproxies:\n' + proxies_yaml[9:] + '\nproxy-groups:\n' + formatted_tail
-            
-            return final_content
+            writer.write('\nproxy-groups:\n')
+            self._write_clash_tail(tail, proxy_names, writer)
         except Exception as e:
             self._add_log(f"使用模板生成Clash配置失败: {str(e)}", "error")
-            # 如果模板生成失败，使用基本配置
-            return self._create_basic_clash_config_fallback(proxies, proxy_names)
+            # 如果模板生成失败，丢弃已写入的内容，使用基本配置
+            writer.reset()
+            writer.write(self._create_basic_clash_config_fallback(proxies, proxy_names))
+    
+    def _write_clash_tail(self, tail: str, proxy_names: List[str], writer: "ClashConfigWriter"):
+        """逐行处理模板tail部分，将每个代理组的代理列表替换为全部节点名称"""
+        # normal: 普通内容；header: 代理组名称之后、proxies字段之前；skip: 跳过代理组原有的代理列表
+        state = 'normal'
+        first = True
+        
+        def emit(text):
+            nonlocal first
+            writer.write(text if first else '\n' + text)
+            first = False
+        
+        def emit_proxy_names():
+            for proxy_name in proxy_names:
+                emit(f'      - {proxy_name}')
+        
+        for line in tail.split('\n'):
+            if state == 'skip':
+                if line.startswith('      -') or not line.strip():
+                    continue
+                # 添加新的代理名称列表
+                emit_proxy_names()
+                state = 'normal'
+            
+            if state == 'header':
+                emit(line)
+                # 查找proxies字段
+                if 'proxies:' in line:
+                    state = 'skip'
+            elif line.strip() and (line.startswith('  - name:') or line.startswith('- name:')):
+                # 处理代理组
+                emit('  ' + line if line.startswith('- name:') else line)
+                state = 'header'
+            else:
+                emit(line)
+        
+        if state == 'skip':
+            emit_proxy_names()
+
+
+class ClashConfigWriter:
+    """将生成的Clash配置写入文件，同时保留内容用于保存到数据库
+
+    proxies部分使用纯Python的yaml.SafeDumper分批序列化，而不是libyaml的CSafeDumper：
+    即使指定allow_unicode=True，libyaml也会把BMP以外的字符（如国旗emoji）转义为"\\U0001F1EF"形式，
+    与原有输出不一致（PyYAML 6.0.3下验证）。性能提升来自分批写入文件，不再拼接完整的YAML字符串
+    """
+
+    def __init__(self, file=None):
+        self.file = file
+        self._parts: List[str] = []
+
+    def write(self, text: str):
+        if self.file is not None:
+            self.file.write(text)
+        self._parts.append(text)
+
+    def reset(self):
+        """丢弃已写入的内容"""
+        if self.file is not None:
+            self.file.seek(0)
+            self.file.truncate()
+        self._parts = []
+
+    def getvalue(self) -> str:
+        return ''.join(self._parts)
+
+
+# 子进程中复用的解析服务实例（无数据库连接，日志只保存在内存中）
+_parse_worker_service = None
+
+
+def _parse_nodes_chunk(node_urls: List[str], rename: bool, filter_keywords: List[str] = None) -> List[Tuple[Optional[Dict[str, Any]], Optional[str], List[Dict[str, Any]]]]:
+    """进程池任务：解析一批节点，返回(proxy, error, 解析日志)列表"""
+    global _parse_worker_service
+    if _parse_worker_service is None:
+        _parse_worker_service = ConfigUpdateService(None)
+    
+    service = _parse_worker_service
+    results = []
+    for node_url in node_urls:
+        service.logs = []
+        proxy, error = service._parse_node_isolated(node_url, rename, filter_keywords)
+        results.append((proxy, error, service.logs))
+    service.logs = []
+    return results
@@ -0,0 +1,168 @@
+"""
+设备访问记录缓冲
+将订阅访问时的设备更新和访问日志聚合在内存中，由后台线程批量写入数据库，
+避免每次订阅请求都同步执行UPDATE/INSERT并提交
+"""
+
+import threading
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from sqlalchemy import text
+from app.core.database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceAccessBuffer:
+    """设备访问写缓冲（write-behind）"""
+
+    def __init__(self, flush_interval: int = 5, flush_size: int = 500):
+        self.is_running = False
+        self.flush_interval = flush_interval  # 定时刷新间隔（秒）
+        self.flush_size = flush_size  # 缓冲条数达到该值时立即刷新
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._flush_event = threading.Event()
+        self._flush_thread = None
+        # device_id -> 聚合后的访问信息
+        self._device_updates: Dict[int, Dict[str, Any]] = {}
+        self._access_logs: List[Dict[str, Any]] = []
+
+    def start(self):
+        """启动后台刷新线程"""
+        if self.is_running:
+            return
+
+        self.is_running = True
+        self._stop_event.clear()
+        self._flush_thread = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flush_thread.start()
+        logger.info("设备访问写缓冲已启动")
+
+    def stop(self):
+        """停止后台线程并写入剩余数据"""
+        if not self.is_running:
+            return
+
+        self.is_running = False
+        self._stop_event.set()
+        self._flush_event.set()
+        if self._flush_thread and self._flush_thread.is_alive():
+            self._flush_thread.join(timeout=10)
+        self.flush()
+        logger.info("设备访问写缓冲已停止")
+
+    def record_device_access(self, device_id: int, ip_address: str, user_agent: str):
+        """记录设备访问（同一设备的多次访问合并为一次更新）"""
+        now = datetime.utcnow()
+        with self._lock:
+            update = self._device_updates.get(device_id)
+            if update:
+                update['access_increment'] += 1
+                update['ip_address'] = ip_address
+                update['user_agent'] = user_agent
+                update['last_seen'] = now
+            else:
+                self._device_updates[device_id] = {
+                    'device_id': device_id,
+                    'access_increment': 1,
+                    'ip_address': ip_address,
+                    'user_agent': user_agent,
+                    'last_seen': now
+                }
+            pending = len(self._device_updates) + len(self._access_logs)
+        self._maybe_trigger_flush(pending)
+
+    def record_access_log(self, subscription_id: int, device_id: Optional[int], ip_address: str,
+                          user_agent: str, access_type: str, status_code: int, message: str):
+        """记录订阅访问日志"""
+        with self._lock:
+            self._access_logs.append({
+                'subscription_id': subscription_id,
+                'device_id': device_id,
+                'ip_address': ip_address,
+                'user_agent': user_agent,
+                'access_type': access_type,
+                'response_status': status_code,
+                'response_message': message,
+                'access_time': datetime.utcnow()
+            })
+            pending = len(self._device_updates) + len(self._access_logs)
+        self._maybe_trigger_flush(pending)
+
+    def _maybe_trigger_flush(self, pending: int):
+        """缓冲条数达到阈值时唤醒刷新线程"""
+        if pending >= self.flush_size:
+            self._flush_event.set()
+
+    def _flush_loop(self):
+        """后台刷新主循环"""
+        while not self._stop_event.is_set():
+            self._flush_event.wait(self.flush_interval)
+            self._flush_event.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"设备访问记录刷新异常: {e}")
+
+    def flush(self) -> int:
+        """将缓冲数据批量写入数据库，返回写入的条数"""
+        with self._flush_lock:
+            with self._lock:
+                device_updates = list(self._device_updates.values())
+                access_logs = self._access_logs
+                self._device_updates = {}
+                self._access_logs = []
+
+            if not device_updates and not access_logs:
+                return 0
+
+            db = SessionLocal()
+            written = 0
+            try:
+                if device_updates:
+                    try:
+                        db.execute(text("""
+                            UPDATE devices
+                            SET last_seen = :last_seen, access_count = access_count + :access_increment,
+                                ip_address = :ip_address, user_agent = :user_agent
+                            WHERE id = :device_id
+                        """), device_updates)
+                        db.commit()
+                        written += len(device_updates)
+                    except Exception as e:
+                        db.rollback()
+                        logger.error(f"批量更新设备访问信息失败，丢弃 {len(device_updates)} 条: {e}")
+
+                # 访问日志单独提交，写入失败不影响设备信息更新
+                if access_logs:
+                    try:
+                        db.execute(text("""
+                            INSERT INTO subscription_access_logs (
+                                subscription_id, device_id, ip_address, user_agent,
+                                access_type, response_status, response_message, access_time
+                            ) VALUES (
+                                :subscription_id, :device_id, :ip_address, :user_agent,
+                                :access_type, :response_status, :response_message, :access_time
+                            )
+                        """), access_logs)
+                        db.commit()
+                        written += len(access_logs)
+                    except Exception as e:
+                        db.rollback()
+                        logger.error(f"批量写入访问日志失败，丢弃 {len(access_logs)} 条: {e}")
+            finally:
+                db.close()
+
+            return written
+
+
+# 全局设备访问写缓冲实例
+device_access_buffer = DeviceAccessBuffer()
+
+
+def get_device_access_buffer() -> DeviceAccessBuffer:
+    """获取设备访问写缓冲实例"""
+    return device_access_buffer
@@ -0,0 +1,217 @@
+"""
+订阅设备计数
+subscription_device_counters表按订阅保存设备总数、允许/禁止数及客户端分类数，
+由设备写入路径在同一事务中增量维护（新增设备、允许/禁止），批量删除类的低频操作按订阅重算，
+定时对账任务修正漂移；读路径直接读取计数，无需对devices表COUNT(*)
+"""
+
+import logging
+from typing import Any, Dict, Iterable, Optional
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from app.services.device_presence import device_presence
+
+logger = logging.getLogger(__name__)
+
+# 计数字段（与subscription_device_counters表列名一致）
+DEVICE_COUNTER_FIELDS = (
+    'total_devices', 'allowed_devices', 'blocked_devices',
+    'apple_devices', 'clash_devices', 'v2ray_devices'
+)
+
+# 客户端分类条件（先转为小写再匹配，PostgreSQL的LIKE区分大小写，与classify_device保持一致）
+_APPLE_CONDITION = (
+    "d.device_type = 'mobile' AND (LOWER(d.user_agent) LIKE '%ios%' OR LOWER(d.user_agent) LIKE '%macos%' "
+    "OR LOWER(d.user_agent) LIKE '%apple%')"
+)
+_CLASH_CONDITION = "LOWER(d.user_agent) LIKE '%clash%'"
+_V2RAY_CONDITION = "LOWER(d.user_agent) LIKE '%v2ray%' OR LOWER(d.user_agent) LIKE '%shadowrocket%'"
+
+_AGGREGATE_COLUMNS = f"""
+    COUNT(d.id) AS total_devices,
+    COUNT(CASE WHEN d.is_allowed = 1 THEN 1 END) AS allowed_devices,
+    COUNT(CASE WHEN d.is_allowed = 0 THEN 1 END) AS blocked_devices,
+    COUNT(CASE WHEN {_APPLE_CONDITION} THEN 1 END) AS apple_devices,
+    COUNT(CASE WHEN {_CLASH_CONDITION} THEN 1 END) AS clash_devices,
+    COUNT(CASE WHEN {_V2RAY_CONDITION} THEN 1 END) AS v2ray_devices
+"""
+
+APPLY_COUNTER_DELTA_QUERY = """
+    UPDATE subscription_device_counters
+    SET total_devices = total_devices + :total_devices,
+        allowed_devices = allowed_devices + :allowed_devices,
+        blocked_devices = blocked_devices + :blocked_devices,
+        apple_devices = apple_devices + :apple_devices,
+        clash_devices = clash_devices + :clash_devices,
+        v2ray_devices = v2ray_devices + :v2ray_devices,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE subscription_id = :subscription_id
+"""
+
+DELETE_COUNTER_QUERY = """
+    DELETE FROM subscription_device_counters WHERE subscription_id = :subscription_id
+"""
+
+REFRESH_COUNTER_QUERY = f"""
+    INSERT INTO subscription_device_counters (
+        subscription_id, {', '.join(DEVICE_COUNTER_FIELDS)}, updated_at
+    )
+    SELECT :subscription_id, {_AGGREGATE_COLUMNS}, CURRENT_TIMESTAMP
+    FROM devices d
+    WHERE d.subscription_id = :subscription_id
+"""
+
+# subscriptions.current_devices 与计数表保持一致（旧代码和邮件模板仍读取该列）
+SYNC_CURRENT_DEVICES_QUERY = """
+    UPDATE subscriptions
+    SET current_devices = COALESCE((
+        SELECT total_devices FROM subscription_device_counters
+        WHERE subscription_id = :subscription_id
+    ), 0)
+    WHERE id = :subscription_id
+"""
+
+AGGREGATE_ALL_QUERY = f"""
+    SELECT s.id AS subscription_id, s.current_devices, {_AGGREGATE_COLUMNS}
+    FROM subscriptions s
+    LEFT JOIN devices d ON d.subscription_id = s.id
+    GROUP BY s.id, s.current_devices
+"""
+
+# 对账修正时先按订阅删除计数行再插入（同一事务内），不依赖各数据库不同的UPSERT语法
+INSERT_COUNTER_QUERY = f"""
+    INSERT INTO subscription_device_counters (
+        subscription_id, {', '.join(DEVICE_COUNTER_FIELDS)}, updated_at
+    ) VALUES (
+        :subscription_id, {', '.join(':' + field for field in DEVICE_COUNTER_FIELDS)}, CURRENT_TIMESTAMP
+    )
+"""
+
+
+def classify_device(device_type: Optional[str], user_agent: Optional[str]) -> Dict[str, int]:
+    """按设备类型和User-Agent计算客户端分类计数（与对账SQL的分类条件一致）"""
+    ua = (user_agent or '').lower()
+    return {
+        'apple_devices': int(device_type == 'mobile' and ('ios' in ua or 'macos' in ua or 'apple' in ua)),
+        'clash_devices': int('clash' in ua),
+        'v2ray_devices': int('v2ray' in ua or 'shadowrocket' in ua)
+    }
+
+
+def new_device_delta(is_allowed: bool, device_type: Optional[str], user_agent: Optional[str]) -> Dict[str, int]:
+    """新增一台设备对应的计数增量"""
+    delta = {
+        'total_devices': 1,
+        'allowed_devices': int(bool(is_allowed)),
+        'blocked_devices': int(not is_allowed)
+    }
+    delta.update(classify_device(device_type, user_agent))
+    return delta
+
+
+def _delta_params(subscription_id: int, delta: Dict[str, int]) -> Dict[str, int]:
+    params = {field: delta.get(field, 0) for field in DEVICE_COUNTER_FIELDS}
+    params['subscription_id'] = subscription_id
+    return params
+
+
+def apply_device_counter_delta(db: Session, subscription_id: int, **delta: int):
+    """在调用方事务中累加计数；计数行不存在时按devices表重算（由调用方提交）"""
+    result = db.execute(text(APPLY_COUNTER_DELTA_QUERY), _delta_params(subscription_id, delta))
+    if result.rowcount == 0:
+        db.execute(text(DELETE_COUNTER_QUERY), {'subscription_id': subscription_id})
+        db.execute(text(REFRESH_COUNTER_QUERY), {'subscription_id': subscription_id})
+    db.execute(text(SYNC_CURRENT_DEVICES_QUERY), {'subscription_id': subscription_id})
+
+
+async def apply_device_counter_delta_async(db, subscription_id: int, **delta: int):
+    """apply_device_counter_delta的异步版本（db为AsyncSession）"""
+    result = await db.execute(text(APPLY_COUNTER_DELTA_QUERY), _delta_params(subscription_id, delta))
+    if result.rowcount == 0:
+        await db.execute(text(DELETE_COUNTER_QUERY), {'subscription_id': subscription_id})
+        await db.execute(text(REFRESH_COUNTER_QUERY), {'subscription_id': subscription_id})
+    await db.execute(text(SYNC_CURRENT_DEVICES_QUERY), {'subscription_id': subscription_id})
+
+
+def refresh_device_counters(db: Session, subscription_id: int):
+    """按devices表重算单个订阅的计数（删除/清空设备等低频操作使用，由调用方提交）"""
+    # ORM方式删除的设备需先写入数据库
+    db.flush()
+    db.execute(text(DELETE_COUNTER_QUERY), {'subscription_id': subscription_id})
+    db.execute(text(REFRESH_COUNTER_QUERY), {'subscription_id': subscription_id})
+    db.execute(text(SYNC_CURRENT_DEVICES_QUERY), {'subscription_id': subscription_id})
+    
+    # 已删除的设备不再计入在线设备数
+    device_ids = db.execute(text("""
+        SELECT id FROM devices WHERE subscription_id = :subscription_id
+    """), {'subscription_id': subscription_id}).scalars().all()
+    device_presence.retain(subscription_id, device_ids)
+
+
+def delete_device_counters(db: Session, subscription_ids: Iterable[int]):
+    """删除订阅的计数行（删除订阅前调用，由调用方提交）"""
+    params = [{'subscription_id': subscription_id} for subscription_id in subscription_ids]
+    if params:
+        db.execute(text(DELETE_COUNTER_QUERY), params)
+
+
+def get_device_counters(db: Session, subscription_ids: Iterable[int]) -> Dict[int, Dict[str, int]]:
+    """批量读取订阅的设备计数（订阅ID -> 计数），没有计数行的订阅不在结果中"""
+    subscription_ids = list(subscription_ids)
+    if not subscription_ids:
+        return {}
+
+    placeholders = ', '.join(f':id_{i}' for i in range(len(subscription_ids)))
+    rows = db.execute(text(f"""
+        SELECT subscription_id, {', '.join(DEVICE_COUNTER_FIELDS)}
+        FROM subscription_device_counters
+        WHERE subscription_id IN ({placeholders})
+    """), {f'id_{i}': subscription_id for i, subscription_id in enumerate(subscription_ids)}).fetchall()
+    return {
+        row.subscription_id: {field: getattr(row, field) or 0 for field in DEVICE_COUNTER_FIELDS}
+        for row in rows
+    }
+
+
+def reconcile_device_counters(db: Session) -> Dict[str, Any]:
+    """按devices表对账全部订阅的计数，只写入有差异的订阅，并删除已不存在订阅的计数行"""
+    existing = {
+        row.subscription_id: tuple(getattr(row, field) for field in DEVICE_COUNTER_FIELDS)
+        for row in db.execute(text(f"""
+            SELECT subscription_id, {', '.join(DEVICE_COUNTER_FIELDS)} FROM subscription_device_counters
+        """)).fetchall()
+    }
+
+    repaired = []
+    stale_current_devices = []
+    subscription_ids = set()
+    for row in db.execute(text(AGGREGATE_ALL_QUERY)).fetchall():
+        subscription_ids.add(row.subscription_id)
+        counts = tuple(getattr(row, field) or 0 for field in DEVICE_COUNTER_FIELDS)
+        if existing.get(row.subscription_id) != counts:
+            params = dict(zip(DEVICE_COUNTER_FIELDS, counts))
+            params['subscription_id'] = row.subscription_id
+            repaired.append(params)
+        if (row.current_devices or 0) != counts[0]:
+            stale_current_devices.append({'subscription_id': row.subscription_id})
+
+    orphaned = [{'subscription_id': subscription_id} for subscription_id in existing if subscription_id not in subscription_ids]
+
+    if repaired:
+        db.execute(text(DELETE_COUNTER_QUERY), [{'subscription_id': params['subscription_id']} for params in repaired])
+        db.execute(text(INSERT_COUNTER_QUERY), repaired)
+    if orphaned:
+        db.execute(text(DELETE_COUNTER_QUERY), orphaned)
+    if stale_current_devices:
+        db.execute(text(SYNC_CURRENT_DEVICES_QUERY), stale_current_devices)
+    db.commit()
+
+    if repaired or orphaned:
+        logger.info(f"设备计数对账完成：修正 {len(repaired)} 个订阅，删除 {len(orphaned)} 条失效计数")
+
+    return {
+        'subscriptions': len(subscription_ids),
+        'repaired': len(repaired),
+        'orphaned': len(orphaned),
+        'current_devices_synced': len(stale_current_devices)
+    }
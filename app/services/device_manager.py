@@ -6,25 +6,233 @@
 import hashlib
 import re
 import json
+import threading
+import time
 from datetime import datetime, timedelta
+from types import SimpleNamespace
 from typing import Dict, List, Optional, Tuple, Any
 from sqlalchemy.orm import Session
 from sqlalchemy import text
+from app.services.device_access_buffer import device_access_buffer
+from app.services.device_presence import device_presence
+from app.services.device_counters import (
+    apply_device_counter_delta, apply_device_counter_delta_async, get_device_counters, new_device_delta,
+    refresh_device_counters
+)
+from app.services.subscription_cache import SubscriptionRecord, subscription_key_cache
+from app.utils.cache import LRUCache
 # from app.models.subscription import Subscription
 # from app.models.user import User
 
 
+# 订阅访问路径使用的SQL（同步与异步实现共用）
+SUBSCRIPTION_QUERY = """
+    SELECT s.id, s.user_id, s.device_limit, s.expire_time, s.is_active,
+           u.username, u.email
+    FROM subscriptions s
+    JOIN users u ON s.user_id = u.id
+    WHERE s.subscription_url = :subscription_url
+"""
+
+# 一次查询取得订阅、当前设备（按哈希精确匹配）及已允许设备数
+# 已允许设备数读取subscription_device_counters，计数行不存在时才回退到COUNT(*)
+# 依赖devices表上的 (subscription_id, device_hash) 和 (subscription_id, is_allowed) 索引
+SUBSCRIPTION_ACCESS_QUERY = """
+    SELECT s.id, s.user_id, s.device_limit, s.expire_time, s.is_active,
+           u.username, u.email,
+           d.id AS device_id, d.is_allowed AS device_is_allowed,
+           COALESCE(c.allowed_devices, (SELECT COUNT(*) FROM devices ad
+            WHERE ad.subscription_id = s.id AND ad.is_allowed = 1)) AS allowed_devices_count
+    FROM subscriptions s
+    JOIN users u ON s.user_id = u.id
+    LEFT JOIN subscription_device_counters c ON c.subscription_id = s.id
+    LEFT JOIN devices d ON d.subscription_id = s.id AND d.device_hash = :device_hash
+    WHERE s.subscription_url = :subscription_url
+    LIMIT 1
+"""
+
+# 订阅记录已缓存时只查询设备部分
+DEVICE_ACCESS_QUERY = """
+    SELECT d.id AS device_id, d.is_allowed AS device_is_allowed,
+           COALESCE(c.allowed_devices, (SELECT COUNT(*) FROM devices ad
+            WHERE ad.subscription_id = :subscription_id AND ad.is_allowed = 1)) AS allowed_devices_count
+    FROM (SELECT 1 AS placeholder) base
+    LEFT JOIN subscription_device_counters c ON c.subscription_id = :subscription_id
+    LEFT JOIN devices d ON d.subscription_id = :subscription_id AND d.device_hash = :device_hash
+    LIMIT 1
+"""
+
+SOFTWARE_RULES_QUERY = """
+    SELECT software_name, software_category, user_agent_pattern, 
+           os_pattern, device_pattern, version_pattern
+    FROM software_rules 
+    WHERE is_active = 1
+    ORDER BY software_name
+"""
+
+INSERT_DEVICE_QUERY = """
+    INSERT INTO devices (
+        user_id, subscription_id, device_ua, device_hash, device_fingerprint, 
+        device_name, device_type, ip_address, user_agent,
+        software_name, software_version, os_name, os_version, device_model, 
+        device_brand, is_allowed, is_active, first_seen, last_seen, last_access, access_count
+    ) VALUES (
+        :user_id, :subscription_id, :device_ua, :device_hash, :device_fingerprint,
+        :device_name, :device_type, :ip_address, :user_agent,
+        :software_name, :software_version, :os_name, :os_version, :device_model,
+        :device_brand, :is_allowed, :is_active, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 1
+    )
+"""
+
+TOUCH_DEVICE_QUERY = """
+    UPDATE devices 
+    SET last_seen = CURRENT_TIMESTAMP, access_count = access_count + 1,
+        ip_address = :ip_address, user_agent = :user_agent
+    WHERE id = :device_id
+"""
+
+INSERT_ACCESS_LOG_QUERY = """
+    INSERT INTO subscription_access_logs (
+        subscription_id, device_id, ip_address, user_agent, 
+        access_type, response_status, response_message, access_time
+    ) VALUES (
+        :subscription_id, :device_id, :ip_address, :user_agent,
+        :access_type, :response_status, :response_message, CURRENT_TIMESTAMP
+    )
+"""
+
+
+class SoftwareRuleMatcher:
+    """软件规则多模式匹配器 - 将所有规则模式编译为一个前缀树正则，一次扫描即可找到最长匹配"""
+    
+    _END = ''
+    
+    def __init__(self, rules: List[Dict[str, str]]):
+        # 模式 -> (规则顺序, 规则)，相同模式保留排在前面的规则
+        self._rules_by_pattern: Dict[str, Tuple[int, Dict[str, str]]] = {}
+        for index, rule in enumerate(rules):
+            pattern = (rule.get('user_agent_pattern') or '').lower()
+            if pattern and pattern not in self._rules_by_pattern:
+                self._rules_by_pattern[pattern] = (index, rule)
+        
+        self._regex = None
+        if self._rules_by_pattern:
+            trie: Dict[str, Any] = {}
+            for pattern in self._rules_by_pattern:
+                node = trie
+                for char in pattern:
+                    node = node.setdefault(char, {})
+                node[self._END] = True
+            # 前瞻断言使每个位置都能匹配，且不消耗字符，重叠的模式也能被找到
+            self._regex = re.compile(f"(?=({self._trie_to_regex(trie)}))", re.DOTALL)
+    
+    @classmethod
+    def _trie_to_regex(cls, node: Dict[str, Any]) -> str:
+        """将前缀树转换为正则，子节点优先于结束标记，保证同一位置取最长模式"""
+        alternatives = [
+            re.escape(char) + cls._trie_to_regex(child)
+            for char, child in sorted(node.items())
+            if char != cls._END
+        ]
+        if not alternatives:
+            return ''
+        
+        body = alternatives[0] if len(alternatives) == 1 else f"(?:{'|'.join(alternatives)})"
+        if cls._END in node:
+            body = f"(?:{body})?"
+        return body
+    
+    def match(self, ua_lower: str) -> Optional[Dict[str, str]]:
+        """返回最长的匹配规则，长度相同时取排序靠前的规则"""
+        if self._regex is None:
+            return None
+        
+        best = None
+        for match in self._regex.finditer(ua_lower):
+            index, rule = self._rules_by_pattern[match.group(1)]
+            length = len(match.group(1))
+            if best is None or length > best[0] or (length == best[0] and index < best[1]):
+                best = (length, index, rule)
+        
+        return best[2] if best else None
+
+
+class SoftwareRuleCache:
+    """软件识别规则缓存 - 规则只加载并编译一次，定期检查规则是否变化
+    
+    系统中没有修改software_rules表的接口，规则直接在数据库中维护，
+    修改后最多refresh_interval秒内生效（无需重启）
+    """
+    
+    def __init__(self, refresh_interval: int = 300):
+        self.refresh_interval = refresh_interval  # 检查规则变化的间隔（秒），即规则修改后的最长生效延迟
+        self.version = 0
+        self._rules: Optional[List[Dict[str, str]]] = None
+        self._matcher = SoftwareRuleMatcher([])
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+    
+    def needs_refresh(self) -> bool:
+        """是否到了重新检查规则的时间"""
+        return self._rules is None or time.monotonic() - self._checked_at >= self.refresh_interval
+    
+    def get_matcher(self, loader) -> SoftwareRuleMatcher:
+        """获取编译后的规则匹配器，规则变化时重建"""
+        if self._rules is not None and time.monotonic() - self._checked_at < self.refresh_interval:
+            return self._matcher
+        
+        with self._lock:
+            now = time.monotonic()
+            if self._rules is not None and now - self._checked_at < self.refresh_interval:
+                return self._matcher
+            
+            try:
+                rules = loader()
+            except Exception as e:
+                # 加载失败时继续使用旧规则，避免设备哈希因规则缺失而变化
+                print(f"获取软件规则失败: {e}")
+                return self._matcher
+            
+            if rules != self._rules:
+                self._rules = rules
+                self._matcher = SoftwareRuleMatcher(rules)
+                self.version += 1
+                user_agent_cache.clear()
+            self._checked_at = now
+            return self._matcher
+
+
+# User-Agent解析结果缓存：(规则版本, UA) -> (设备信息, 设备哈希)
+user_agent_cache = LRUCache(maxsize=4096)
+
+# 全局软件规则缓存实例
+software_rule_cache = SoftwareRuleCache()
+
+
 class DeviceManager:
     """设备管理器"""
     
     def __init__(self, db: Session):
         self.db = db
     
+    def _analyze_user_agent(self, user_agent: str) -> Tuple[Dict[str, str], str]:
+        """解析User-Agent并生成设备哈希，结果按UA缓存"""
+        matcher = software_rule_cache.get_matcher(self._load_software_rules)
+        cache_key = (software_rule_cache.version, user_agent)
+        cached = user_agent_cache.get(cache_key)
+        if cached is None:
+            device_info = self._parse_user_agent_with_rules(user_agent, matcher)
+            device_hash = self._compute_device_hash(user_agent, device_info)
+            cached = (device_info, device_hash)
+            user_agent_cache.set(cache_key, cached)
+        return cached
+    
     def generate_device_hash(self, user_agent: str, ip_address: str) -> str:
         """生成设备唯一标识 - 改进版本，解决同设备不同IP问题"""
-        # 解析设备信息
-        device_info = self.parse_user_agent(user_agent)
-        
+        return self._analyze_user_agent(user_agent)[1]
+    
+    def _compute_device_hash(self, user_agent: str, device_info: Dict[str, str]) -> str:
+        """根据设备信息计算设备哈希"""
         # 提取关键设备特征，不依赖IP地址
         device_features = []
         
@@ -82,6 +290,10 @@ class DeviceManager:
     
     def parse_user_agent(self, user_agent: str) -> Dict[str, str]:
         """解析User-Agent，识别软件、操作系统、设备信息 - 改进版本"""
+        return dict(self._analyze_user_agent(user_agent)[0])
+    
+    def _parse_user_agent_with_rules(self, user_agent: str, matcher: SoftwareRuleMatcher) -> Dict[str, str]:
+        """使用预处理的软件规则解析User-Agent"""
         result = {
             'software_name': 'Unknown',
             'software_version': '',
@@ -93,20 +305,11 @@ class DeviceManager:
             'device_name': 'Unknown Device'
         }
         
-        # 获取软件识别规则
-        rules = self.get_software_rules()
-        
         # 转换为小写进行匹配
         ua_lower = user_agent.lower()
         
-        # 匹配软件规则 - 改进的匹配逻辑
-        matched_rule = None
-        for rule in rules:
-            pattern = rule['user_agent_pattern'].lower()
-            if pattern in ua_lower:
-                # 检查是否有更精确的匹配
-                if not matched_rule or len(pattern) > len(matched_rule['user_agent_pattern']):
-                    matched_rule = rule
+        # 匹配软件规则 - 取最长（最精确）的匹配
+        matched_rule = matcher.match(ua_lower)
         
         if matched_rule:
             result['software_name'] = matched_rule['software_name']
@@ -278,62 +481,68 @@ class DeviceManager:
         else:
             return "Unknown Device"
     
+    def _build_similar_device_query(self, subscription_id: int, device_info: Dict[str, str], user_agent: str) -> Tuple[Optional[str], Dict[str, Any]]:
+        """构建相似设备查询，无可用特征时返回 (None, params)"""
+        # 构建查询条件
+        conditions = []
+        params = {'subscription_id': subscription_id}
+        
+        # 1. 通过软件名称查找
+        if device_info.get('software_name') and device_info['software_name'] != 'Unknown':
+            conditions.append("software_name = :software_name")
+            params['software_name'] = device_info['software_name']
+        
+        # 2. 通过设备型号查找
+        if device_info.get('device_model'):
+            conditions.append("device_model = :device_model")
+            params['device_model'] = device_info['device_model']
+        
+        # 3. 通过操作系统和版本查找
+        if device_info.get('os_name') and device_info['os_name'] != 'Unknown':
+            conditions.append("os_name = :os_name")
+            params['os_name'] = device_info['os_name']
+            if device_info.get('os_version'):
+                conditions.append("os_version = :os_version")
+                params['os_version'] = device_info['os_version']
+        
+        # 4. 通过User-Agent中的关键特征查找
+        ua_lower = user_agent.lower()
+        if 'iphone' in ua_lower:
+            iphone_match = re.search(r'iphone(\d+,\d+)', user_agent, re.IGNORECASE)
+            if iphone_match:
+                conditions.append("device_model LIKE :iphone_model")
+                params['iphone_model'] = f"iPhone {iphone_match.group(1).replace(',', '.')}%"
+        
+        if 'ipad' in ua_lower:
+            ipad_match = re.search(r'ipad(\d+,\d+)', user_agent, re.IGNORECASE)
+            if ipad_match:
+                conditions.append("device_model LIKE :ipad_model")
+                params['ipad_model'] = f"iPad {ipad_match.group(1).replace(',', '.')}%"
+        
+        # 5. 通过软件版本查找
+        if device_info.get('software_version'):
+            conditions.append("software_version = :software_version")
+            params['software_version'] = device_info['software_version']
+        
+        if not conditions:
+            return None, params
+        
+        query = f"""
+            SELECT id, is_allowed, access_count, first_seen, last_seen, ip_address
+            FROM devices
+            WHERE subscription_id = :subscription_id AND ({' AND '.join(conditions)})
+            ORDER BY last_seen DESC
+            LIMIT 1
+        """
+        return query, params
+    
     def _find_similar_device(self, subscription_id: int, device_info: Dict[str, str], user_agent: str) -> Optional[Any]:
         """查找相似设备 - 解决同设备不同IP问题"""
         try:
-            # 构建查询条件
-            conditions = []
-            params = {'subscription_id': subscription_id}
-            
-            # 1. 通过软件名称查找
-            if device_info.get('software_name') and device_info['software_name'] != 'Unknown':
-                conditions.append("software_name = :software_name")
-                params['software_name'] = device_info['software_name']
-            
-            # 2. 通过设备型号查找
-            if device_info.get('device_model'):
-                conditions.append("device_model = :device_model")
-                params['device_model'] = device_info['device_model']
-            
-            # 3. 通过操作系统和版本查找
-            if device_info.get('os_name') and device_info['os_name'] != 'Unknown':
-                conditions.append("os_name = :os_name")
-                params['os_name'] = device_info['os_name']
-                if device_info.get('os_version'):
-                    conditions.append("os_version = :os_version")
-                    params['os_version'] = device_info['os_version']
-            
-            # 4. 通过User-Agent中的关键特征查找
-            ua_lower = user_agent.lower()
-            if 'iphone' in ua_lower:
-                iphone_match = re.search(r'iphone(\d+,\d+)', user_agent, re.IGNORECASE)
-                if iphone_match:
-                    conditions.append("device_model LIKE :iphone_model")
-                    params['iphone_model'] = f"iPhone {iphone_match.group(1).replace(',', '.')}%"
-            
-            if 'ipad' in ua_lower:
-                ipad_match = re.search(r'ipad(\d+,\d+)', user_agent, re.IGNORECASE)
-                if ipad_match:
-                    conditions.append("device_model LIKE :ipad_model")
-                    params['ipad_model'] = f"iPad {ipad_match.group(1).replace(',', '.')}%"
-            
-            # 5. 通过软件版本查找
-            if device_info.get('software_version'):
-                conditions.append("software_version = :software_version")
-                params['software_version'] = device_info['software_version']
-            
-            if not conditions:
+            query, params = self._build_similar_device_query(subscription_id, device_info, user_agent)
+            if not query:
                 return None
             
-            # 执行查询
-            query = f"""
-                SELECT id, is_allowed, access_count, first_seen, last_seen, ip_address
-                FROM devices
-                WHERE subscription_id = :subscription_id AND ({' AND '.join(conditions)})
-                ORDER BY last_seen DESC
-                LIMIT 1
-            """
-            
             result = self.db.execute(text(query), params).fetchone()
             return result
             
@@ -344,29 +553,115 @@ class DeviceManager:
     def get_software_rules(self) -> List[Dict[str, str]]:
         """获取软件识别规则"""
         try:
-            result = self.db.execute(text("""
-                SELECT software_name, software_category, user_agent_pattern, 
-                       os_pattern, device_pattern, version_pattern
-                FROM software_rules 
-                WHERE is_active = 1
-                ORDER BY software_name
-            """)).fetchall()
-            
-            return [
-                {
-                    'software_name': row[0],
-                    'software_category': row[1],
-                    'user_agent_pattern': row[2],
-                    'os_pattern': row[3],
-                    'device_pattern': row[4],
-                    'version_pattern': row[5]
-                }
-                for row in result
-            ]
+            return self._load_software_rules()
         except Exception as e:
             print(f"获取软件规则失败: {e}")
             return []
     
+    def _load_software_rules(self) -> List[Dict[str, str]]:
+        """从数据库加载软件识别规则（失败时抛出异常）"""
+        result = self.db.execute(text(SOFTWARE_RULES_QUERY)).fetchall()
+        return self._rows_to_rules(result)
+    
+    @staticmethod
+    def _rows_to_rules(result) -> List[Dict[str, str]]:
+        """将软件规则查询结果转换为规则列表"""
+        return [
+            {
+                'software_name': row[0],
+                'software_category': row[1],
+                'user_agent_pattern': row[2],
+                'os_pattern': row[3],
+                'device_pattern': row[4],
+                'version_pattern': row[5]
+            }
+            for row in result
+        ]
+    
+    def _get_subscription(self, subscription_url: str) -> Optional[SubscriptionRecord]:
+        """根据订阅地址获取订阅及用户信息（优先使用缓存）"""
+        record = subscription_key_cache.get(subscription_url)
+        if record is not None:
+            return record
+        
+        generation = subscription_key_cache.generation
+        row = self.db.execute(text(SUBSCRIPTION_QUERY), {'subscription_url': subscription_url}).fetchone()
+        if not row:
+            return None
+        record = SubscriptionRecord.from_row(row)
+        subscription_key_cache.set(subscription_url, record, generation)
+        return record
+    
+    def _get_subscription_access(self, subscription_url: str, device_hash: str) -> Optional[Any]:
+        """获取订阅信息、已知设备及已允许设备数，订阅记录已缓存时只查询设备"""
+        record = subscription_key_cache.get(subscription_url)
+        if record is not None:
+            device = self.db.execute(text(DEVICE_ACCESS_QUERY), {
+                'subscription_id': record.id,
+                'device_hash': device_hash
+            }).fetchone()
+            return self._merge_subscription_access(record, device)
+        
+        generation = subscription_key_cache.generation
+        row = self.db.execute(text(SUBSCRIPTION_ACCESS_QUERY), {
+            'subscription_url': subscription_url,
+            'device_hash': device_hash
+        }).fetchone()
+        if row:
+            subscription_key_cache.set(subscription_url, SubscriptionRecord.from_row(row), generation)
+        return row
+    
+    @staticmethod
+    def _merge_subscription_access(record: SubscriptionRecord, device: Any) -> SimpleNamespace:
+        """合并缓存的订阅记录与设备查询结果"""
+        return SimpleNamespace(
+            **record._asdict(),
+            device_id=device.device_id,
+            device_is_allowed=device.device_is_allowed,
+            allowed_devices_count=device.allowed_devices_count
+        )
+    
+    def _is_subscription_expired(self, subscription: Any) -> bool:
+        """检查订阅是否过期"""
+        if not subscription.expire_time:
+            return False
+        
+        # 处理字符串格式的日期
+        if isinstance(subscription.expire_time, str):
+            try:
+                expire_time = datetime.fromisoformat(subscription.expire_time.replace('Z', '+00:00'))
+            except:
+                expire_time = datetime.strptime(subscription.expire_time, '%Y-%m-%d %H:%M:%S.%f')
+        else:
+            expire_time = subscription.expire_time
+        
+        return expire_time < datetime.utcnow()
+    
+    def check_subscription_status(self, subscription_url: str) -> Dict[str, Any]:
+        """仅检查订阅本身是否可用（不读写设备表），用于条件请求的快速校验"""
+        result = {
+            'allowed': False,
+            'status_code': 200,
+            'message': ''
+        }
+        
+        try:
+            subscription = self._get_subscription(subscription_url)
+            if not subscription:
+                result['status_code'] = 404
+                result['message'] = '订阅地址不存在'
+            elif self._is_subscription_expired(subscription):
+                result['status_code'] = 403
+                result['message'] = '订阅已过期'
+            else:
+                result['allowed'] = True
+        except Exception as e:
+            print(f"检查订阅状态失败: {e}")
+            result['status_code'] = 500
+            result['message'] = '服务器内部错误'
+        
+        return result
+    
     def check_subscription_access(self, subscription_url: str, user_agent: str, ip_address: str) -> Dict[str, Any]:
         """检查订阅访问权限"""
         result = {
@@ -378,14 +673,14 @@ class DeviceManager:
         }
         
         try:
-            # 获取订阅信息
-            subscription = self.db.execute(text("""
-                SELECT s.id, s.user_id, s.device_limit, s.expire_time, s.is_active,
-                       u.id as user_id, u.username, u.email
-                FROM subscriptions s
-                JOIN users u ON s.user_id = u.id
-                WHERE s.subscription_url = :subscription_url
-            """), {'subscription_url': subscription_url}).fetchone()
+            # 解析设备信息（结果已缓存，不访问数据库）
+            device_info = self.parse_user_agent(user_agent)
+            
+            # 生成设备哈希（不依赖IP地址）
+            device_hash = self.generate_device_hash(user_agent, ip_address)
+            
+            # 一次查询获取订阅信息、已知设备及已允许设备数
+            subscription = self._get_subscription_access(subscription_url, device_hash)
             
             if not subscription:
                 result['status_code'] = 404
@@ -394,80 +689,46 @@ class DeviceManager:
                 return result
             
             # 检查订阅是否过期
-            if subscription.expire_time:
-                # 处理字符串格式的日期
-                if isinstance(subscription.expire_time, str):
-                    from datetime import datetime
-                    try:
-                        expire_time = datetime.fromisoformat(subscription.expire_time.replace('Z', '+00:00'))
-                    except:
-                        expire_time = datetime.strptime(subscription.expire_time, '%Y-%m-%d %H:%M:%S.%f')
-                else:
-                    expire_time = subscription.expire_time
-                
-                if expire_time < datetime.utcnow():
-                    result['status_code'] = 403
-                    result['message'] = '订阅已过期'
-                    result['access_type'] = 'blocked_expired'
-                    self._log_access(subscription.id, None, ip_address, user_agent, 'blocked_expired', 403, '订阅已过期')
-                    return result
+            if self._is_subscription_expired(subscription):
+                result['status_code'] = 403
+                result['message'] = '订阅已过期'
+                result['access_type'] = 'blocked_expired'
+                self._log_access(subscription.id, None, ip_address, user_agent, 'blocked_expired', 403, '订阅已过期')
+                return result
             
-            # 解析设备信息
-            device_info = self.parse_user_agent(user_agent)
             result['device_info'] = device_info
-            
-            # 生成设备哈希（不依赖IP地址）
-            device_hash = self.generate_device_hash(user_agent, ip_address)
-            
-            # 检查设备是否已存在 - 改进的检查逻辑
-            existing_device = self.db.execute(text("""
-                SELECT id, is_allowed, access_count, first_seen, last_seen, ip_address
-                FROM devices
-                WHERE device_hash = :device_hash AND subscription_id = :subscription_id
-            """), {
-                'device_hash': device_hash,
-                'subscription_id': subscription.id
-            }).fetchone()
+            device_id = subscription.device_id
+            device_is_allowed = subscription.device_is_allowed
             
             # 如果设备不存在，尝试通过软件特征查找相似设备
-            if not existing_device:
-                existing_device = self._find_similar_device(
+            if device_id is None:
+                similar_device = self._find_similar_device(
                     subscription.id, device_info, user_agent
                 )
+                if similar_device:
+                    device_id = similar_device.id
+                    device_is_allowed = similar_device.is_allowed
             
-            if existing_device:
+            if device_id is not None:
                 # 设备已存在，更新访问信息
-                self.db.execute(text("""
-                    UPDATE devices 
-                    SET last_seen = CURRENT_TIMESTAMP, access_count = access_count + 1,
-                        ip_address = :ip_address, user_agent = :user_agent
-                    WHERE id = :device_id
-                """), {
-                    'device_id': existing_device.id,
-                    'ip_address': ip_address,
-                    'user_agent': user_agent
-                })
+                self._touch_device(device_id, ip_address, user_agent)
+                device_presence.touch(device_id, subscription.id)
                 
-                if existing_device.is_allowed:
+                if device_is_allowed:
                     result['allowed'] = True
                     result['access_type'] = 'allowed'
-                    self._log_access(subscription.id, existing_device.id, ip_address, user_agent, 'allowed', 200, '访问成功')
+                    self._log_access(subscription.id, device_id, ip_address, user_agent, 'allowed', 200, '访问成功')
                 else:
                     result['status_code'] = 403
                     result['message'] = '设备数量已达上限'
                     result['access_type'] = 'blocked_device_limit'
-                    self._log_access(subscription.id, existing_device.id, ip_address, user_agent, 'blocked_device_limit', 403, '设备数量已达上限')
+                    self._log_access(subscription.id, device_id, ip_address, user_agent, 'blocked_device_limit', 403, '设备数量已达上限')
                 
                 self.db.commit()
                 return result
             
             # 新设备，检查设备数量限制
-            allowed_devices_count = self.db.execute(text("""
-                SELECT COUNT(*) FROM devices 
-                WHERE subscription_id = :subscription_id AND is_allowed = 1
-            """), {'subscription_id': subscription.id}).scalar()
-            
-            if allowed_devices_count >= subscription.device_limit:
+            if (subscription.allowed_devices_count or 0) >= subscription.device_limit:
                 # 设备数量已达上限，记录但不允许
                 device_id = self._create_device_record(
                     subscription.id, subscription.user_id, device_hash, 
@@ -490,6 +751,7 @@ class DeviceManager:
                 self._log_access(subscription.id, device_id, ip_address, user_agent, 'allowed', 200, '访问成功')
             
             self.db.commit()
+            device_presence.touch(device_id, subscription.id)
             
         except Exception as e:
             print(f"检查订阅访问权限失败: {e}")
@@ -504,19 +766,20 @@ class DeviceManager:
                             ip_address: str, user_agent: str, device_info: Dict[str, str], 
                             is_allowed: bool) -> int:
         """创建设备记录"""
-        result = self.db.execute(text("""
-            INSERT INTO devices (
-                user_id, subscription_id, device_ua, device_hash, device_fingerprint, 
-                device_name, device_type, ip_address, user_agent,
-                software_name, software_version, os_name, os_version, device_model, 
-                device_brand, is_allowed, is_active, first_seen, last_seen, last_access, access_count
-            ) VALUES (
-                :user_id, :subscription_id, :device_ua, :device_hash, :device_fingerprint,
-                :device_name, :device_type, :ip_address, :user_agent,
-                :software_name, :software_version, :os_name, :os_version, :device_model,
-                :device_brand, :is_allowed, :is_active, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP, 1
-            )
-        """), {
+        result = self.db.execute(text(INSERT_DEVICE_QUERY), self._device_record_params(
+            subscription_id, user_id, device_hash, ip_address, user_agent, device_info, is_allowed
+        ))
+        apply_device_counter_delta(self.db, subscription_id, **new_device_delta(
+            is_allowed, device_info.get('device_type', 'unknown'), user_agent
+        ))
+        
+        return result.lastrowid
+    
+    def _device_record_params(self, subscription_id: int, user_id: int, device_hash: str, 
+                              ip_address: str, user_agent: str, device_info: Dict[str, str], 
+                              is_allowed: bool) -> Dict[str, Any]:
+        """设备记录插入参数"""
+        return {
             'user_id': user_id,
             'subscription_id': subscription_id,
             'device_ua': f"{user_agent}|{ip_address}",
@@ -534,23 +797,31 @@ class DeviceManager:
             'device_brand': device_info.get('device_brand', ''),
             'is_allowed': is_allowed,
             'is_active': True
-        })
+        }
+    
+    def _touch_device(self, device_id: int, ip_address: str, user_agent: str):
+        """更新设备最后访问信息（写缓冲运行时异步批量写入）"""
+        if device_access_buffer.is_running:
+            device_access_buffer.record_device_access(device_id, ip_address, user_agent)
+            return
         
-        return result.lastrowid
+        self.db.execute(text(TOUCH_DEVICE_QUERY), {
+            'device_id': device_id,
+            'ip_address': ip_address,
+            'user_agent': user_agent
+        })
     
     def _log_access(self, subscription_id: int, device_id: Optional[int], ip_address: str, 
                    user_agent: str, access_type: str, status_code: int, message: str):
         """记录访问日志"""
+        if device_access_buffer.is_running:
+            device_access_buffer.record_access_log(
+                subscription_id, device_id, ip_address, user_agent, access_type, status_code, message
+            )
+            return
+        
         try:
-            self.db.execute(text("""
-                INSERT INTO subscription_access_logs (
-                    subscription_id, device_id, ip_address, user_agent, 
-                    access_type, response_status, response_message, access_time
-                ) VALUES (
-                    :subscription_id, :device_id, :ip_address, :user_agent,
-                    :access_type, :response_status, :response_message, CURRENT_TIMESTAMP
-                )
-            """), {
+            self.db.execute(text(INSERT_ACCESS_LOG_QUERY), {
                 'subscription_id': subscription_id,
                 'device_id': device_id,
                 'ip_address': ip_address,
@@ -618,7 +889,7 @@ class DeviceManager:
         try:
             # 验证设备存在
             device = self.db.execute(text("""
-                SELECT id FROM devices WHERE id = :device_id
+                SELECT id, subscription_id, is_allowed FROM devices WHERE id = :device_id
             """), {'device_id': device_id}).fetchone()
             
             if not device:
@@ -643,6 +914,14 @@ class DeviceManager:
             """
             
             self.db.execute(text(update_sql), params)
+            
+            # 允许/禁止状态变化时同步设备计数
+            if 'is_allowed' in params and bool(params['is_allowed']) != bool(device.is_allowed):
+                change = 1 if params['is_allowed'] else -1
+                apply_device_counter_delta(
+                    self.db, device.subscription_id, allowed_devices=change, blocked_devices=-change
+                )
+            
             self.db.commit()
             return True
             
@@ -656,7 +935,7 @@ class DeviceManager:
         try:
             # 验证设备所有权
             device = self.db.execute(text("""
-                SELECT id FROM devices 
+                SELECT id, subscription_id FROM devices 
                 WHERE id = :device_id AND user_id = :user_id
             """), {'device_id': device_id, 'user_id': user_id}).fetchone()
             
@@ -667,6 +946,7 @@ class DeviceManager:
             self.db.execute(text("""
                 DELETE FROM devices WHERE id = :device_id
             """), {'device_id': device_id})
+            refresh_device_counters(self.db, device.subscription_id)
             
             self.db.commit()
             return True
@@ -690,6 +970,7 @@ class DeviceManager:
             self.db.execute(text("""
                 DELETE FROM devices WHERE subscription_id = :subscription_id
             """), {'subscription_id': subscription_id})
+            refresh_device_counters(self.db, subscription_id)
             
             self.db.commit()
             return device_count
@@ -702,20 +983,249 @@ class DeviceManager:
     def get_subscription_device_stats(self, subscription_id: int) -> Dict[str, int]:
         """获取订阅设备统计"""
         try:
-            result = self.db.execute(text("""
-                SELECT 
-                    COUNT(*) as total_devices,
-                    SUM(CASE WHEN is_allowed = 1 THEN 1 ELSE 0 END) as allowed_devices,
-                    SUM(CASE WHEN is_allowed = 0 THEN 1 ELSE 0 END) as blocked_devices
-                FROM devices 
-                WHERE subscription_id = :subscription_id
-            """), {'subscription_id': subscription_id}).fetchone()
+            counters = get_device_counters(self.db, [subscription_id]).get(subscription_id)
+            if counters is None:
+                # 计数行尚未建立（如升级后对账任务还未运行），按devices表重算一次
+                refresh_device_counters(self.db, subscription_id)
+                self.db.commit()
+                counters = get_device_counters(self.db, [subscription_id]).get(subscription_id, {})
             
             return {
-                'total_devices': result.total_devices or 0,
-                'allowed_devices': result.allowed_devices or 0,
-                'blocked_devices': result.blocked_devices or 0
+                'total_devices': counters.get('total_devices', 0),
+                'allowed_devices': counters.get('allowed_devices', 0),
+                'blocked_devices': counters.get('blocked_devices', 0)
             }
         except Exception as e:
             print(f"获取订阅设备统计失败: {e}")
+            self.db.rollback()
             return {'total_devices': 0, 'allowed_devices': 0, 'blocked_devices': 0}
+
+
+class AsyncDeviceManager(DeviceManager):
+    """异步设备管理器 - 供订阅下载端点使用（db为AsyncSession）
+    
+    User-Agent解析和设备哈希沿用DeviceManager的实现，只重写访问数据库的方法
+    """
+    
+    async def _refresh_software_rules(self):
+        """规则到期时异步加载，之后的解析直接使用已编译的匹配器"""
+        if not software_rule_cache.needs_refresh():
+            return
+        
+        try:
+            result = (await self.db.execute(text(SOFTWARE_RULES_QUERY))).fetchall()
+            rules = self._rows_to_rules(result)
+        except Exception as e:
+            print(f"获取软件规则失败: {e}")
+            return
+        software_rule_cache.get_matcher(lambda: rules)
+    
+    def _load_software_rules(self) -> List[Dict[str, str]]:
+        """异步会话不能同步查询，规则由_refresh_software_rules预先加载"""
+        raise RuntimeError("异步会话不支持同步加载软件规则")
+    
+    async def _get_subscription(self, subscription_url: str) -> Optional[SubscriptionRecord]:
+        """根据订阅地址获取订阅及用户信息（优先使用缓存）"""
+        record = subscription_key_cache.get(subscription_url)
+        if record is not None:
+            return record
+        
+        generation = subscription_key_cache.generation
+        row = (await self.db.execute(text(SUBSCRIPTION_QUERY), {'subscription_url': subscription_url})).fetchone()
+        if not row:
+            return None
+        record = SubscriptionRecord.from_row(row)
+        subscription_key_cache.set(subscription_url, record, generation)
+        return record
+    
+    async def _get_subscription_access(self, subscription_url: str, device_hash: str) -> Optional[Any]:
+        """获取订阅信息、已知设备及已允许设备数，订阅记录已缓存时只查询设备"""
+        record = subscription_key_cache.get(subscription_url)
+        if record is not None:
+            device = (await self.db.execute(text(DEVICE_ACCESS_QUERY), {
+                'subscription_id': record.id,
+                'device_hash': device_hash
+            })).fetchone()
+            return self._merge_subscription_access(record, device)
+        
+        generation = subscription_key_cache.generation
+        row = (await self.db.execute(text(SUBSCRIPTION_ACCESS_QUERY), {
+            'subscription_url': subscription_url,
+            'device_hash': device_hash
+        })).fetchone()
+        if row:
+            subscription_key_cache.set(subscription_url, SubscriptionRecord.from_row(row), generation)
+        return row
+    
+    async def check_subscription_status(self, subscription_url: str) -> Dict[str, Any]:
+        """仅检查订阅本身是否可用（不读写设备表），用于条件请求的快速校验"""
+        result = {
+            'allowed': False,
+            'status_code': 200,
+            'message': ''
+        }
+        
+        try:
+            subscription = await self._get_subscription(subscription_url)
+            if not subscription:
+                result['status_code'] = 404
+                result['message'] = '订阅地址不存在'
+            elif self._is_subscription_expired(subscription):
+                result['status_code'] = 403
+                result['message'] = '订阅已过期'
+            else:
+                result['allowed'] = True
+        except Exception as e:
+            print(f"检查订阅状态失败: {e}")
+            result['status_code'] = 500
+            result['message'] = '服务器内部错误'
+        
+        return result
+    
+    async def check_subscription_access(self, subscription_url: str, user_agent: str, ip_address: str) -> Dict[str, Any]:
+        """检查订阅访问权限"""
+        result = {
+            'allowed': False,
+            'status_code': 200,
+            'message': '',
+            'device_info': {},
+            'access_type': 'allowed'
+        }
+        
+        try:
+            await self._refresh_software_rules()
+            device_info = self.parse_user_agent(user_agent)
+            device_hash = self.generate_device_hash(user_agent, ip_address)
+            
+            # 一次查询获取订阅信息、已知设备及已允许设备数
+            subscription = await self._get_subscription_access(subscription_url, device_hash)
+            
+            if not subscription:
+                result['status_code'] = 404
+                result['message'] = '订阅地址不存在'
+                result['access_type'] = 'not_found'
+                return result
+            
+            if self._is_subscription_expired(subscription):
+                result['status_code'] = 403
+                result['message'] = '订阅已过期'
+                result['access_type'] = 'blocked_expired'
+                await self._log_access(subscription.id, None, ip_address, user_agent, 'blocked_expired', 403, '订阅已过期')
+                await self.db.commit()
+                return result
+            
+            result['device_info'] = device_info
+            device_id = subscription.device_id
+            device_is_allowed = subscription.device_is_allowed
+            
+            if device_id is None:
+                similar_device = await self._find_similar_device(
+                    subscription.id, device_info, user_agent
+                )
+                if similar_device:
+                    device_id = similar_device.id
+                    device_is_allowed = similar_device.is_allowed
+            
+            if device_id is not None:
+                await self._touch_device(device_id, ip_address, user_agent)
+                device_presence.touch(device_id, subscription.id)
+                
+                if device_is_allowed:
+                    result['allowed'] = True
+                    result['access_type'] = 'allowed'
+                    await self._log_access(subscription.id, device_id, ip_address, user_agent, 'allowed', 200, '访问成功')
+                else:
+                    result['status_code'] = 403
+                    result['message'] = '设备数量已达上限'
+                    result['access_type'] = 'blocked_device_limit'
+                    await self._log_access(subscription.id, device_id, ip_address, user_agent, 'blocked_device_limit', 403, '设备数量已达上限')
+                
+                await self.db.commit()
+                return result
+            
+            # 新设备，检查设备数量限制
+            is_allowed = (subscription.allowed_devices_count or 0) < subscription.device_limit
+            device_id = await self._create_device_record(
+                subscription.id, subscription.user_id, device_hash,
+                ip_address, user_agent, device_info, is_allowed
+            )
+            
+            if is_allowed:
+                result['allowed'] = True
+                result['access_type'] = 'allowed'
+                await self._log_access(subscription.id, device_id, ip_address, user_agent, 'allowed', 200, '访问成功')
+            else:
+                result['status_code'] = 403
+                result['message'] = f'设备数量已达上限（{subscription.device_limit}个）'
+                result['access_type'] = 'blocked_device_limit'
+                await self._log_access(subscription.id, device_id, ip_address, user_agent, 'blocked_device_limit', 403, result['message'])
+            
+            await self.db.commit()
+            device_presence.touch(device_id, subscription.id)
+            
+        except Exception as e:
+            print(f"检查订阅访问权限失败: {e}")
+            result['status_code'] = 500
+            result['message'] = '服务器内部错误'
+            result['access_type'] = 'error'
+            await self.db.rollback()
+        
+        return result
+    
+    async def _find_similar_device(self, subscription_id: int, device_info: Dict[str, str], user_agent: str) -> Optional[Any]:
+        """查找相似设备 - 解决同设备不同IP问题"""
+        try:
+            query, params = self._build_similar_device_query(subscription_id, device_info, user_agent)
+            if not query:
+                return None
+            
+            return (await self.db.execute(text(query), params)).fetchone()
+        except Exception as e:
+            print(f"查找相似设备失败: {e}")
+            return None
+    
+    async def _create_device_record(self, subscription_id: int, user_id: int, device_hash: str, 
+                                    ip_address: str, user_agent: str, device_info: Dict[str, str], 
+                                    is_allowed: bool) -> int:
+        """创建设备记录"""
+        result = await self.db.execute(text(INSERT_DEVICE_QUERY), self._device_record_params(
+            subscription_id, user_id, device_hash, ip_address, user_agent, device_info, is_allowed
+        ))
+        await apply_device_counter_delta_async(self.db, subscription_id, **new_device_delta(
+            is_allowed, device_info.get('device_type', 'unknown'), user_agent
+        ))
+        return result.lastrowid
+    
+    async def _touch_device(self, device_id: int, ip_address: str, user_agent: str):
+        """更新设备最后访问信息（写缓冲运行时异步批量写入）"""
+        if device_access_buffer.is_running:
+            device_access_buffer.record_device_access(device_id, ip_address, user_agent)
+            return
+        
+        await self.db.execute(text(TOUCH_DEVICE_QUERY), {
+            'device_id': device_id,
+            'ip_address': ip_address,
+            'user_agent': user_agent
+        })
+    
+    async def _log_access(self, subscription_id: int, device_id: Optional[int], ip_address: str, 
+                          user_agent: str, access_type: str, status_code: int, message: str):
+        """记录访问日志"""
+        if device_access_buffer.is_running:
+            device_access_buffer.record_access_log(
+                subscription_id, device_id, ip_address, user_agent, access_type, status_code, message
+            )
+            return
+        
+        try:
+            await self.db.execute(text(INSERT_ACCESS_LOG_QUERY), {
+                'subscription_id': subscription_id,
+                'device_id': device_id,
+                'ip_address': ip_address,
+                'user_agent': user_agent,
+                'access_type': access_type,
+                'response_status': status_code,
+                'response_message': message
+            })
+        except Exception as e:
+            print(f"记录访问日志失败: {e}")
@@ -0,0 +1,174 @@
+"""
+设备在线状态
+订阅访问路径记录设备最后访问时间，按时间分桶保存在内存中（device_id -> 所在时间桶），
+过期的时间桶整体淘汰；全局和单个订阅的在线设备数为O(1)读取，不再扫描devices表，
+也不依赖数据库特定的时间函数
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Optional, Set
+from sqlalchemy import text
+
+
+class DevicePresence:
+    """设备在线状态（线程安全）：最近window秒内访问过订阅的设备视为在线"""
+
+    def __init__(self, window: int = 300, bucket_seconds: int = 10):
+        self.window = window  # 在线判定时间窗口（秒）
+        self.bucket_seconds = bucket_seconds  # 时间桶粒度（秒），在线判定精度
+        self._lock = threading.Lock()
+        # 时间桶编号 -> 该时间段内最后一次访问的设备ID（按编号递增排列）
+        self._buckets: "OrderedDict[int, Set[int]]" = OrderedDict()
+        # device_id -> (所在时间桶编号, 订阅ID)
+        self._devices: Dict[int, tuple] = {}
+        # 订阅ID -> 在线设备ID
+        self._subscriptions: Dict[int, Set[int]] = {}
+
+    def _bucket(self, timestamp: float) -> int:
+        return int(timestamp // self.bucket_seconds)
+
+    def _expire(self, now: float):
+        """淘汰超出时间窗口的时间桶（调用方持有锁）"""
+        oldest = self._bucket(now - self.window)
+        while self._buckets:
+            bucket, device_ids = next(iter(self._buckets.items()))
+            if bucket > oldest:
+                break
+            self._buckets.popitem(last=False)
+            for device_id in device_ids:
+                self._remove(device_id)
+
+    def _remove(self, device_id: int):
+        """移除设备（不处理时间桶，调用方持有锁）"""
+        entry = self._devices.pop(device_id, None)
+        if entry is None:
+            return None
+        subscription_devices = self._subscriptions.get(entry[1])
+        if subscription_devices is not None:
+            subscription_devices.discard(device_id)
+            if not subscription_devices:
+                del self._subscriptions[entry[1]]
+        return entry
+
+    def touch(self, device_id: int, subscription_id: int, timestamp: Optional[float] = None):
+        """记录设备访问"""
+        now = time.time()
+        timestamp = now if timestamp is None else timestamp
+        bucket = self._bucket(timestamp)
+        with self._lock:
+            entry = self._devices.get(device_id)
+            if entry is not None:
+                if entry[0] >= bucket:
+                    return
+                old_bucket = self._buckets.get(entry[0])
+                if old_bucket is not None:
+                    old_bucket.discard(device_id)
+                if entry[1] != subscription_id:
+                    self._remove(device_id)
+
+            self._devices[device_id] = (bucket, subscription_id)
+            self._subscriptions.setdefault(subscription_id, set()).add(device_id)
+            if bucket not in self._buckets:
+                newest = next(reversed(self._buckets), None)
+                self._buckets[bucket] = set()
+                if newest is not None and bucket < newest:
+                    # 预加载的历史访问早于已有时间桶时重新排序（只在启动加载时出现）
+                    self._buckets = OrderedDict(sorted(self._buckets.items()))
+            self._buckets[bucket].add(device_id)
+            self._expire(now)
+
+    def forget(self, device_ids: Iterable[int]):
+        """移除已删除的设备"""
+        with self._lock:
+            for device_id in device_ids:
+                entry = self._remove(device_id)
+                if entry is not None and entry[0] in self._buckets:
+                    self._buckets[entry[0]].discard(device_id)
+
+    def retain(self, subscription_id: int, device_ids: Iterable[int]):
+        """只保留订阅下仍存在的设备（删除/清空设备后调用）"""
+        existing = set(device_ids)
+        with self._lock:
+            stale = [device_id for device_id in self._subscriptions.get(subscription_id, ()) if device_id not in existing]
+        if stale:
+            self.forget(stale)
+
+    def is_online(self, device_id: int) -> bool:
+        """设备是否在线"""
+        with self._lock:
+            self._expire(time.time())
+            return device_id in self._devices
+
+    def online_count(self) -> int:
+        """全局在线设备数"""
+        with self._lock:
+            self._expire(time.time())
+            return len(self._devices)
+
+    def online_count_for(self, subscription_id: int) -> int:
+        """单个订阅的在线设备数"""
+        with self._lock:
+            self._expire(time.time())
+            return len(self._subscriptions.get(subscription_id, ()))
+
+    def online_counts(self, subscription_ids: Optional[Iterable[int]] = None) -> Dict[int, int]:
+        """批量读取订阅的在线设备数（不传订阅ID时返回全部有在线设备的订阅）"""
+        with self._lock:
+            self._expire(time.time())
+            if subscription_ids is None:
+                return {subscription_id: len(devices) for subscription_id, devices in self._subscriptions.items()}
+            return {
+                subscription_id: len(self._subscriptions[subscription_id])
+                for subscription_id in subscription_ids
+                if subscription_id in self._subscriptions
+            }
+
+    def load_recent(self, db) -> int:
+        """启动时从devices表加载时间窗口内访问过的设备，返回加载的设备数
+
+        last_seen按UTC写入（CURRENT_TIMESTAMP或datetime.utcnow()），查询参数由Python计算，不依赖数据库时间函数
+        """
+        utc_now = datetime.utcnow()
+        rows = db.execute(text("""
+            SELECT id, subscription_id, last_seen FROM devices
+            WHERE last_seen >= :cutoff
+        """), {'cutoff': utc_now - timedelta(seconds=self.window)}).fetchall()
+
+        now = time.time()
+        loaded = 0
+        for row in sorted(rows, key=lambda row: str(row.last_seen)):
+            last_seen = row.last_seen
+            if isinstance(last_seen, str):
+                try:
+                    last_seen = datetime.fromisoformat(last_seen)
+                except ValueError:
+                    continue
+            if last_seen.tzinfo is not None:
+                last_seen = last_seen.astimezone(timezone.utc).replace(tzinfo=None)
+            age = (utc_now - last_seen).total_seconds()
+            if 0 <= age < self.window:
+                self.touch(row.id, row.subscription_id, now - age)
+                loaded += 1
+        return loaded
+
+    def stats(self) -> dict:
+        """在线状态统计信息"""
+        with self._lock:
+            self._expire(time.time())
+            return {
+                'online_devices': len(self._devices),
+                'online_subscriptions': len(self._subscriptions),
+                'buckets': len(self._buckets)
+            }
+
+
+# 全局设备在线状态实例
+device_presence = DevicePresence()
+
+
+def get_device_presence() -> DevicePresence:
+    """获取设备在线状态实例"""
+    return device_presence
@@ -0,0 +1,113 @@
+"""
+节点解析结果缓存
+以节点链接（及解析方式）的哈希为键，将解析得到的Clash代理配置保存在本地sqlite文件中，
+重启后仍然有效；多次更新之间内容未变化的节点链接无需重新解析
+"""
+
+import hashlib
+import json
+import logging
+import sqlite3
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class NodeParseCache:
+    """节点解析结果的磁盘缓存，超出容量时淘汰最久未使用的条目"""
+
+    def __init__(self, path: str, max_entries: int = 50000):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS node_parse_cache (
+                key TEXT PRIMARY KEY,
+                proxy TEXT,
+                last_used REAL NOT NULL
+            )
+        """)
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS ix_node_parse_cache_last_used ON node_parse_cache (last_used)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(node_url: str, mode: str, fingerprint: str = "") -> str:
+        """生成缓存键：解析方式、过滤关键字等参数不同时解析结果也不同"""
+        raw = f"{mode}\0{fingerprint}\0{node_url}"
+        return hashlib.sha256(raw.encode('utf-8', errors='surrogatepass')).hexdigest()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """批量读取缓存，返回命中的 key -> 解析结果（解析失败的节点结果为None）"""
+        keys = list(dict.fromkeys(keys))
+        found = {}
+        # sqlite单条语句的参数数量有限，分批查询
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            placeholders = ','.join('?' * len(batch))
+            rows = self._conn.execute(
+                f"SELECT key, proxy FROM node_parse_cache WHERE key IN ({placeholders})", batch
+            ).fetchall()
+            for key, proxy in rows:
+                found[key] = json.loads(proxy) if proxy is not None else None
+
+        if found:
+            now = time.time()
+            self._conn.executemany(
+                "UPDATE node_parse_cache SET last_used = ? WHERE key = ?",
+                [(now, key) for key in found]
+            )
+            self._conn.commit()
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def set_many(self, items: List[Tuple[str, Optional[Dict[str, Any]]]]):
+        """批量写入解析结果，并按容量淘汰旧条目"""
+        now = time.time()
+        rows = []
+        for key, proxy in items:
+            try:
+                rows.append((key, json.dumps(proxy, ensure_ascii=False) if proxy is not None else None, now))
+            except (TypeError, ValueError):
+                # 无法序列化的结果不缓存
+                continue
+
+        if rows:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO node_parse_cache (key, proxy, last_used) VALUES (?, ?, ?)", rows
+            )
+        self._evict()
+        self._conn.commit()
+
+    def _evict(self):
+        """删除超出容量的最久未使用条目"""
+        count = self._conn.execute("SELECT COUNT(*) FROM node_parse_cache").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute("""
+                DELETE FROM node_parse_cache WHERE key IN (
+                    SELECT key FROM node_parse_cache ORDER BY last_used LIMIT ?
+                )
+            """, (overflow,))
+
+    def close(self):
+        """关闭数据库连接"""
+        try:
+            self._conn.close()
+        except Exception as e:
+            logger.warning(f"关闭节点解析缓存失败: {e}")
+
+    def stats(self) -> dict:
+        """缓存统计信息"""
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / total * 100) if total > 0 else 0
+        }
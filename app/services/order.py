@@ -9,6 +9,7 @@ from app.models.user import User
 from app.models.payment_config import PaymentConfig
 from app.schemas.order import OrderCreate, OrderUpdate
 from app.utils.security import generate_order_no
+from app.utils.timeseries import day_range, fill_daily_series
 
 class OrderService:
     def __init__(self, db: Session):
@@ -244,6 +245,20 @@ class OrderService:
         result = query.scalar()
         return float(result) if result else 0.0
 
+    def get_revenue_trend(self, start_date: datetime, end_date: datetime) -> List[dict]:
+        """按天统计已支付订单收入（一次按日期分组查询，没有收入的日期补0）"""
+        range_start, range_end = day_range(start_date, end_date)
+        day = func.date(Order.created_at)
+        rows = self.db.query(day, func.sum(Order.amount)).filter(
+            Order.status == "paid",
+            Order.created_at >= range_start,
+            Order.created_at < range_end
+        ).group_by(day).all()
+        return [
+            {"date": item["date"], "revenue": float(item["value"] or 0)}
+            for item in fill_daily_series(rows, start_date, end_date)
+        ]
+
     def get_total_revenue(self) -> float:
         """获取总收入"""
         result = self.db.query(func.sum(Order.amount)).filter(
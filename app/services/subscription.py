@@ -1,20 +1,47 @@
 from datetime import datetime, timedelta
-from typing import Optional, List, Tuple
-from sqlalchemy.orm import Session
-from sqlalchemy import func, and_, or_
+from typing import Optional, List, Tuple, Dict
+from sqlalchemy.orm import Session, contains_eager
+from sqlalchemy import func, and_, or_, case, bindparam
 import secrets
 import string
 import yaml
 import base64
 from pathlib import Path
 
-from app.models.subscription import Subscription, Device
+from app.models.subscription import Subscription, Device, SubscriptionDeviceCounter
 from app.models.user import User
 from app.models.node import Node
 from app.models.user_activity import SubscriptionReset
 from app.schemas.subscription import SubscriptionCreate, SubscriptionUpdate
+from app.services.device_counters import delete_device_counters, get_device_counters, refresh_device_counters
+from app.services.device_presence import device_presence
+from app.services.subscription_cache import (
+    CONFIG_VERSION_QUERY, subscription_config_cache, subscription_key_cache, build_placeholder_entry
+)
 from app.utils.security import generate_subscription_url
 
+# 管理后台订阅列表中读取设备计数表的统计字段（online_devices由device_presence提供）
+DEVICE_STAT_FIELDS = ('device_count', 'apple_count', 'clash_count', 'v2ray_count')
+
+# 管理后台订阅列表的排序方式 -> (排序字段, 是否降序)
+SUBSCRIPTION_SORTS = {
+    'add_time_desc': ('created_at', True),
+    'add_time_asc': ('created_at', False),
+    'expire_time_desc': ('expire_time', True),
+    'expire_time_asc': ('expire_time', False),
+    'device_limit_desc': ('device_limit', True),
+    'device_limit_asc': ('device_limit', False),
+    'device_count_desc': ('device_count', True),
+    'device_count_asc': ('device_count', False),
+    'apple_count_desc': ('apple_count', True),
+    'apple_count_asc': ('apple_count', False),
+    'online_devices_desc': ('online_devices', True),
+    'online_devices_asc': ('online_devices', False),
+}
+
+# 订阅下载端点读取配置内容的查询
+CONFIG_ENTRY_QUERY = 'SELECT value, COALESCE(updated_at, created_at) AS updated_at FROM system_configs WHERE "key" = :key AND type = :type'
+
 class SubscriptionService:
     def __init__(self, db: Session):
         self.db = db
@@ -27,6 +54,33 @@ class SubscriptionService:
         """根据用户ID获取订阅"""
         return self.db.query(Subscription).filter(Subscription.user_id == user_id).first()
     
+    def get_by_user_ids(self, user_ids: List[int]) -> Dict[int, Subscription]:
+        """批量获取多个用户的订阅（用户ID -> 订阅，每个用户取ID最小的一条）"""
+        if not user_ids:
+            return {}
+        
+        subscriptions = {}
+        query = self.db.query(Subscription).filter(Subscription.user_id.in_(user_ids)).order_by(Subscription.id)
+        for subscription in query:
+            subscriptions.setdefault(subscription.user_id, subscription)
+        return subscriptions
+    
+    def get_device_counts(self, subscription_ids: List[int]) -> Dict[int, Tuple[int, int]]:
+        """批量统计订阅的设备数（订阅ID -> (设备总数, 最近5分钟内访问过的在线设备数)）
+        
+        设备总数读取设备计数表，在线设备数读取内存中的设备在线状态
+        """
+        if not subscription_ids:
+            return {}
+        
+        counters = get_device_counters(self.db, subscription_ids)
+        online_counts = device_presence.online_counts(subscription_ids)
+        
+        return {
+            subscription_id: (counters.get(subscription_id, {}).get('total_devices', 0), online_counts.get(subscription_id, 0))
+            for subscription_id in set(counters) | set(online_counts)
+        }
+    
     def get_all_by_user_id(self, user_id: int) -> List[Subscription]:
         """根据用户ID获取所有订阅"""
         return self.db.query(Subscription).filter(Subscription.user_id == user_id).all()
@@ -64,6 +118,7 @@ class SubscriptionService:
             setattr(subscription, field, value)
         
         self.db.commit()
+        subscription_key_cache.invalidate(subscription_id)
         self.db.refresh(subscription)
         return subscription
 
@@ -78,6 +133,7 @@ class SubscriptionService:
         
         subscription.subscription_url = new_key
         self.db.commit()
+        subscription_key_cache.invalidate(subscription_id)
         return True
 
     def delete(self, subscription_id: int) -> bool:
@@ -86,8 +142,10 @@ class SubscriptionService:
         if not subscription:
             return False
         
+        delete_device_counters(self.db, [subscription_id])
         self.db.delete(subscription)
         self.db.commit()
+        subscription_key_cache.invalidate(subscription_id)
         return True
 
     def get_devices_by_subscription_id(self, subscription_id: int) -> List[Device]:
@@ -159,6 +217,7 @@ class SubscriptionService:
             return False
         
         self.db.delete(device)
+        refresh_device_counters(self.db, device.subscription_id)
         self.db.commit()
         return True
 
@@ -167,6 +226,7 @@ class SubscriptionService:
         devices = self.get_devices_by_subscription_id(subscription_id)
         for device in devices:
             self.db.delete(device)
+        refresh_device_counters(self.db, subscription_id)
         self.db.commit()
         return True
 
@@ -212,8 +272,8 @@ class SubscriptionService:
             "active_rate": (active / total * 100) if total > 0 else 0
         }
 
-    def get_subscriptions_with_pagination(self, skip: int = 0, limit: int = 20, search: str = None, status: str = None) -> Tuple[List[Subscription], int]:
-        """获取订阅列表（分页）"""
+    def _subscription_list_query(self, search: str = None, status: str = None):
+        """构建管理后台订阅列表的查询（关联用户，应用状态和搜索条件）"""
         # 使用join查询来获取用户信息
         query = self.db.query(Subscription).join(User, Subscription.user_id == User.id)
         
@@ -238,9 +298,87 @@ class SubscriptionService:
             )
             query = query.filter(search_filter)
         
+        return query
+    
+    def get_subscriptions_with_pagination(self, skip: int = 0, limit: int = 20, search: str = None, status: str = None) -> Tuple[List[Subscription], int]:
+        """获取订阅列表（分页）"""
+        query = self._subscription_list_query(search, status)
         total = query.count()
         subscriptions = query.offset(skip).limit(limit).all()
         return subscriptions, total
+    
+    def _device_stats_query(self):
+        """按订阅的设备统计查询（读取设备计数表，在线设备数由device_presence提供）"""
+        return self.db.query(
+            SubscriptionDeviceCounter.subscription_id.label('subscription_id'),
+            SubscriptionDeviceCounter.total_devices.label('device_count'),
+            SubscriptionDeviceCounter.apple_devices.label('apple_count'),
+            SubscriptionDeviceCounter.clash_devices.label('clash_count'),
+            SubscriptionDeviceCounter.v2ray_devices.label('v2ray_count')
+        )
+    
+    def _online_devices_column(self):
+        """在线设备数的排序表达式（按在线设备数分组的订阅ID IN列表，没有在线设备时返回None）
+        
+        订阅ID为整数，直接内联到SQL中，不受数据库绑定参数个数的限制
+        """
+        subscriptions_by_count = {}
+        for subscription_id, online in device_presence.online_counts().items():
+            subscriptions_by_count.setdefault(online, []).append(subscription_id)
+        if not subscriptions_by_count:
+            return None
+        
+        return case(
+            *[
+                (Subscription.id.in_(bindparam(f'online_{online}', sorted(subscription_ids), expanding=True, literal_execute=True)), online)
+                for online, subscription_ids in sorted(subscriptions_by_count.items())
+            ],
+            else_=0
+        )
+    
+    def get_subscriptions_with_device_stats(self, skip: int = 0, limit: int = 20, search: str = None,
+                                            status: str = None, sort: str = None) -> Tuple[List[Subscription], Dict[int, Dict[str, int]], int]:
+        """获取订阅列表（分页），同时返回设备统计
+        
+        按设备计数排序时在数据库中关联设备计数表；在线设备数只在内存中，
+        按在线设备数排序时将其转换为CASE表达式，同样在数据库中排序和分页
+        """
+        query = self._subscription_list_query(search, status).options(contains_eager(Subscription.user))
+        total = query.count()
+        
+        sort_field, descending = SUBSCRIPTION_SORTS.get(sort, (None, False))
+        if sort_field == 'online_devices':
+            sort_column = self._online_devices_column()
+        elif sort_field in DEVICE_STAT_FIELDS:
+            stats_subquery = self._device_stats_query().subquery()
+            query = query.outerjoin(stats_subquery, stats_subquery.c.subscription_id == Subscription.id)
+            sort_column = func.coalesce(stats_subquery.c[sort_field], 0)
+        elif sort_field:
+            sort_column = getattr(Subscription, sort_field)
+        else:
+            sort_column = None
+        
+        if sort_column is not None:
+            query = query.order_by(sort_column.desc() if descending else sort_column.asc(), Subscription.id)
+        elif sort_field:
+            # 没有在线设备时只按订阅ID排序
+            query = query.order_by(Subscription.id)
+        subscriptions = query.offset(skip).limit(limit).all()
+        
+        device_stats = {}
+        if subscriptions:
+            subscription_ids = [subscription.id for subscription in subscriptions]
+            stats_rows = self._device_stats_query().filter(
+                SubscriptionDeviceCounter.subscription_id.in_(subscription_ids)
+            ).all()
+            device_stats = {
+                row.subscription_id: {field: getattr(row, field) or 0 for field in DEVICE_STAT_FIELDS}
+                for row in stats_rows
+            }
+            for subscription_id, online in device_presence.online_counts(subscription_ids).items():
+                device_stats.setdefault(subscription_id, {})['online_devices'] = online
+        
+        return subscriptions, device_stats, total
 
     # 新增方法：重置订阅
     def reset_subscription(self, subscription_id: int, user_id: int, reset_type: str = "manual", reason: str = None) -> bool:
@@ -264,6 +402,7 @@ class SubscriptionService:
         subscription.current_devices = 0
         
         self.db.commit()
+        subscription_key_cache.invalidate(subscription_id)
         
         # 记录订阅重置操作
         reset_record = SubscriptionReset(
@@ -475,6 +614,10 @@ class SubscriptionService:
         """统计活跃订阅数量"""
         return self.db.query(Subscription).filter(Subscription.is_active == True).count()
     
+    def count_online_devices(self) -> int:
+        """统计在线设备数量（最近5分钟内访问过订阅的设备）"""
+        return device_presence.online_count()
+    
     def count_expiring_soon(self, days: int = 7) -> int:
         """统计即将过期的订阅数量"""
         from datetime import datetime, timedelta
@@ -528,27 +671,29 @@ class SubscriptionService:
     
     def get_invalid_clash_config(self) -> str:
         """获取失效的Clash配置"""
-        from sqlalchemy import text
-        query = text('SELECT value FROM system_configs WHERE "key" = \'clash_config_invalid\' AND type = \'clash_invalid\'')
-        result = self.db.execute(query).first()
-        
-        if result:
-            return result.value
+        return self.get_invalid_clash_config_entry()['content']
+    
+    def get_invalid_clash_config_entry(self) -> dict:
+        """获取失效的Clash配置缓存条目（含ETag信息）"""
+        entry = self._get_cached_config_entry('clash_config_invalid', 'clash_invalid')
+        if entry is not None:
+            return entry
         
         # 返回默认失效配置
-        return self._get_default_invalid_clash_config_str()
+        return build_placeholder_entry(self._get_default_invalid_clash_config_str())
     
     def get_invalid_v2ray_config(self) -> str:
         """获取失效的V2Ray配置"""
-        from sqlalchemy import text
-        query = text('SELECT value FROM system_configs WHERE "key" = \'v2ray_config_invalid\' AND type = \'v2ray_invalid\'')
-        result = self.db.execute(query).first()
-        
-        if result:
-            return result.value
+        return self.get_invalid_v2ray_config_entry()['content']
+    
+    def get_invalid_v2ray_config_entry(self) -> dict:
+        """获取失效的V2Ray配置缓存条目（含ETag信息）"""
+        entry = self._get_cached_config_entry('v2ray_config_invalid', 'v2ray_invalid')
+        if entry is not None:
+            return entry
         
         # 返回默认失效配置
-        return self._get_default_invalid_v2ray_config_str()
+        return build_placeholder_entry(self._get_default_invalid_v2ray_config_str())
     
     def _generate_v2ray_inbound_config(self, node: Node, subscription: Subscription) -> dict:
         """生成V2Ray入站配置"""
@@ -670,37 +815,55 @@ rules:
   }
 }"""
     
+    def _get_cached_config_entry(self, key: str, config_type: str) -> Optional[dict]:
+        """从缓存获取system_configs中的配置条目，未命中时查询数据库"""
+        from sqlalchemy import text
+
+        def load() -> Optional[tuple]:
+            result = self.db.execute(text(CONFIG_ENTRY_QUERY), {'key': key, 'type': config_type}).first()
+            if result is None or result.value is None:
+                return None
+            return result.value, result.updated_at
+
+        def load_version() -> Optional[str]:
+            return self.db.execute(text(CONFIG_VERSION_QUERY)).scalar()
+
+        subscription_config_cache.sync_published_version(load_version)
+        return subscription_config_cache.get_entry(key, load)
+    
     def get_v2ray_config(self) -> str:
         """获取数据库中的V2Ray配置文件内容"""
+        return self.get_v2ray_config_entry()['content']
+    
+    def get_v2ray_config_entry(self) -> dict:
+        """获取V2Ray配置缓存条目（含ETag信息）"""
         try:
-            # 从系统配置中获取V2Ray配置
-            from sqlalchemy import text
-            query = text('SELECT value FROM system_configs WHERE "key" = \'v2ray_config\' AND type = \'v2ray\'')
-            result = self.db.execute(query).first()
-            
-            if result:
-                return result.value
+            # 从系统配置中获取V2Ray配置（优先使用进程内缓存）
+            entry = self._get_cached_config_entry('v2ray_config', 'v2ray')
+            if entry is not None:
+                return entry
             else:
                 # 如果没有配置，返回默认的无效配置
-                return "# V2Ray配置未设置\n# 请联系管理员配置V2Ray节点信息"
+                return build_placeholder_entry("# V2Ray配置未设置\n# 请联系管理员配置V2Ray节点信息")
         except Exception as e:
-            return f"# V2Ray配置加载失败: {str(e)}"
+            return build_placeholder_entry(f"# V2Ray配置加载失败: {str(e)}")
     
     def get_clash_config(self) -> str:
         """获取数据库中的Clash配置文件内容"""
+        return self.get_clash_config_entry()['content']
+    
+    def get_clash_config_entry(self) -> dict:
+        """获取Clash配置缓存条目（含ETag信息）"""
         try:
-            # 从系统配置中获取Clash配置
-            from sqlalchemy import text
-            query = text('SELECT value FROM system_configs WHERE "key" = \'clash_config\' AND type = \'clash\'')
-            result = self.db.execute(query).first()
-            
-            if result:
-                return result.value
+            # 从系统配置中获取Clash配置（优先使用进程内缓存）
+            entry = self._get_cached_config_entry('clash_config', 'clash')
+            if entry is not None:
+                return entry
             else:
                 # 如果没有配置，返回默认的无效配置
-                return "# Clash配置未设置\n# 请联系管理员配置Clash节点信息"
+                return build_placeholder_entry("# Clash配置未设置\n# 请联系管理员配置Clash节点信息")
         except Exception as e:
-            return f"# Clash配置加载失败: {str(e)}"
+            return build_placeholder_entry(f"# Clash配置加载失败: {str(e)}")
     
     def send_subscription_email(self, user_id: int) -> bool:
         """发送订阅邮件给用户"""
@@ -795,4 +958,66 @@ rules:
             print(f"发送订阅邮件失败: {e}")
             import traceback
             traceback.print_exc()
-            return False 
\ No newline at end of file
+            return False 
+
+
+class AsyncSubscriptionService(SubscriptionService):
+    """订阅下载端点使用的异步服务，只提供配置内容读取（db为AsyncSession）"""
+    
+    async def _get_cached_config_entry(self, key: str, config_type: str) -> Optional[dict]:
+        """从缓存获取system_configs中的配置条目，未命中时异步查询数据库"""
+        from sqlalchemy import text
+
+        async def load() -> Optional[tuple]:
+            result = (await self.db.execute(text(CONFIG_ENTRY_QUERY), {'key': key, 'type': config_type})).first()
+            if result is None or result.value is None:
+                return None
+            return result.value, result.updated_at
+
+        async def load_version() -> Optional[str]:
+            return (await self.db.execute(text(CONFIG_VERSION_QUERY))).scalar()
+
+        await subscription_config_cache.sync_published_version_async(load_version)
+        return await subscription_config_cache.get_entry_async(key, load)
+    
+    async def get_v2ray_config_entry(self) -> dict:
+        """获取V2Ray配置缓存条目（含ETag信息）"""
+        try:
+            entry = await self._get_cached_config_entry('v2ray_config', 'v2ray')
+            if entry is not None:
+                return entry
+            return build_placeholder_entry("# V2Ray配置未设置\n# 请联系管理员配置V2Ray节点信息")
+        except Exception as e:
+            return build_placeholder_entry(f"# V2Ray配置加载失败: {str(e)}")
+    
+    async def get_clash_config_entry(self) -> dict:
+        """获取Clash配置缓存条目（含ETag信息）"""
+        try:
+            entry = await self._get_cached_config_entry('clash_config', 'clash')
+            if entry is not None:
+                return entry
+            return build_placeholder_entry("# Clash配置未设置\n# 请联系管理员配置Clash节点信息")
+        except Exception as e:
+            return build_placeholder_entry(f"# Clash配置加载失败: {str(e)}")
+    
+    async def get_invalid_v2ray_config(self) -> str:
+        """获取失效的V2Ray配置"""
+        try:
+            entry = await self._get_cached_config_entry('v2ray_config_invalid', 'v2ray_invalid')
+        except Exception as e:
+            print(f"获取失效V2Ray配置失败: {e}")
+            entry = None
+        if entry is not None:
+            return entry['content']
+        return self._get_default_invalid_v2ray_config_str()
+    
+    async def get_invalid_clash_config(self) -> str:
+        """获取失效的Clash配置"""
+        try:
+            entry = await self._get_cached_config_entry('clash_config_invalid', 'clash_invalid')
+        except Exception as e:
+            print(f"获取失效Clash配置失败: {e}")
+            entry = None
+        if entry is not None:
+            return entry['content']
+        return self._get_default_invalid_clash_config_str()
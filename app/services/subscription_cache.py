@@ -0,0 +1,322 @@
+"""
+订阅内容缓存
+进程内缓存订阅下载端点使用的配置内容，避免每次客户端刷新都从数据库读取大体积配置；
+同时缓存订阅地址对应的订阅记录，避免每次访问都查询subscriptions⨝users
+"""
+
+import asyncio
+import gzip
+import hashlib
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+
+from sqlalchemy import text
+
+from app.utils.cache import LRUCache
+
+try:
+    import brotli
+except ImportError:  # brotli为可选依赖，未安装时只提供gzip
+    brotli = None
+
+# 小于该大小的内容不压缩
+MIN_COMPRESS_SIZE = 1024
+
+# 压缩级别：最高级别对数MB的配置耗时数百毫秒，压缩率提升有限
+GZIP_COMPRESS_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# 配置版本号：每次发布订阅配置时与配置内容在同一事务中更新，
+# 各进程定期检查该值，变化时使本地缓存失效
+CONFIG_VERSION_QUERY = 'SELECT value FROM system_configs WHERE "key" = \'config_version\' AND type = \'config\''
+UPDATE_CONFIG_VERSION_QUERY = """
+    UPDATE system_configs SET value = :value, updated_at = :updated_at
+    WHERE "key" = 'config_version' AND type = 'config'
+"""
+INSERT_CONFIG_VERSION_QUERY = """
+    INSERT INTO system_configs ("key", value, type, category, display_name, description, is_public, sort_order, created_at, updated_at)
+    VALUES ('config_version', :value, 'config', 'proxy', '订阅配置版本', '订阅配置发布版本号（自动维护）', 0, 0, :updated_at, :updated_at)
+"""
+
+
+def _parse_updated_at(value: Any) -> Optional[datetime]:
+    """解析数据库返回的更新时间（SQLite原生查询返回字符串）"""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if value.tzinfo is None:
+        # 配置保存时使用的是本地时间
+        value = value.astimezone()
+    return value.astimezone(timezone.utc)
+
+
+def build_config_entry(content: str, updated_at: Any = None, version: int = 0) -> Dict[str, Any]:
+    """构建缓存条目，内容哈希在此计算一次，供ETag复用"""
+    return {
+        'content': content,
+        'etag': hashlib.sha256(content.encode('utf-8')).hexdigest(),
+        'last_modified': _parse_updated_at(updated_at),
+        'version': version,
+        'loaded_at': time.time(),
+        'encoded': {},
+        # 同一条目的并发请求只压缩一次
+        'encode_lock': threading.Lock()
+    }
+
+
+def build_placeholder_entry(content: str) -> Dict[str, Any]:
+    """构建占位内容（配置未设置、加载失败等）的条目：不带ETag/Last-Modified，不写入缓存，
+    避免客户端缓存占位内容后在配置恢复前一直收到304"""
+    entry = build_config_entry(content)
+    entry['etag'] = None
+    return entry
+
+
+def supported_encodings() -> Tuple[str, ...]:
+    """服务端支持的压缩编码（按优先级排序）"""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def _compress(raw: bytes, encoding: str) -> Optional[bytes]:
+    """按编码压缩内容，不支持的编码或内容过小时返回None"""
+    if len(raw) < MIN_COMPRESS_SIZE:
+        return None
+    if encoding == 'gzip':
+        return gzip.compress(raw, compresslevel=GZIP_COMPRESS_LEVEL, mtime=0)
+    if encoding == 'br' and brotli is not None:
+        return brotli.compress(raw, mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+    return None
+
+
+def is_encoded(entry: Dict[str, Any], encoding: str) -> bool:
+    """条目是否已生成该编码的压缩内容"""
+    return encoding in entry['encoded']
+
+
+def get_encoded_content(entry: Dict[str, Any], encoding: str) -> Optional[bytes]:
+    """获取条目的压缩内容，每个配置版本只压缩一次（并发请求等待同一次压缩）"""
+    encoded = entry['encoded']
+    if encoding in encoded:
+        return encoded[encoding]
+
+    with entry['encode_lock']:
+        if encoding not in encoded:
+            encoded[encoding] = _compress(entry['content'].encode('utf-8'), encoding)
+        return encoded[encoding]
+
+
+async def get_encoded_content_async(entry: Dict[str, Any], encoding: str) -> Optional[bytes]:
+    """异步端点使用：压缩版本尚未生成时在线程池中压缩，不阻塞事件循环"""
+    if is_encoded(entry, encoding):
+        return entry['encoded'][encoding]
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, get_encoded_content, entry, encoding)
+
+
+def precompress_entry(entry: Optional[Dict[str, Any]]):
+    """预先生成所有支持的压缩版本"""
+    if not entry:
+        return
+    for encoding in supported_encodings():
+        get_encoded_content(entry, encoding)
+
+
+class SubscriptionConfigCache:
+    """订阅配置内容缓存（按配置键缓存，带版本号）"""
+
+    def __init__(self, ttl: int = 60, version_check_interval: int = 5):
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict[str, Any]] = {}
+        self._version = 0
+        # 多进程部署时其他进程无法收到失效通知，定期检查数据库中的配置版本号，并依靠TTL兜底刷新
+        self._ttl = ttl
+        self._version_check_interval = version_check_interval
+        self._published_version: Optional[str] = None
+        self._version_checked_at = 0.0
+
+    @property
+    def version(self) -> int:
+        """当前缓存版本号，每次失效时递增"""
+        return self._version
+
+    def _get_fresh(self, key: str, now: float) -> Optional[Dict[str, Any]]:
+        """返回未过期的缓存记录"""
+        entry = self._entries.get(key)
+        if entry and entry['version'] == self._version and now - entry['loaded_at'] < self._ttl:
+            return entry
+        return None
+
+    def _store(self, key: str, version: int, now: float, loaded: Optional[Tuple[str, Any]]) -> Optional[Dict[str, Any]]:
+        """写入加载结果并返回缓存条目（配置不存在时不缓存，调用方返回占位内容）"""
+        if not loaded:
+            return None
+        config_entry = build_config_entry(loaded[0], loaded[1], version)
+        entry = self._entries.get(key)
+        if entry and entry['entry']['etag'] == config_entry['etag']:
+            # 内容未变化时沿用旧条目，保留已生成的压缩版本
+            config_entry = entry['entry']
+
+        with self._lock:
+            if version == self._version:
+                self._entries[key] = {
+                    'entry': config_entry,
+                    'version': version,
+                    'loaded_at': now
+                }
+        return config_entry
+
+    def get_entry(self, key: str, loader: Callable[[], Optional[Tuple[str, Any]]]) -> Optional[Dict[str, Any]]:
+        """获取配置缓存条目，未命中或已过期时通过loader加载 (content, updated_at)"""
+        now = time.time()
+        entry = self._get_fresh(key, now)
+        if entry:
+            return entry['entry']
+
+        # 记录加载前的版本，加载期间发生失效则不写入缓存
+        version = self._version
+        return self._store(key, version, now, loader())
+
+    async def get_entry_async(self, key: str, loader: Callable[[], Awaitable[Optional[Tuple[str, Any]]]]) -> Optional[Dict[str, Any]]:
+        """异步版本的get_entry，loader为协程函数"""
+        now = time.time()
+        entry = self._get_fresh(key, now)
+        if entry:
+            return entry['entry']
+
+        version = self._version
+        return self._store(key, version, now, await loader())
+
+    def _version_check_due(self) -> bool:
+        """是否需要检查数据库中的配置版本号"""
+        now = time.time()
+        with self._lock:
+            if now - self._version_checked_at < self._version_check_interval:
+                return False
+            self._version_checked_at = now
+            return True
+
+    def _apply_published_version(self, published_version: Optional[str]):
+        """配置版本号与上次检查时不同则使缓存失效"""
+        if published_version != self._published_version:
+            self._published_version = published_version
+            self.invalidate()
+
+    def sync_published_version(self, loader: Callable[[], Optional[str]]):
+        """定期通过loader读取配置版本号，其他进程发布新配置后使本进程缓存失效"""
+        if self._version_check_due():
+            self._apply_published_version(loader())
+
+    async def sync_published_version_async(self, loader: Callable[[], Awaitable[Optional[str]]]):
+        """异步版本的sync_published_version，loader为协程函数"""
+        if self._version_check_due():
+            self._apply_published_version(await loader())
+
+    def get(self, key: str, loader: Callable[[], Optional[Tuple[str, Any]]]) -> Optional[str]:
+        """获取配置内容"""
+        entry = self.get_entry(key, loader)
+        return entry['content'] if entry else None
+
+    def invalidate(self):
+        """使全部缓存失效（配置保存后调用）"""
+        with self._lock:
+            self._version += 1
+            self._entries.clear()
+
+
+class SubscriptionRecord(NamedTuple):
+    """订阅访问检查所需的订阅信息"""
+    id: int
+    user_id: int
+    device_limit: int
+    expire_time: Any
+    is_active: bool
+    username: str
+    email: str
+
+    @classmethod
+    def from_row(cls, row: Any) -> "SubscriptionRecord":
+        return cls(row.id, row.user_id, row.device_limit, row.expire_time,
+                   row.is_active, row.username, row.email)
+
+
+class SubscriptionKeyCache:
+    """订阅地址 -> 订阅记录缓存（TTL+LRU）"""
+
+    def __init__(self, maxsize: int = 10000, ttl: int = 60):
+        # 其他进程修改订阅时收不到失效通知，依靠TTL兜底
+        self._records = LRUCache(maxsize=maxsize, ttl=ttl)
+        self._keys_by_id: Dict[int, str] = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    @property
+    def generation(self) -> int:
+        """失效计数，查询数据库前记录，写入时用于判断期间是否发生过失效"""
+        return self._generation
+
+    def get(self, subscription_url: str) -> Optional[SubscriptionRecord]:
+        """获取缓存的订阅记录"""
+        return self._records.get(subscription_url)
+
+    def set(self, subscription_url: str, record: SubscriptionRecord, generation: int):
+        """写入订阅记录，查询期间发生过失效则放弃写入"""
+        with self._lock:
+            if generation != self._generation:
+                return
+            old_key = self._keys_by_id.get(record.id)
+            if old_key and old_key != subscription_url:
+                self._records.pop(old_key)
+            self._keys_by_id[record.id] = subscription_url
+            self._records.set(subscription_url, record)
+
+    def invalidate(self, subscription_id: int):
+        """订阅信息（地址、到期时间、设备限制等）变更后调用"""
+        with self._lock:
+            self._generation += 1
+            subscription_url = self._keys_by_id.pop(subscription_id, None)
+            if subscription_url:
+                self._records.pop(subscription_url)
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._generation += 1
+            self._keys_by_id.clear()
+            self._records.clear()
+
+    def stats(self) -> dict:
+        """缓存统计信息"""
+        return self._records.stats()
+
+
+def bump_config_version(db: Any, updated_at: Any = None) -> str:
+    """更新配置版本号（不提交），需与配置内容的修改在同一事务中执行"""
+    value = uuid.uuid4().hex
+    params = {'value': value, 'updated_at': updated_at or datetime.now()}
+    if db.execute(text(UPDATE_CONFIG_VERSION_QUERY), params).rowcount == 0:
+        db.execute(text(INSERT_CONFIG_VERSION_QUERY), params)
+    return value
+
+
+# 全局订阅配置缓存实例
+subscription_config_cache = SubscriptionConfigCache()
+
+# 全局订阅地址缓存实例
+subscription_key_cache = SubscriptionKeyCache()
+
+
+def get_subscription_config_cache() -> SubscriptionConfigCache:
+    """获取订阅配置缓存实例"""
+    return subscription_config_cache
+
+
+def get_subscription_key_cache() -> SubscriptionKeyCache:
+    """获取订阅地址缓存实例"""
+    return subscription_key_cache
@@ -7,6 +7,7 @@ from app.models.user import User
 from app.models.subscription import Subscription
 from app.models.package import Package
 from app.models.order import Order
+from app.services.subscription_cache import subscription_key_cache
 
 
 class SubscriptionManager:
@@ -81,6 +82,8 @@ class SubscriptionManager:
             order.payment_time = datetime.now()
             
             self.db.commit()
+            if current_subscription:
+                subscription_key_cache.invalidate(current_subscription.id)
             
             # 发送支付成功通知
             try:
@@ -211,6 +214,8 @@ class SubscriptionManager:
                 subscription.updated_at = now
             
             self.db.commit()
+            for subscription in expired_subscriptions:
+                subscription_key_cache.invalidate(subscription.id)
             return len(expired_subscriptions)
             
         except Exception as e:
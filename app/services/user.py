@@ -10,6 +10,7 @@ from app.schemas.user import UserCreate, UserUpdate
 from app.utils.security import get_password_hash, verify_password
 from app.utils.email import send_verification_email, send_password_reset_email
 from app.utils.security import create_access_token
+from app.utils.timeseries import day_range, fill_daily_series
 
 class UserService:
     def __init__(self, db: Session):
@@ -197,6 +198,9 @@ class UserService:
             # 2. 删除用户的所有订阅（这会级联删除订阅下的设备）
             from app.models.subscription import Subscription
             subscriptions = self.db.query(Subscription).filter(Subscription.user_id == user_id).all()
+            # 订阅的设备计数行引用订阅，需先删除
+            from app.services.device_counters import delete_device_counters
+            delete_device_counters(self.db, [subscription.id for subscription in subscriptions])
             for subscription in subscriptions:
                 # 删除订阅下的所有设备
                 subscription_devices = self.db.query(Device).filter(Device.subscription_id == subscription.id).all()
@@ -294,6 +298,19 @@ class UserService:
             query = query.filter(User.created_at < end_date)
         return query.count()
 
+    def get_registration_trend(self, start_date: datetime, end_date: datetime) -> List[dict]:
+        """按天统计注册用户数（一次按日期分组查询，没有注册的日期补0）"""
+        range_start, range_end = day_range(start_date, end_date)
+        day = func.date(User.created_at)
+        rows = self.db.query(day, func.count(User.id)).filter(
+            User.created_at >= range_start,
+            User.created_at < range_end
+        ).group_by(day).all()
+        return [
+            {"date": item["date"], "count": item["value"]}
+            for item in fill_daily_series(rows, start_date, end_date)
+        ]
+
     def get_users_with_pagination(
         self, 
         skip: int = 0, 
@@ -42,6 +42,9 @@ class NotificationScheduler:
         # 设置定时任务
         self._setup_schedules()
         
+        # 启动时先对账一次设备计数（升级后为已有订阅建立计数）
+        self._reconcile_device_counters()
+        
         while self.running:
             try:
                 schedule.run_pending()
@@ -67,6 +70,9 @@ class NotificationScheduler:
         # 每小时检查一次邮件队列
         schedule.every().hour.do(self._process_email_queue)
         
+        # 每天凌晨4点对账订阅设备计数
+        schedule.every().day.at("04:00").do(self._reconcile_device_counters)
+        
         print("定时任务已设置完成")
     
     def _check_subscription_expiry_7_days(self):
@@ -144,6 +150,14 @@ class NotificationScheduler:
         finally:
             if 'db' in locals():
                 db.close()
+    
+    def _reconcile_device_counters(self):
+        """对账订阅设备计数"""
+        try:
+            from app.tasks.subscription_tasks import run_device_counter_reconcile
+            run_device_counter_reconcile()
+        except Exception as e:
+            print(f"设备计数对账失败: {e}")
 
 
 # 全局调度器实例
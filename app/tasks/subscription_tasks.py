@@ -7,6 +7,7 @@ from sqlalchemy.orm import Session
 
 from app.core.database import get_db
 from app.services.subscription_manager import SubscriptionManager
+from app.services.device_counters import reconcile_device_counters
 
 
 async def check_expired_subscriptions():
@@ -43,3 +44,21 @@ def run_subscription_check():
         return 0
     finally:
         db.close()
+
+
+def run_device_counter_reconcile():
+    """按devices表对账订阅设备计数，修正增量维护产生的漂移（同步版本，用于定时任务）"""
+    db = next(get_db())
+    try:
+        result = reconcile_device_counters(db)
+        
+        if result['repaired'] or result['orphaned']:
+            print(f"设备计数对账: 修正 {result['repaired']} 个订阅，删除 {result['orphaned']} 条失效计数")
+        
+        return result
+    except Exception as e:
+        print(f"设备计数对账失败: {e}")
+        db.rollback()
+        return None
+    finally:
+        db.close()
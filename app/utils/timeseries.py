@@ -0,0 +1,40 @@
+"""
+按天统计的时间序列工具
+数据库只按日期分组返回有数据的日期，由这里补齐没有数据的日期
+"""
+
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, List, Tuple, Union
+
+
+def day_range(start_date: Union[date, datetime], end_date: Union[date, datetime]) -> Tuple[datetime, datetime]:
+    """返回覆盖起止日期（含）的查询区间 [起始日0点, 结束日次日0点)"""
+    start_day = start_date.date() if isinstance(start_date, datetime) else start_date
+    end_day = end_date.date() if isinstance(end_date, datetime) else end_date
+    return (
+        datetime.combine(start_day, datetime.min.time()),
+        datetime.combine(end_day + timedelta(days=1), datetime.min.time())
+    )
+
+
+def date_key(value: Any) -> str:
+    """数据库按日期分组的结果统一为 YYYY-MM-DD（SQLite返回字符串，MySQL/PostgreSQL返回date）"""
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()[:10]
+    return str(value)[:10]
+
+
+def fill_daily_series(rows: Iterable[Tuple[Any, Any]], start_date: Union[date, datetime],
+                      end_date: Union[date, datetime], default: Any = 0) -> List[Dict[str, Any]]:
+    """将 (日期, 值) 分组结果补齐为从起始日到结束日（含）每天一项的序列"""
+    values = {date_key(day): value for day, value in rows}
+    start_day = start_date.date() if isinstance(start_date, datetime) else start_date
+    end_day = end_date.date() if isinstance(end_date, datetime) else end_date
+
+    series = []
+    current_day = start_day
+    while current_day <= end_day:
+        key = current_day.isoformat()
+        series.append({'date': key, 'value': values.get(key, default)})
+        current_day += timedelta(days=1)
+    return series
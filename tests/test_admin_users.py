@@ -0,0 +1,67 @@
+"""管理后台用户列表测试：批量加载订阅和设备数"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.api.api_v1.endpoints import admin
+from app.models import Device, Subscription, User
+from app.services.device_counters import refresh_device_counters
+from app.services.subscription import SubscriptionService
+
+
+def list_users(db):
+    return admin.get_users(page=1, size=20, keyword="", status="", date_range="", db=db, current_admin=None)
+
+
+@pytest.fixture
+def users(db):
+    created = []
+    for i in range(3):
+        user = User(username=f"user-{i}", email=f"user-{i}@example.com", hashed_password="x")
+        db.add(user)
+        db.flush()
+        if i < 2:
+            subscription = Subscription(user_id=user.id, subscription_url=f"url-{i}", device_limit=5,
+                                        expire_time=datetime.utcnow() + timedelta(days=30))
+            db.add(subscription)
+            db.flush()
+            for j in range(i + 1):
+                db.add(Device(subscription_id=subscription.id, device_fingerprint=f"fp-{i}-{j}"))
+            db.flush()
+            refresh_device_counters(db, subscription.id)
+        created.append(user)
+    db.commit()
+    return created
+
+
+def test_user_list_includes_batched_device_counts(db, users):
+    response = list_users(db)
+
+    assert response.success
+    by_name = {user['username']: user for user in response.data['users']}
+    assert by_name['user-0']['device_count'] == 1
+    assert by_name['user-1']['subscription']['current_devices'] == 2
+    assert by_name['user-2']['subscription'] is None
+
+
+def test_user_list_falls_back_to_stored_counts(db, users, monkeypatch):
+    def fail(self, subscription_ids):
+        raise RuntimeError("counter table unavailable")
+
+    rollbacks = []
+    original_rollback = db.rollback
+
+    def rollback():
+        rollbacks.append(1)
+        original_rollback()
+
+    monkeypatch.setattr(SubscriptionService, 'get_device_counts', fail)
+    monkeypatch.setattr(db, 'rollback', rollback)
+    response = list_users(db)
+
+    assert response.success
+    assert rollbacks == [1]
+    by_name = {user['username']: user for user in response.data['users']}
+    assert by_name['user-1']['device_count'] == 2
+    assert by_name['user-1']['online_devices'] == 0
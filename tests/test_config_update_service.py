@@ -0,0 +1,273 @@
+"""节点源下载测试：流式base64解码、条件请求与内容哈希跳过"""
+
+import base64
+import hashlib
+
+import pytest
+
+from app.services.config_update_service import ConfigUpdateService, NodeLinkStream
+
+
+CONTENT = b"vmess://abc\nss://def\n"
+CONTENT_SHA256 = hashlib.sha256(CONTENT).hexdigest()
+
+
+# 链接中的?和>使base64编码结果包含/（URL安全编码时为_）
+TROJAN_LINKS = [f"trojan://pw{i}@host{i}.example.com:443?sni=s{i}&x=%3F%3E#node-{i}?>" for i in range(200)]
+TROJAN_CONTENT = ('\n'.join(TROJAN_LINKS) + '\n').encode()
+
+
+def stream_links(data, chunk_size=64 * 1024):
+    stream = NodeLinkStream()
+    for i in range(0, len(data), chunk_size):
+        stream.feed(data[i:i + chunk_size])
+    stream.close()
+    return stream
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 4096, 64 * 1024])
+def test_base64_source_decoded_across_chunk_boundaries(chunk_size):
+    encoded = base64.b64encode(TROJAN_CONTENT)
+    # 按MIME格式每76个字符换行
+    wrapped = b'\r\n'.join(encoded[i:i + 76] for i in range(0, len(encoded), 76))
+    stream = stream_links(wrapped, chunk_size)
+
+    assert stream.is_base64 and stream.decode_error is None
+    assert stream.links == TROJAN_LINKS
+    assert stream.size == len(wrapped)
+
+
+@pytest.mark.parametrize("chunk_size", [7, 4096, 64 * 1024])
+def test_stray_character_after_sniff_does_not_break_decoding(chunk_size):
+    encoded = base64.b64encode(TROJAN_CONTENT)
+    data = encoded[:6000] + b'-' + encoded[6000:8000] + b'\n*\n' + encoded[8000:]
+    stream = stream_links(data, chunk_size)
+
+    assert stream.decode_error is None
+    assert stream.links == TROJAN_LINKS
+
+
+@pytest.mark.parametrize("chunk_size", [7, 64 * 1024])
+def test_urlsafe_base64_source(chunk_size):
+    encoded = base64.urlsafe_b64encode(TROJAN_CONTENT)
+    assert b'_' in encoded[:4096]
+    stream = stream_links(encoded, chunk_size)
+
+    assert stream.is_urlsafe and stream.decode_error is None
+    assert stream.links == TROJAN_LINKS
+
+
+def test_concatenated_padded_base64_blocks():
+    first, second = TROJAN_CONTENT[:5000] + b'\n\n', TROJAN_CONTENT[5000:]
+    data = base64.b64encode(first) + b'\n' + base64.b64encode(second)
+    assert b'=' in base64.b64encode(first)
+    stream = stream_links(data, 4096)
+
+    assert stream.decode_error is None
+    assert len(stream.links) == len(TROJAN_LINKS)
+
+
+def test_decode_error_falls_back_to_raw_text():
+    encoded = base64.b64encode(TROJAN_CONTENT[:4000] + b'\n')
+    # base64内容之后混入原始文本，错位的填充字符使base64解码失败
+    data = encoded + b'\n=\nss://YWVzLTI1Ni1nY206c2VjcmV0@jp.example.com:8388#raw\n'
+    stream = stream_links(data, 4096)
+
+    assert stream.is_base64 and stream.decode_error is not None
+    decoded_links = [link for link in TROJAN_LINKS if link.encode() in TROJAN_CONTENT[:4000]]
+    assert stream.links == decoded_links + ['ss://YWVzLTI1Ni1nY206c2VjcmV0@jp.example.com:8388#raw']
+
+
+def test_raw_text_source():
+    stream = stream_links(TROJAN_CONTENT, 7)
+    assert stream.is_base64 is False
+    assert stream.links == TROJAN_LINKS
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, content=b'', headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(self.status_code)
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+
+class FakeSession:
+    def __init__(self, response):
+        self.response = response
+        self.requests = []
+
+    def get(self, url, timeout=None, headers=None, stream=False):
+        self.requests.append(dict(headers or {}))
+        return self.response
+
+
+@pytest.fixture
+def service():
+    return ConfigUpdateService(db=None)
+
+
+def test_first_download_extracts_links(service):
+    session = FakeSession(FakeResponse(content=CONTENT, headers={'ETag': '"v1"'}))
+    result = service._fetch_source(session, 'http://example.com/sub')
+
+    assert session.requests == [{}]
+    assert result['unchanged'] is False
+    assert result['sha256'] == CONTENT_SHA256
+    assert result['etag'] == '"v1"'
+    assert result['stream'].links == ['vmess://abc', 'ss://def']
+
+
+def test_not_modified_reuses_previous_links(service):
+    previous = {'etag': '"v1"', 'last_modified': None, 'sha256': CONTENT_SHA256, 'links': ['vmess://abc']}
+    session = FakeSession(FakeResponse(status_code=304))
+    result = service._fetch_source(session, 'http://example.com/sub', previous)
+
+    assert session.requests == [{'If-None-Match': '"v1"'}]
+    assert result['unchanged'] is True
+    assert result['stream'] is None
+    assert result['sha256'] == CONTENT_SHA256
+
+
+def test_same_hash_without_validators_is_unchanged(service):
+    # 服务端不提供ETag/Last-Modified，仅靠内容哈希判断未变化
+    previous = {'etag': None, 'last_modified': None, 'sha256': CONTENT_SHA256, 'links': ['vmess://abc', 'ss://def']}
+    session = FakeSession(FakeResponse(content=CONTENT))
+    result = service._fetch_source(session, 'http://example.com/sub', previous)
+
+    assert session.requests == [{}]
+    assert result['unchanged'] is True
+    assert result['stream'] is None
+    assert result['sha256'] == CONTENT_SHA256
+
+
+def test_same_hash_ignoring_server_validators_is_unchanged(service):
+    previous = {'etag': '"v1"', 'last_modified': None, 'sha256': CONTENT_SHA256, 'links': ['vmess://abc', 'ss://def']}
+    session = FakeSession(FakeResponse(content=CONTENT, headers={'ETag': '"v2"'}))
+    result = service._fetch_source(session, 'http://example.com/sub', previous)
+
+    assert result['unchanged'] is True
+    assert result['etag'] == '"v2"'
+
+
+def test_changed_hash_is_parsed(service):
+    previous = {'etag': None, 'last_modified': None, 'sha256': 'outdated', 'links': ['vmess://old']}
+    session = FakeSession(FakeResponse(content=CONTENT))
+    result = service._fetch_source(session, 'http://example.com/sub', previous)
+
+    assert result['unchanged'] is False
+    assert result['stream'].links == ['vmess://abc', 'ss://def']
+
+
+def test_previous_without_links_is_parsed(service):
+    # 没有缓存的节点链接时即使哈希相同也必须重新解析
+    previous = {'etag': None, 'last_modified': None, 'sha256': CONTENT_SHA256, 'links': None}
+    session = FakeSession(FakeResponse(content=CONTENT))
+    result = service._fetch_source(session, 'http://example.com/sub', previous)
+
+    assert result['unchanged'] is False
+    assert result['stream'].links == ['vmess://abc', 'ss://def']
+
+
+def test_clash_proxies_keep_emoji_unescaped(service, tmp_path, monkeypatch):
+    import yaml
+    from app.services import config_update_service
+    from app.services.config_update_service import ClashConfigWriter
+
+    templates = tmp_path / 'templates'
+    templates.mkdir()
+    (templates / 'clash_template_head.yaml').write_text('port: 7890\n', encoding='utf-8')
+    (templates / 'clash_template_tail.yaml').write_text(
+        '  - name: 节点选择\n    type: select\n    proxies:\n      - DIRECT\n', encoding='utf-8')
+    services_dir = tmp_path / 'app' / 'services'
+    services_dir.mkdir(parents=True)
+    monkeypatch.setattr(config_update_service, '__file__', str(services_dir / 'config_update_service.py'))
+
+    name = '日本 🇯🇵 #17'
+    proxies = [{'name': name, 'type': 'ss', 'server': 'example.com', 'port': 443}]
+    writer = ClashConfigWriter()
+    service._write_clash_with_legacy_template(proxies, [name], writer)
+    content = writer.getvalue()
+
+    assert f"- name: '{name}'" in content
+    assert '\\U' not in content
+    config = yaml.safe_load(content)
+    assert config['proxies'] == proxies
+
+
+def published_rows(db):
+    from sqlalchemy import text
+    return dict(db.execute(text(
+        "SELECT \"key\", value FROM system_configs WHERE \"key\" IN ('clash_config', 'v2ray_config', 'config_version')"
+    )).fetchall())
+
+
+def stage_outputs(service, tmp_path, label='new'):
+    outputs = {}
+    for key, name in (('clash_config', 'clash.yaml'), ('v2ray_config', 'xr')):
+        output_file = tmp_path / name
+        output_file.write_text(f'old {key}', encoding='utf-8')
+        temp_file = tmp_path / f'{name}.tmp'
+        temp_file.write_text(f'{label} {key}', encoding='utf-8')
+        service._stage_output(key, f'{label} {key}', str(temp_file), str(output_file))
+        outputs[key] = (temp_file, output_file)
+    return outputs
+
+
+def test_publish_commits_rows_and_replaces_files(db, tmp_path):
+    service = ConfigUpdateService(db)
+    outputs = stage_outputs(service, tmp_path)
+
+    service._publish_staged_outputs()
+
+    rows = published_rows(db)
+    assert rows['clash_config'] == 'new clash_config'
+    assert rows['v2ray_config'] == 'new v2ray_config'
+    assert rows['config_version']
+    for key, (temp_file, output_file) in outputs.items():
+        assert output_file.read_text(encoding='utf-8') == f'new {key}'
+        assert not temp_file.exists()
+    assert service._staged_outputs == {}
+
+
+def test_publish_rollback_keeps_old_files_and_rows(db, tmp_path, monkeypatch):
+    from app.services import config_update_service
+
+    service = ConfigUpdateService(db)
+    stage_outputs(service, tmp_path)
+    service._publish_staged_outputs()
+    version = published_rows(db)['config_version']
+
+    outputs = stage_outputs(service, tmp_path, label='next')
+    for key, (_, output_file) in outputs.items():
+        output_file.write_text(f'published {key}', encoding='utf-8')
+
+    def fail_bump(db, updated_at=None):
+        raise RuntimeError("database is locked")
+
+    # 配置行已写入、版本号更新失败：整个事务回滚
+    monkeypatch.setattr(config_update_service, 'bump_config_version', fail_bump)
+    with pytest.raises(RuntimeError):
+        service._publish_staged_outputs()
+
+    rows = published_rows(db)
+    assert rows['clash_config'] == 'new clash_config'
+    assert rows['config_version'] == version
+    for key, (temp_file, output_file) in outputs.items():
+        # 临时文件未被提升为正式文件，并已删除
+        assert output_file.read_text(encoding='utf-8') == f'published {key}'
+        assert not temp_file.exists()
+    assert service._staged_outputs == {}
@@ -0,0 +1,188 @@
+"""订阅设备计数的增量维护与对账测试"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+
+from app.models import Device, Subscription, SubscriptionDeviceCounter, User
+from app.services import device_counters
+from app.services.device_counters import (
+    DEVICE_COUNTER_FIELDS,
+    apply_device_counter_delta,
+    get_device_counters,
+    new_device_delta,
+    reconcile_device_counters,
+    refresh_device_counters,
+)
+from app.services.device_presence import DevicePresence
+
+
+@pytest.fixture(autouse=True)
+def presence(monkeypatch):
+    presence = DevicePresence()
+    monkeypatch.setattr(device_counters, "device_presence", presence)
+    return presence
+
+
+def make_subscription(db, url="url-1"):
+    user = User(username=f"user-{url}", email=f"{url}@example.com", hashed_password="x")
+    db.add(user)
+    db.flush()
+    subscription = Subscription(
+        user_id=user.id, subscription_url=url, device_limit=5,
+        expire_time=datetime.utcnow() + timedelta(days=30)
+    )
+    db.add(subscription)
+    db.flush()
+    return subscription
+
+
+def add_device(db, subscription, user_agent="ClashX/1.0", is_allowed=True, device_type="desktop"):
+    device = Device(
+        subscription_id=subscription.id, device_fingerprint=f"fp-{user_agent}-{is_allowed}",
+        user_agent=user_agent, is_allowed=is_allowed, device_type=device_type
+    )
+    db.add(device)
+    db.flush()
+    return device
+
+
+def counters(db, subscription_id):
+    return get_device_counters(db, [subscription_id]).get(subscription_id)
+
+
+def current_devices(db, subscription_id):
+    return db.execute(text("SELECT current_devices FROM subscriptions WHERE id = :id"),
+                      {'id': subscription_id}).scalar()
+
+
+def test_new_device_delta_classifies_clients():
+    delta = new_device_delta(False, 'mobile', 'Shadowrocket/1.0 iOS')
+    assert delta == {
+        'total_devices': 1, 'allowed_devices': 0, 'blocked_devices': 1,
+        'apple_devices': 1, 'clash_devices': 0, 'v2ray_devices': 1
+    }
+
+
+def test_apply_delta_creates_missing_row_from_devices(db):
+    subscription = make_subscription(db)
+    add_device(db, subscription, "ClashX/1.0")
+
+    # 计数行不存在时按devices表重算（已包含刚写入的设备），不再叠加增量
+    apply_device_counter_delta(db, subscription.id, **new_device_delta(True, 'desktop', 'ClashX/1.0'))
+    db.commit()
+
+    assert counters(db, subscription.id)['total_devices'] == 1
+    assert counters(db, subscription.id)['clash_devices'] == 1
+    assert current_devices(db, subscription.id) == 1
+
+    add_device(db, subscription, "V2RayN/6.0", is_allowed=False)
+    apply_device_counter_delta(db, subscription.id, **new_device_delta(False, 'desktop', 'V2RayN/6.0'))
+    db.commit()
+
+    assert counters(db, subscription.id) == {
+        'total_devices': 2, 'allowed_devices': 1, 'blocked_devices': 1,
+        'apple_devices': 0, 'clash_devices': 1, 'v2ray_devices': 1
+    }
+    assert current_devices(db, subscription.id) == 2
+
+
+def test_refresh_recounts_and_forgets_deleted_devices(db, presence):
+    subscription = make_subscription(db)
+    kept = add_device(db, subscription, "ClashX/1.0")
+    removed = add_device(db, subscription, "V2RayN/6.0")
+    refresh_device_counters(db, subscription.id)
+    presence.touch(kept.id, subscription.id)
+    presence.touch(removed.id, subscription.id)
+
+    db.delete(removed)
+    refresh_device_counters(db, subscription.id)
+    db.commit()
+
+    assert counters(db, subscription.id)['total_devices'] == 1
+    assert counters(db, subscription.id)['v2ray_devices'] == 0
+    assert current_devices(db, subscription.id) == 1
+    assert presence.is_online(kept.id)
+    assert not presence.is_online(removed.id)
+
+
+def test_reconcile_repairs_drift_and_removes_orphans(db):
+    drifted = make_subscription(db, "url-1")
+    missing = make_subscription(db, "url-2")
+    accurate = make_subscription(db, "url-3")
+    add_device(db, drifted, "ClashX/1.0")
+    add_device(db, drifted, "V2RayN/6.0", is_allowed=False)
+    add_device(db, missing, "Shadowrocket/1.0 iOS", device_type="mobile")
+    add_device(db, accurate, "ClashX/1.0")
+    refresh_device_counters(db, accurate.id)
+
+    zero = {field: 0 for field in DEVICE_COUNTER_FIELDS}
+    db.add(SubscriptionDeviceCounter(subscription_id=drifted.id, **dict(zero, total_devices=7)))
+    db.add(SubscriptionDeviceCounter(subscription_id=999, **zero))
+    db.commit()
+
+    result = reconcile_device_counters(db)
+
+    assert result == {'subscriptions': 3, 'repaired': 2, 'orphaned': 1, 'current_devices_synced': 2}
+    assert counters(db, drifted.id) == {
+        'total_devices': 2, 'allowed_devices': 1, 'blocked_devices': 1,
+        'apple_devices': 0, 'clash_devices': 1, 'v2ray_devices': 1
+    }
+    assert counters(db, missing.id)['apple_devices'] == 1
+    assert counters(db, accurate.id)['total_devices'] == 1
+    assert counters(db, 999) is None
+    assert [current_devices(db, s.id) for s in (drifted, missing, accurate)] == [2, 1, 1]
+
+
+def test_reconcile_is_idempotent(db):
+    subscription = make_subscription(db)
+    add_device(db, subscription)
+    db.commit()
+
+    reconcile_device_counters(db)
+    result = reconcile_device_counters(db)
+
+    assert result == {'subscriptions': 1, 'repaired': 0, 'orphaned': 0, 'current_devices_synced': 0}
+    assert db.query(SubscriptionDeviceCounter).count() == 1
+
+
+def test_delete_user_with_devices_removes_counters(db):
+    from app.services.user import UserService
+
+    # SQLite默认不检查外键，与MySQL/PostgreSQL保持一致
+    db.execute(text("PRAGMA foreign_keys=ON"))
+    subscription = make_subscription(db)
+    add_device(db, subscription)
+    refresh_device_counters(db, subscription.id)
+    db.commit()
+    user_id, subscription_id = subscription.user_id, subscription.id
+
+    assert UserService(db).delete(user_id)
+    db.commit()
+
+    assert db.query(Subscription).filter(Subscription.id == subscription_id).count() == 0
+    assert db.query(SubscriptionDeviceCounter).count() == 0
+    assert db.query(Device).count() == 0
+
+
+def test_sql_classification_matches_classify_device(db):
+    subscription = make_subscription(db)
+    devices = [
+        ('mobile', 'Shadowrocket/2.2 IOS/17'),
+        ('mobile', 'clash-verge macos'),
+        ('desktop', 'CLASH.META/1.18'),
+        ('mobile', 'v2rayNG/1.8 Android'),
+        ('desktop', 'Mozilla/5.0 (Macintosh) AppleWebKit'),
+        ('mobile', None),
+    ]
+    expected = {field: 0 for field in DEVICE_COUNTER_FIELDS}
+    for i, (device_type, user_agent) in enumerate(devices):
+        db.add(Device(subscription_id=subscription.id, device_fingerprint=f"fp-{i}",
+                      device_type=device_type, user_agent=user_agent, is_allowed=True))
+        for field, value in new_device_delta(True, device_type, user_agent).items():
+            expected[field] += value
+    db.flush()
+
+    refresh_device_counters(db, subscription.id)
+    assert counters(db, subscription.id) == expected
@@ -0,0 +1,134 @@
+"""设备在线状态测试：时间桶淘汰、乱序访问与启动加载"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.models import Device, Subscription, User
+from app.services import device_presence as device_presence_module
+from app.services.device_presence import DevicePresence
+
+
+class FakeClock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(device_presence_module.time, 'time', clock)
+    return clock
+
+
+def test_touch_counts_devices_per_subscription(clock):
+    presence = DevicePresence(window=300, bucket_seconds=10)
+    presence.touch(1, 10)
+    presence.touch(2, 10)
+    presence.touch(3, 20)
+    presence.touch(1, 10)
+
+    assert presence.online_count() == 3
+    assert presence.online_count_for(10) == 2
+    assert presence.online_counts() == {10: 2, 20: 1}
+    assert presence.online_counts([10, 30]) == {10: 2}
+    assert presence.is_online(3)
+
+
+def test_devices_expire_after_window(clock):
+    presence = DevicePresence(window=300, bucket_seconds=10)
+    presence.touch(1, 10)
+    clock.now += 200
+    presence.touch(2, 10)
+
+    clock.now += 150
+    assert not presence.is_online(1)
+    assert presence.is_online(2)
+    assert presence.online_counts() == {10: 1}
+
+    clock.now += 200
+    assert presence.online_count() == 0
+    assert presence.stats() == {'online_devices': 0, 'online_subscriptions': 0, 'buckets': 0}
+
+
+def test_touch_moves_device_to_newer_bucket(clock):
+    presence = DevicePresence(window=300, bucket_seconds=10)
+    presence.touch(1, 10)
+    clock.now += 200
+    presence.touch(1, 10)
+
+    # 第一次访问所在的时间桶过期后设备仍在线
+    clock.now += 150
+    assert presence.is_online(1)
+    assert presence.stats()['buckets'] == 1
+
+
+def test_older_access_does_not_move_device_back(clock):
+    presence = DevicePresence(window=300, bucket_seconds=10)
+    presence.touch(1, 10)
+    presence.touch(1, 10, clock.now - 250)
+
+    clock.now += 100
+    assert presence.is_online(1)
+
+
+def test_out_of_order_buckets_expire_in_time_order(clock):
+    presence = DevicePresence(window=300, bucket_seconds=10)
+    presence.touch(1, 10, clock.now - 50)
+    presence.touch(2, 10, clock.now - 250)
+    presence.touch(3, 20, clock.now - 150)
+
+    clock.now += 60
+    assert presence.online_counts() == {10: 1, 20: 1}
+    assert not presence.is_online(2)
+
+    clock.now += 100
+    assert presence.online_counts() == {10: 1}
+
+
+def test_device_moved_to_another_subscription(clock):
+    presence = DevicePresence()
+    presence.touch(1, 10)
+    clock.now += 20
+    presence.touch(1, 20)
+
+    assert presence.online_counts() == {20: 1}
+
+
+def test_forget_and_retain_remove_deleted_devices(clock):
+    presence = DevicePresence()
+    for device_id in (1, 2, 3):
+        presence.touch(device_id, 10)
+    presence.touch(4, 20)
+
+    presence.retain(10, [1, 3])
+    assert presence.online_counts() == {10: 2, 20: 1}
+
+    presence.forget([1, 4])
+    assert presence.online_counts() == {10: 1}
+    assert not presence.is_online(4)
+
+
+def test_load_recent_reads_devices_in_window(db):
+    user = User(username="user", email="user@example.com", hashed_password="x")
+    db.add(user)
+    db.flush()
+    subscription = Subscription(user_id=user.id, subscription_url="url-1",
+                                expire_time=datetime.utcnow() + timedelta(days=30))
+    db.add(subscription)
+    db.flush()
+
+    now = datetime.utcnow()
+    for fingerprint, last_seen in (('recent', now - timedelta(seconds=30)),
+                                   ('older', now - timedelta(seconds=200)),
+                                   ('stale', now - timedelta(seconds=600)),
+                                   ('never', None)):
+        db.add(Device(subscription_id=subscription.id, device_fingerprint=fingerprint, last_seen=last_seen))
+    db.commit()
+
+    presence = DevicePresence(window=300, bucket_seconds=10)
+    assert presence.load_recent(db) == 2
+    assert presence.online_counts() == {subscription.id: 2}
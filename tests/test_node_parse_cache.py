@@ -0,0 +1,84 @@
+"""节点解析结果缓存测试：缓存键随解析方式和参数变化，容量淘汰与重启后复用"""
+
+import pytest
+
+from app.services.config_update_service import ConfigUpdateService
+from app.services.node_parse_cache import NodeParseCache
+
+
+# 包含重复链接和无法解析的链接
+NODE_URLS = [
+    'ss://YWVzLTI1Ni1nY206c2VjcmV0@jp.example.com:8388#%E6%97%A5%E6%9C%AC%2001',
+    'trojan://pw@us.example.com:443?sni=us.example.com#%E7%BE%8E%E5%9B%BD%2001',
+    'trojan://pw@hk.example.com:443?sni=hk.example.com#%E9%A6%99%E6%B8%AF%2001',
+    'vless://invalid',
+    'ss://YWVzLTI1Ni1nY206c2VjcmV0@sg.example.com:8388#',
+    'trojan://pw@us.example.com:443?sni=us.example.com#%E7%BE%8E%E5%9B%BD%2001',
+]
+
+
+@pytest.fixture
+def service():
+    return ConfigUpdateService(db=None)
+
+
+def test_parse_cache_key_depends_on_mode_and_fingerprint():
+    node_url = NODE_URLS[0]
+    key = NodeParseCache.make_key(node_url, 'legacy', '[1, []]')
+    assert key == NodeParseCache.make_key(node_url, 'legacy', '[1, []]')
+    assert key != NodeParseCache.make_key(node_url, 'raw', '[1, []]')
+    assert key != NodeParseCache.make_key(node_url, 'legacy', '[1, ["过期"]]')
+    assert key != NodeParseCache.make_key(NODE_URLS[1], 'legacy', '[1, []]')
+
+
+def test_parse_cache_round_trip_and_eviction(tmp_path):
+    cache = NodeParseCache(str(tmp_path / 'cache.sqlite'), max_entries=2)
+    try:
+        cache.set_many([('a', {'name': '日本 🇯🇵'}), ('b', None)])
+        assert cache.get_many(['a', 'b', 'missing']) == {'a': {'name': '日本 🇯🇵'}, 'b': None}
+        assert cache.stats()['hits'] == 2 and cache.stats()['misses'] == 1
+
+        # 最久未使用的条目先被淘汰
+        cache._conn.execute("UPDATE node_parse_cache SET last_used = 0 WHERE key = 'a'")
+        cache.set_many([('c', {'name': 'c'})])
+        assert set(cache.get_many(['a', 'b', 'c'])) == {'b', 'c'}
+    finally:
+        cache.close()
+
+    # 重新打开后缓存仍然有效
+    reopened = NodeParseCache(str(tmp_path / 'cache.sqlite'))
+    try:
+        assert reopened.get_many(['c']) == {'c': {'name': 'c'}}
+    finally:
+        reopened.close()
+
+
+def test_parse_nodes_uses_cache_per_filter_keywords(service, tmp_path, monkeypatch):
+    calls = []
+    original = service._parse_node_isolated
+
+    def counting(node_url, rename, filter_keywords=None):
+        calls.append(node_url)
+        return original(node_url, rename, filter_keywords)
+
+    monkeypatch.setattr(service, '_parse_node_isolated', counting)
+    node_urls = NODE_URLS
+
+    first = service._parse_nodes(node_urls, True, [], cache_dir=str(tmp_path))
+    # 重复的链接只解析一次
+    assert len(calls) == 5
+
+    calls.clear()
+    second = service._parse_nodes(node_urls, True, [], cache_dir=str(tmp_path))
+    assert second == first
+    # 解析失败（返回None）的结果同样被缓存
+    assert calls == []
+
+    # 过滤关键字变化时缓存键不同，需要重新解析
+    service._parse_nodes(node_urls, True, ['香港'], cache_dir=str(tmp_path))
+    assert len(calls) == 5
+
+    # 不重命名的解析方式也使用独立的缓存键
+    calls.clear()
+    service._parse_nodes(node_urls, False, [], cache_dir=str(tmp_path))
+    assert len(calls) == 5
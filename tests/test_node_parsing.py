@@ -0,0 +1,87 @@
+"""节点解析测试：多进程解析与单进程解析的结果一致"""
+
+import base64
+import json
+import os
+from urllib.parse import quote
+
+import pytest
+
+from app.services import config_update_service
+from app.services.config_update_service import ConfigUpdateService, ensure_unique_name
+
+
+def vmess_link(name, server):
+    return 'vmess://' + base64.b64encode(json.dumps({
+        "v": "2", "ps": name, "add": server, "port": "443", "id": "a3482e88-686a-4a58-8126-99c9df64b7bf",
+        "aid": "0", "net": "ws", "type": "none", "host": server, "path": "/ws", "tls": "tls"
+    }).encode()).decode()
+
+
+def ss_link(name, server):
+    return 'ss://' + base64.b64encode(b'aes-256-gcm:secret').decode() + f'@{server}:8388#' + quote(name)
+
+
+def trojan_link(name, server):
+    return f'trojan://pw@{server}:443?sni={server}#' + quote(name)
+
+
+# 包含重名节点、重复链接和无法解析的链接
+NODE_URLS = [
+    vmess_link('香港 01', 'hk.example.com'),
+    ss_link('日本 🇯🇵 #17', 'jp.example.com'),
+    trojan_link('美国 01', 'us.example.com'),
+    vmess_link('香港 01', 'hk2.example.com'),
+    'vless://invalid',
+    ss_link('', 'sg.example.com'),
+    trojan_link('美国 01', 'us.example.com'),
+] * 3
+
+
+@pytest.fixture
+def service():
+    return ConfigUpdateService(db=None)
+
+
+def messages(service):
+    return [(log['level'], log['message']) for log in service.logs if not log['message'].startswith('⚡')]
+
+
+@pytest.mark.parametrize("rename", [True, False])
+def test_parallel_parse_matches_serial(service, monkeypatch, rename):
+    serial = [service._parse_node_isolated(node_url, rename, ['过期']) for node_url in NODE_URLS]
+    serial_logs = messages(service)
+
+    monkeypatch.setattr(os, 'cpu_count', lambda: 2)
+    monkeypatch.setattr(config_update_service, 'PARSE_CHUNK_SIZE', 4)
+    parallel_service = ConfigUpdateService(db=None)
+    parallel = parallel_service._parse_nodes_parallel(NODE_URLS, rename, ['过期'])
+
+    assert parallel == serial
+    assert messages(parallel_service) == serial_logs
+    assert any(log['message'].startswith('⚡') for log in parallel_service.logs)
+
+
+def test_parallel_parse_falls_back_with_single_cpu(service, monkeypatch):
+    monkeypatch.setattr(os, 'cpu_count', lambda: 1)
+    assert service._parse_nodes_parallel(NODE_URLS, True) is None
+
+
+def test_isolated_names_made_unique_in_order_match_shared_counter(service):
+    # 旧逻辑在解析时共用name_count；并行解析后按顺序去重应得到相同的名称
+    shared_count = {}
+    legacy_names = []
+    for node_url in NODE_URLS:
+        proxy = service._parse_node_legacy(node_url, shared_count)
+        if proxy is not None:
+            legacy_names.append(proxy['name'])
+
+    name_count = {}
+    isolated_names = [
+        ensure_unique_name(proxy['name'], name_count)
+        for proxy, _ in (service._parse_node_isolated(node_url, True) for node_url in NODE_URLS)
+        if proxy is not None
+    ]
+
+    assert isolated_names == legacy_names
+    assert len(set(isolated_names)) == len(isolated_names)
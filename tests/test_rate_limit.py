@@ -0,0 +1,94 @@
+"""订阅地址令牌桶限流测试"""
+
+import asyncio
+
+import pytest
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+
+from app.middleware import rate_limit
+from app.middleware.rate_limit import TokenBucketLimiter
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limit.time, 'monotonic', clock)
+    return clock
+
+
+def test_bucket_allows_burst_then_limits(clock):
+    limiter = TokenBucketLimiter(capacity=3, refill_per_second=0.5)
+
+    assert [limiter.acquire('sub-a') for _ in range(3)] == [0, 0, 0]
+    assert limiter.acquire('sub-a') == pytest.approx(2.0)
+    # 其他订阅地址独立计数
+    assert limiter.acquire('sub-b') == 0
+
+
+def test_bucket_refills_over_time(clock):
+    limiter = TokenBucketLimiter(capacity=2, refill_per_second=1)
+    limiter.acquire('sub-a')
+    limiter.acquire('sub-a')
+
+    clock.now += 0.5
+    assert limiter.acquire('sub-a') == pytest.approx(0.5)
+    clock.now += 0.5
+    assert limiter.acquire('sub-a') == 0
+
+    # 令牌数不超过容量
+    clock.now += 100
+    assert [limiter.acquire('sub-a') for _ in range(3)] == [0, 0, pytest.approx(1.0)]
+
+
+def test_zero_refill_rate_waits_fixed_interval(clock):
+    limiter = TokenBucketLimiter(capacity=1, refill_per_second=0)
+    assert limiter.acquire('sub-a') == 0
+    assert limiter.acquire('sub-a') == 60.0
+
+
+def test_cleanup_drops_only_full_buckets(clock):
+    limiter = TokenBucketLimiter(capacity=2, refill_per_second=1)
+    limiter.acquire('sub-a')
+    clock.now += 5
+    limiter.acquire('sub-b')
+
+    limiter.cleanup()
+    assert set(limiter.buckets) == {'sub-b'}
+
+
+def make_request(path, client_ip='203.0.113.1'):
+    return Request({
+        "type": "http", "method": "GET", "path": path, "query_string": b"",
+        "headers": [], "client": (client_ip, 12345)
+    })
+
+
+def test_middleware_returns_429_with_retry_after(clock, monkeypatch):
+    limiter = TokenBucketLimiter(capacity=1, refill_per_second=0.4)
+    monkeypatch.setattr(rate_limit, 'subscription_rate_limiter', limiter)
+    monkeypatch.setattr(rate_limit, 'rate_limiter', rate_limit.RateLimiter())
+
+    async def call_next(request):
+        return PlainTextResponse("ok")
+
+    async def run(path):
+        return await rate_limit.rate_limit_middleware(make_request(path), call_next)
+
+    assert asyncio.run(run('/api/v1/subscriptions/clash/key-a')).status_code == 200
+
+    response = asyncio.run(run('/api/v1/subscriptions/clash/key-a'))
+    assert response.status_code == 429
+    # 需要等待2.5秒，向上取整
+    assert response.headers['retry-after'] == '3'
+
+    # 同一客户端的其他订阅地址不受影响
+    assert asyncio.run(run('/api/v1/subscriptions/ssr/key-b')).status_code == 200
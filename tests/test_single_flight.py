@@ -0,0 +1,115 @@
+"""SingleFlight并发调用合并测试"""
+
+import asyncio
+
+import pytest
+
+from app.utils.cache import SingleFlight
+
+
+def test_concurrent_calls_share_one_result():
+    async def main():
+        flight = SingleFlight()
+        calls = []
+        release = asyncio.Event()
+
+        async def load():
+            calls.append(1)
+            await release.wait()
+            return {'content': 'config'}
+
+        tasks = [asyncio.create_task(flight.do('key', load)) for _ in range(5)]
+        await asyncio.sleep(0)
+        assert len(flight) == 1
+        release.set()
+        results = await asyncio.gather(*tasks)
+        return calls, results, len(flight)
+
+    calls, results, pending = asyncio.run(main())
+    assert len(calls) == 1
+    assert all(result is results[0] for result in results)
+    assert pending == 0
+
+
+def test_different_keys_run_separately():
+    async def main():
+        flight = SingleFlight()
+
+        async def load(value):
+            await asyncio.sleep(0)
+            return value
+
+        return await asyncio.gather(flight.do('a', lambda: load(1)), flight.do('b', lambda: load(2)))
+
+    assert asyncio.run(main()) == [1, 2]
+
+
+def test_exception_is_shared_by_waiters():
+    async def main():
+        flight = SingleFlight()
+        calls = []
+
+        async def load():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise RuntimeError("database unavailable")
+
+        results = await asyncio.gather(*[flight.do('key', load) for _ in range(3)], return_exceptions=True)
+        # 失败后不保留调用记录，下一次调用重新执行
+        with pytest.raises(RuntimeError):
+            await flight.do('key', load)
+        return calls, results
+
+    calls, results = asyncio.run(main())
+    assert len(calls) == 2
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert results[0] is results[1] is results[2]
+
+
+def test_cancelled_leader_does_not_cancel_waiters():
+    async def main():
+        flight = SingleFlight()
+        calls = []
+
+        async def load():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        leader = asyncio.create_task(flight.do('key', load))
+        await asyncio.sleep(0)
+        waiters = [asyncio.create_task(flight.do('key', load)) for _ in range(3)]
+        await asyncio.sleep(0)
+        leader.cancel()
+
+        results = await asyncio.gather(*waiters)
+        with pytest.raises(asyncio.CancelledError):
+            await leader
+        return calls, results, len(flight)
+
+    calls, results, pending = asyncio.run(main())
+    # 第一个等待者重新发起调用，其余等待者共享其结果
+    assert len(calls) == 2
+    assert results == [2, 2, 2]
+    assert pending == 0
+
+
+def test_cancelled_waiter_does_not_affect_leader():
+    async def main():
+        flight = SingleFlight()
+
+        async def load():
+            await asyncio.sleep(0.01)
+            return 'config'
+
+        leader = asyncio.create_task(flight.do('key', load))
+        await asyncio.sleep(0)
+        waiter = asyncio.create_task(flight.do('key', load))
+        await asyncio.sleep(0)
+        waiter.cancel()
+
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        return await leader
+
+    assert asyncio.run(main()) == 'config'
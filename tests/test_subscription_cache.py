@@ -0,0 +1,222 @@
+"""订阅内容缓存：压缩版本、ETag复用和订阅地址缓存失效"""
+
+import asyncio
+import gzip
+import threading
+
+import pytest
+
+from app.services import subscription_cache
+from app.services.subscription_cache import (
+    SubscriptionConfigCache, SubscriptionKeyCache, SubscriptionRecord,
+    build_config_entry, build_placeholder_entry, get_encoded_content, get_encoded_content_async
+)
+
+LARGE_CONTENT = "proxies:\n" + "".join(f"  - name: node-{i}\n    server: 10.0.{i % 256}.1\n" for i in range(2000))
+
+
+def make_request(headers=None):
+    from starlette.requests import Request
+    return Request({
+        "type": "http", "method": "GET", "path": "/", "query_string": b"",
+        "headers": [(name.lower().encode(), value.encode()) for name, value in (headers or {}).items()]
+    })
+
+
+def make_record(subscription_id=1, device_limit=3):
+    return SubscriptionRecord(subscription_id, 10, device_limit, None, True, "user", "user@example.com")
+
+
+def test_gzip_content_round_trips():
+    entry = build_config_entry(LARGE_CONTENT)
+    body = get_encoded_content(entry, "gzip")
+    assert gzip.decompress(body).decode("utf-8") == LARGE_CONTENT
+
+
+def test_brotli_content_round_trips():
+    brotli = pytest.importorskip("brotli")
+    entry = build_config_entry(LARGE_CONTENT)
+    body = get_encoded_content(entry, "br")
+    assert brotli.decompress(body).decode("utf-8") == LARGE_CONTENT
+
+
+def test_small_content_is_not_compressed():
+    entry = build_config_entry("short")
+    assert get_encoded_content(entry, "gzip") is None
+
+
+def test_concurrent_requests_compress_once(monkeypatch):
+    calls = []
+    original = subscription_cache._compress
+
+    def counting_compress(raw, encoding):
+        calls.append(encoding)
+        return original(raw, encoding)
+
+    monkeypatch.setattr(subscription_cache, "_compress", counting_compress)
+    entry = build_config_entry(LARGE_CONTENT)
+    barrier = threading.Barrier(8)
+    results = []
+
+    def worker():
+        barrier.wait()
+        results.append(get_encoded_content(entry, "gzip"))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert calls == ["gzip"]
+    assert len(set(results)) == 1
+
+
+def test_async_encoding_reuses_cached_body():
+    entry = build_config_entry(LARGE_CONTENT)
+    body = asyncio.run(get_encoded_content_async(entry, "gzip"))
+    assert body is get_encoded_content(entry, "gzip")
+
+
+def test_config_cache_reuses_entry_when_content_unchanged():
+    # ttl=0：每次都重新加载
+    cache = SubscriptionConfigCache(ttl=0)
+    first = cache.get_entry("clash_config", lambda: (LARGE_CONTENT, None))
+    get_encoded_content(first, "gzip")
+
+    second = cache.get_entry("clash_config", lambda: (LARGE_CONTENT, None))
+    assert second is first
+    assert "gzip" in second["encoded"]
+
+    third = cache.get_entry("clash_config", lambda: (LARGE_CONTENT + "# changed\n", None))
+    assert third["etag"] != first["etag"]
+    assert third["encoded"] == {}
+
+
+def test_config_cache_drops_load_raced_by_invalidation():
+    cache = SubscriptionConfigCache(ttl=60)
+
+    def loader():
+        cache.invalidate()
+        return ("old", None)
+
+    cache.get_entry("clash_config", loader)
+    loads = []
+    cache.get_entry("clash_config", lambda: loads.append(1) or ("new", None))
+    assert loads == [1]
+
+
+def test_published_version_change_invalidates_cache():
+    cache = SubscriptionConfigCache(ttl=60, version_check_interval=0)
+    cache.sync_published_version(lambda: "v1")
+    cache.get_entry("clash_config", lambda: ("a", None))
+
+    cache.sync_published_version(lambda: "v1")
+    assert cache.get_entry("clash_config", lambda: ("b", None))["content"] == "a"
+
+    cache.sync_published_version(lambda: "v2")
+    assert cache.get_entry("clash_config", lambda: ("b", None))["content"] == "b"
+
+
+def test_missing_config_is_not_cached():
+    cache = SubscriptionConfigCache(ttl=60)
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return None
+
+    assert cache.get_entry("clash_config", loader) is None
+    assert cache.get_entry("clash_config", loader) is None
+    assert len(calls) == 2
+    # 配置写入后立即生效，不受TTL影响
+    assert cache.get_entry("clash_config", lambda: ("proxies: []", None))["content"] == "proxies: []"
+
+
+def test_config_response_has_validators():
+    from app.api.api_v1.endpoints.subscriptions import build_config_response
+    entry = build_config_entry(LARGE_CONTENT)
+
+    response = build_config_response(make_request(), entry)
+    assert response.headers["etag"] == f'"{entry["etag"]}"'
+    assert response.headers["cache-control"] == "no-cache"
+
+    response = build_config_response(make_request({"If-None-Match": response.headers["etag"]}), entry)
+    assert response.status_code == 304
+
+
+def test_placeholder_response_has_no_validators():
+    from app.api.api_v1.endpoints.subscriptions import build_config_response
+    entry = build_placeholder_entry("# Clash配置加载失败: database is locked")
+
+    response = build_config_response(make_request(), entry)
+    assert response.status_code == 200
+    assert "etag" not in response.headers
+    assert "last-modified" not in response.headers
+    assert response.headers["cache-control"] == "no-store"
+
+    response = build_config_response(make_request({"If-None-Match": "*", "Accept-Encoding": "gzip"}), entry)
+    assert response.status_code == 200
+    assert response.body == entry["content"].encode("utf-8")
+
+
+def test_config_entry_error_returns_placeholder():
+    from app.services.subscription import SubscriptionService
+
+    class BrokenSession:
+        def execute(self, *args, **kwargs):
+            raise RuntimeError("database is locked")
+
+    subscription_cache.subscription_config_cache.invalidate()
+    entry = SubscriptionService(BrokenSession()).get_clash_config_entry()
+    assert entry["etag"] is None
+    assert "database is locked" in entry["content"]
+
+
+def test_key_cache_invalidate_drops_record():
+    cache = SubscriptionKeyCache(ttl=60)
+    cache.set("url-1", make_record(), cache.generation)
+    assert cache.get("url-1").device_limit == 3
+
+    cache.invalidate(1)
+    assert cache.get("url-1") is None
+
+
+def test_key_cache_ignores_write_raced_by_invalidation():
+    cache = SubscriptionKeyCache(ttl=60)
+    generation = cache.generation
+    cache.invalidate(1)
+    cache.set("url-1", make_record(), generation)
+    assert cache.get("url-1") is None
+
+
+def test_key_cache_replaces_old_url_of_same_subscription():
+    cache = SubscriptionKeyCache(ttl=60)
+    cache.set("old-url", make_record(), cache.generation)
+    cache.set("new-url", make_record(), cache.generation)
+    assert cache.get("old-url") is None
+    assert cache.get("new-url") is not None
+
+
+
+def test_admin_subscription_update_invalidates_key_cache(db):
+    from datetime import datetime, timedelta
+    from app.api.api_v1.endpoints.admin import update_subscription
+    from app.models import Subscription, User
+
+    user = User(username="user", email="user@example.com", hashed_password="x")
+    db.add(user)
+    db.flush()
+    subscription = Subscription(
+        user_id=user.id, subscription_url="url-1", device_limit=3,
+        expire_time=datetime.utcnow() + timedelta(days=30)
+    )
+    db.add(subscription)
+    db.commit()
+
+    key_cache = subscription_cache.subscription_key_cache
+    key_cache.set("url-1", make_record(subscription.id), key_cache.generation)
+
+    response = update_subscription(subscription.id, {"device_limit": 1, "is_active": False}, db=db, current_admin=None)
+    assert response.success
+    assert key_cache.get("url-1") is None
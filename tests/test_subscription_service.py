@@ -0,0 +1,62 @@
+"""管理后台订阅列表排序测试"""
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from app.models import Subscription, User
+from app.services import subscription as subscription_module
+from app.services.device_presence import DevicePresence
+from app.services.subscription import SubscriptionService
+
+
+@pytest.fixture
+def presence(monkeypatch):
+    presence = DevicePresence()
+    monkeypatch.setattr(subscription_module, "device_presence", presence)
+    return presence
+
+
+def make_subscriptions(db, count):
+    subscriptions = []
+    for i in range(count):
+        user = User(username=f"user-{i}", email=f"user-{i}@example.com", hashed_password="x")
+        db.add(user)
+        db.flush()
+        subscription = Subscription(
+            user_id=user.id, subscription_url=f"url-{i}", device_limit=5,
+            expire_time=datetime.utcnow() + timedelta(days=30)
+        )
+        db.add(subscription)
+        db.flush()
+        subscriptions.append(subscription)
+    db.commit()
+    return subscriptions
+
+
+def test_sort_by_online_devices_pages_in_database(db, presence):
+    s1, s2, s3, s4 = make_subscriptions(db, 4)
+    presence.touch(101, s3.id)
+    presence.touch(102, s3.id)
+    presence.touch(103, s2.id)
+    presence.touch(104, s4.id)
+
+    service = SubscriptionService(db)
+    page, stats, total = service.get_subscriptions_with_device_stats(skip=0, limit=3, sort='online_devices_desc')
+    assert total == 4
+    assert [s.id for s in page] == [s3.id, s2.id, s4.id]
+    assert stats[s3.id]['online_devices'] == 2
+
+    page, _, _ = service.get_subscriptions_with_device_stats(skip=3, limit=3, sort='online_devices_desc')
+    assert [s.id for s in page] == [s1.id]
+
+    page, _, _ = service.get_subscriptions_with_device_stats(skip=0, limit=10, sort='online_devices_asc')
+    assert [s.id for s in page] == [s1.id, s2.id, s4.id, s3.id]
+
+
+def test_sort_by_online_devices_without_online_devices(db, presence):
+    subscriptions = make_subscriptions(db, 3)
+
+    page, _, total = SubscriptionService(db).get_subscriptions_with_device_stats(limit=2, sort='online_devices_desc')
+    assert total == 3
+    assert [s.id for s in page] == [s.id for s in subscriptions[:2]]